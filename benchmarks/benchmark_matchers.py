@@ -0,0 +1,87 @@
+# Name:    benchmark_matchers.py
+# Purpose: Compare recall and speed of exact and approximate (LSH) matchers
+# Authors:      Anton Korosov
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# Usage:
+#   python benchmark_matchers.py [image1.tif image2.tif]
+# Without arguments a synthetic pair of textured images is used. Recall is
+# the fraction of matches from the exact matcher (after the ratio test)
+# which are also found by the approximate matcher.
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+from scipy import ndimage as nd
+
+from sea_ice_drift.ftlib import (find_key_points,
+                                 get_matcher,
+                                 _get_matches)
+
+NFEATURES = [10000, 50000, 100000]
+RATIO_TEST = 0.7
+MATCHERS = [
+    ('bf', {}),
+    ('lsh', dict(lsh_tables=6, lsh_key_size=12, lsh_probes=1)),
+    ('lsh', dict(lsh_tables=12, lsh_key_size=20, lsh_probes=2)),
+]
+
+def get_synthetic_images(size=6000, shift=(15, 25), seed=0):
+    ''' Create two textured images shifted relative to each other '''
+    rs = np.random.RandomState(seed)
+    img = nd.gaussian_filter(rs.rand(size + shift[0], size + shift[1]), 2)
+    img = (255 * (img - img.min()) / (img.max() - img.min())).astype(np.uint8)
+    img1 = img[:size, :size]
+    img2 = img[shift[0]:, shift[1]:]
+    noise = rs.randint(-5, 6, img2.shape)
+    img2 = np.clip(img2 + noise, 0, 255).astype(np.uint8)
+    return img1, img2
+
+def get_images(argv):
+    ''' Read images from files given in <argv> or create synthetic '''
+    if len(argv) < 3:
+        return get_synthetic_images()
+    from sea_ice_drift.lib import get_n
+    return get_n(argv[1])[1], get_n(argv[2])[1]
+
+def match(matcher, descr1, descr2, **kwargs):
+    ''' Match descriptors and return pairs passing ratio test and time '''
+    bf = get_matcher(matcher, **kwargs)
+    t0 = time.time()
+    matches = _get_matches(descr1, descr2, bf, False).ratio_test(RATIO_TEST)
+    t1 = time.time()
+    pairs = set(zip(matches.query_idx, matches.train_idx))
+    return pairs, t1 - t0
+
+def main(argv):
+    img1, img2 = get_images(argv)
+    print('%8s %8s %50s %10s %8s %8s' % ('nFeat', 'nKeyP', 'matcher',
+                                         'time, s', 'matches', 'recall'))
+    for nFeatures in NFEATURES:
+        kp1, descr1 = find_key_points(img1, nFeatures=nFeatures)
+        kp2, descr2 = find_key_points(img2, nFeatures=nFeatures)
+        exact = None
+        for matcher, params in MATCHERS:
+            pairs, dt = match(matcher, descr1, descr2, **params)
+            if exact is None:
+                exact = pairs
+            recall = len(exact & pairs) / float(max(len(exact), 1))
+            name = '%s %s' % (matcher, ','.join('%s=%s' % kv for kv in
+                                                sorted(params.items())))
+            print('%8d %8d %50s %10.2f %8d %8.3f' % (
+                  nFeatures, len(kp1), name, dt, len(pairs), recall))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,70 @@
+# Name:    benchmark_mcc.py
+# Purpose: Compare speed of per-angle and batched FFT cross-correlation
+# Authors:      Anton Korosov
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# Usage:
+#   python benchmark_mcc.py
+# Time of rotate_and_match for one point with engine='opencv' (one
+# cv2.matchTemplate per angle) and engine='fft' (all angles correlated in
+# frequency domain at once) for several template sizes, search window borders
+# and numbers of angles. Maximum difference of the best CC values is printed.
+from __future__ import print_function
+
+import time
+
+import numpy as np
+from scipy import ndimage as nd
+
+from sea_ice_drift.pmlib import rotate_and_match
+
+IMG_SIZES = [35, 51]
+BORDERS = [20, 50, 100]
+ANGLES = [range(-15, 16, 3), range(-15, 16, 1)]
+REPEATS = 20
+
+def get_synthetic_images(size=600, angle=5, seed=0):
+    ''' Create textured image and its rotated copy '''
+    rs = np.random.RandomState(seed)
+    img = nd.gaussian_filter(rs.rand(size, size), 2)
+    img1 = (255 * (img - img.min()) / (img.max() - img.min())).astype(np.uint8)
+    img2 = nd.rotate(img1, angle, reshape=False, order=1)
+    return img1, img2
+
+def run(engine, img1, x, y, img_size, image, angles):
+    ''' Run rotate_and_match <REPEATS> times and return mean time and result '''
+    t0 = time.time()
+    for i in range(REPEATS):
+        result = rotate_and_match(img1, x, y, img_size, image, 0,
+                                  list(angles), engine=engine)
+    return (time.time() - t0) / REPEATS, result
+
+def main():
+    img1, img2 = get_synthetic_images()
+    x = y = img1.shape[0] // 2
+    print('%8s %8s %8s %12s %12s %8s %10s' % ('imgSize', 'border', 'angles',
+          'opencv, ms', 'fft, ms', 'speedup', 'max diff'))
+    for img_size in IMG_SIZES:
+        hws = img_size // 2
+        for border in BORDERS:
+            image = img2[y - hws - border:y + hws + border + 1,
+                         x - hws - border:x + hws + border + 1]
+            for angles in ANGLES:
+                t_cv, r_cv = run('opencv', img1, x, y, img_size, image, angles)
+                t_fft, r_fft = run('fft', img1, x, y, img_size, image, angles)
+                print('%8d %8d %8d %12.2f %12.2f %8.2f %10.2e' % (
+                      img_size, border, len(angles), t_cv * 1000,
+                      t_fft * 1000, t_cv / t_fft, abs(r_cv[0] - r_fft[0])))
+
+if __name__ == '__main__':
+    main()
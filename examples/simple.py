@@ -36,22 +36,22 @@ from sea_ice_drift import SeaIceDrift
 # open files, read 'sigma0_HV' band and convert to UInt8 image
 f1 = 'S1B_EW_GRDM_1SDH_20161005T101835_20161005T101935_002370_004016_FBF1.SAFE.tif'
 f2 = 'S1A_EW_GRDM_1SDH_20161005T142446_20161005T142546_013356_0154D8_C3EC.SAFE.tif'
-sid = SeaIceDrift(f1, f2)
+# workers of Pattern Matching are stopped at the end of the with block
+with SeaIceDrift(f1, f2) as sid:
+    # apply Feature Tracking algorithm and retrieve ice drift speed
+    # and starting/ending coordinates of matched keypoints
+    uft, vft, lon1ft, lat1ft, lon2ft, lat2ft = sid.get_drift_FT()
 
-# apply Feature Tracking algorithm and retrieve ice drift speed
-# and starting/ending coordinates of matched keypoints
-uft, vft, lon1ft, lat1ft, lon2ft, lat2ft = sid.get_drift_FT()
+    # user defined grid of points:
+    lon1pm, lat1pm = np.meshgrid(np.linspace(-3, 2, 50),
+                         np.linspace(86.4, 86.8, 50))
 
-# user defined grid of points:
-lon1pm, lat1pm = np.meshgrid(np.linspace(-3, 2, 50),
-                     np.linspace(86.4, 86.8, 50))
-
-# apply Pattern Matching and find sea ice drift speed
-# for the given grid of points
-upm, vpm, rpm, apm, hpm, lon2pm, lat2pm = sid.get_drift_PM(
-                                    lon1pm, lat1pm,
-                                    lon1ft, lat1ft,
-                                    lon2ft, lat2ft)
+    # apply Pattern Matching and find sea ice drift speed
+    # for the given grid of points
+    upm, vpm, rpm, apm, hpm, lon2pm, lat2pm = sid.get_drift_PM(
+                                        lon1pm, lat1pm,
+                                        lon1ft, lat1ft,
+                                        lon2ft, lat2ft)
 
 # ==== PLOTTING ====
 # get coordinates of SAR scene borders
@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 
-from sea_ice_drift.lib import (get_uint8_image,
+from sea_ice_drift.lib import (PolyDriftModel,
+                               ScatteredInterpolator,
+                               get_uint8_image,
                                get_displacement_km,
                                get_speed_ms,
                                get_displacement_pix,
@@ -10,10 +12,14 @@ from sea_ice_drift.lib import (get_uint8_image,
                                get_n,
                                get_drift_vectors)
 
-from sea_ice_drift.ftlib import (find_key_points,
+from sea_ice_drift.ftlib import (KeyPoints,
+                                 Matches,
+                                 find_key_points,
+                                 get_matcher,
                                  get_match_coords,
                                  domain_filter,
                                  max_drift_filter,
+                                 get_max_drift_pix,
                                  lstsq_filter,
                                  feature_tracking)
 
@@ -22,13 +28,35 @@ from sea_ice_drift.pmlib import (get_rotated_template,
                                  get_initial_rotation,
                                  rotate_and_match,
                                  use_mcc,
-                                 use_mcc_mp,
+                                 use_mcc_chunk,
+                                 get_window_norms,
+                                 match_templates_integral,
+                                 get_pyramid,
+                                 refine_first_guess,
+                                 get_pixel_grid,
                                  prepare_first_guess,
                                  pattern_matching)
 
+from sea_ice_drift.cache import ArrayCache
+from sea_ice_drift.shared import SharedArrays
+from sea_ice_drift.reader import BlockReader, get_reader
+from sea_ice_drift.checkpoint import Checkpoint
+from sea_ice_drift.executors import (SerialExecutor,
+                                     ThreadExecutor,
+                                     ProcessExecutor,
+                                     get_executor)
+from sea_ice_drift.geolocation import (FastGeolocation,
+                                       TileGeolocation,
+                                       Projector,
+                                       get_projector)
+
+from sea_ice_drift.tiling import tiled_drift
 from sea_ice_drift.seaicedrift import SeaIceDrift
+from sea_ice_drift.batch import BatchRunner, run_batch
 
 __all__ = [
+    'PolyDriftModel',
+    'ScatteredInterpolator',
     'get_uint8_image',
     'get_displacement_km',
     'get_speed_ms',
@@ -37,18 +65,49 @@ __all__ = [
     'x2y2_interpolation_poly',
     'x2y2_interpolation_near',
     'get_n', 
+    'get_drift_vectors',
     
+    'KeyPoints',
+    'Matches',
     'find_key_points',
+    'get_matcher',
     'get_match_coords',
     'domain_filter',
     'max_drift_filter',
+    'get_max_drift_pix',
     'lstsq_filter',
+    'feature_tracking',
 
     'get_rotated_template',
     'get_distance_to_nearest_keypoint',
     'get_initial_rotation',
     'rotate_and_match',
     'use_mcc',
+    'use_mcc_chunk',
+    'get_window_norms',
+    'match_templates_integral',
+    'get_pyramid',
+    'refine_first_guess',
+    'get_pixel_grid',
+    'prepare_first_guess',
+    'pattern_matching',
+
+    'ArrayCache',
+    'SharedArrays',
+    'BlockReader',
+    'get_reader',
+    'Checkpoint',
+    'SerialExecutor',
+    'ThreadExecutor',
+    'ProcessExecutor',
+    'get_executor',
+    'FastGeolocation',
+    'TileGeolocation',
+    'Projector',
+    'get_projector',
 
+    'tiled_drift',
     'SeaIceDrift',
+    'BatchRunner',
+    'run_batch',
     ]
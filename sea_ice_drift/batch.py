@@ -0,0 +1,423 @@
+# Name:    batch.py
+# Purpose: Processing of many pairs of scenes in parallel
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+try:
+    from multiprocessing.connection import wait
+except ImportError:
+    # Python 2
+    wait = None
+
+import numpy as np
+
+import gdal
+
+from sea_ice_drift.seaicedrift import SeaIceDrift
+
+# bytes per pixel of the working (subsampled) image: UInt8 image and its
+# copies in Nansat, ORB pyramid, shared images and temporary arrays of PM
+BYTES_PER_PIXEL = 8
+# memory used by a pair independently of the scene size (Python, modules,
+# keypoints, descriptors), bytes
+PAIR_OVERHEAD = 500 * 1024**2
+
+def get_available_memory(fraction=0.8):
+    ''' Return <fraction> of physical memory of the node, bytes '''
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        total = 8 * 1024**3
+    return int(total * fraction)
+
+def estimate_pair_memory(filename1, filename2, factor=0.5,
+                         bytes_per_pixel=BYTES_PER_PIXEL,
+                         overhead=PAIR_OVERHEAD):
+    ''' Estimate memory needed for processing of a pair from size of scenes
+    Parameters
+    ----------
+        filename1, filename2 : str, names of input files
+        factor : float, subsampling factor (as in get_n)
+        bytes_per_pixel : int, memory per pixel of subsampled image
+        overhead : int, memory per pair independent of the size
+    Returns
+    -------
+        memory : int, bytes
+    '''
+    pixels = 0
+    for filename in [filename1, filename2]:
+        ds = gdal.Open(filename)
+        if ds is None:
+            raise IOError('Cannot open %s' % filename)
+        pixels += ds.RasterXSize * ds.RasterYSize * factor**2
+        ds = None
+    return int(pixels * bytes_per_pixel + overhead)
+
+def get_pair_id(filename1, filename2):
+    ''' Return name of the pair product from names of input files '''
+    names = [os.path.splitext(os.path.basename(f))[0]
+             for f in [filename1, filename2]]
+    return '%s_%s' % tuple(names)
+
+def process_pair(filename1, filename2, output, grid, ft_kwargs=None,
+                 pm_kwargs=None, **kwargs):
+    ''' Retrieve drift from one pair with FT and PM and save the product
+    Parameters
+    ----------
+        filename1, filename2 : str, names of input files
+        output : str, name of the output .npz file
+        grid : dict, lon and lat (or x, y and nsr) of the PM grid
+        ft_kwargs : dict, parameters for SeaIceDrift.get_drift_FT
+        pm_kwargs : dict, parameters for SeaIceDrift.get_drift_PM. PM runs in
+            the current process by default (backend='serial').
+        **kwargs : parameters for SeaIceDrift (e.g. factor)
+    Returns
+    -------
+        status : dict with status of the pair
+    '''
+    t0 = time.time()
+    ft_kwargs = dict(ft_kwargs or {})
+    pm_kwargs = dict(pm_kwargs or {})
+    # pairs run in worker processes which cannot start pools of processes
+    pm_kwargs.setdefault('backend', 'serial')
+    status = dict(filename1=filename1, filename2=filename2, output=output)
+    try:
+        with SeaIceDrift(filename1, filename2, **kwargs) as sid:
+            uft, vft, lon1ft, lat1ft, lon2ft, lat2ft = sid.get_drift_FT(
+                                                                **ft_kwargs)
+            product = dict(uft=uft, vft=vft, lon1ft=lon1ft, lat1ft=lat1ft,
+                           lon2ft=lon2ft, lat2ft=lat2ft)
+            if 'nsr' in grid:
+                upm, vpm, rpm, apm, hpm, x2pm, y2pm = sid.get_drift_PM_grid(
+                    grid['x'], grid['y'], grid['nsr'],
+                    lon1ft, lat1ft, lon2ft, lat2ft, **pm_kwargs)
+                product.update(x1pm=grid['x'], y1pm=grid['y'],
+                               x2pm=x2pm, y2pm=y2pm)
+            else:
+                upm, vpm, rpm, apm, hpm, lon2pm, lat2pm = sid.get_drift_PM(
+                    grid['lon'], grid['lat'],
+                    lon1ft, lat1ft, lon2ft, lat2ft, **pm_kwargs)
+                product.update(lon1pm=grid['lon'], lat1pm=grid['lat'],
+                               lon2pm=lon2pm, lat2pm=lat2pm)
+            product.update(upm=upm, vpm=vpm, rpm=rpm, apm=apm, hpm=hpm)
+        # write to temporary file and rename to avoid incomplete products
+        tmp_output = output + '.tmp.npz'
+        np.savez(tmp_output, **product)
+        os.rename(tmp_output, output)
+        status.update(status='done', ft_vectors=len(uft),
+                      pm_vectors=int(np.isfinite(rpm).sum()))
+    except Exception as e:
+        status.update(status='failed', error='%s: %s' % (type(e).__name__, e),
+                      traceback=traceback.format_exc())
+    status['time'] = time.time() - t0
+    return status
+
+def _process_pair_mp(connection, pair_func, args, kwargs):
+    ''' Call <pair_func> in a worker process and send status through
+    <connection> '''
+    try:
+        status = pair_func(*args, **kwargs)
+    except BaseException as e:
+        status = dict(status='failed', error='%s: %s' % (type(e).__name__, e),
+                      traceback=traceback.format_exc())
+    try:
+        connection.send(status)
+    except Exception as e:
+        # e.g. status cannot be pickled
+        connection.send(dict(status='failed',
+                             error='%s: %s' % (type(e).__name__, e)))
+    connection.close()
+
+def _wait_finished(running, interval=0.1):
+    ''' Wait until at least one running pair sends status or its process
+    exits
+    Parameters
+    ----------
+        running : dict, process and receiving connection of each pair
+        interval : float, interval of polling on Python 2, seconds
+    Returns
+    -------
+        finished : list of ids of finished pairs
+    '''
+    while True:
+        if wait is not None:
+            wait([obj for process, receiver in running.values()
+                  for obj in (receiver, process.sentinel)])
+        finished = [pair_id for pair_id in running
+                    if running[pair_id][1].poll() or
+                    not running[pair_id][0].is_alive()]
+        if len(finished) > 0:
+            return finished
+        time.sleep(interval)
+
+def _get_finished_status(process, connection):
+    ''' Get status sent by finished worker process or status of failure if
+    the process exited without sending it (e.g. killed by OOM killer) '''
+    if connection.poll():
+        try:
+            return connection.recv()
+        except Exception:
+            # incomplete or broken status
+            pass
+    process.join()
+    return dict(status='failed',
+                error='Worker process exited with code %s' % process.exitcode)
+
+def _get_next_pair(pending, memory, memory_used, running, budget):
+    ''' Find the first pending pair which fits into free memory
+    Parameters
+    ----------
+        pending : list of pair ids
+        memory : dict, estimated memory of each pair
+        memory_used : int, memory used by running pairs
+        running : int, number of running pairs
+        budget : int, total memory budget
+    Returns
+    -------
+        pair_id : id of the pair to start or None. If nothing is running,
+            the first pending pair is started even if it does not fit.
+    '''
+    for pair_id in pending:
+        if memory_used + memory[pair_id] <= budget:
+            return pair_id
+    if running == 0 and len(pending) > 0:
+        return pending[0]
+    return None
+
+class BatchRunner(object):
+    ''' Process many pairs concurrently within a memory budget
+
+    Each pair is processed by process_pair in a new process (which returns
+    memory to the system when it exits). A pair is started only when its
+    estimated memory fits into the budget together with the pairs already
+    running. A pair whose process is killed (e.g. by the OOM killer) is
+    marked as failed. Products (<pair_id>.npz) and status of pairs
+    (status.json) are written to the output directory as soon as each pair
+    is finished. Pairs which are already done are skipped, so an interrupted
+    batch can be restarted.
+    '''
+    def __init__(self, pairs, grid, output_dir, processes=None, memory=None,
+                 factor=0.5, bytes_per_pixel=BYTES_PER_PIXEL,
+                 overhead=PAIR_OVERHEAD, ft_kwargs=None, pm_kwargs=None,
+                 verbose=True, pair_func=process_pair, **kwargs):
+        ''' Initialize batch
+        Parameters
+        ----------
+            pairs : list of (filename1, filename2)
+            grid : dict, lon and lat (or x, y and nsr) of the PM grid
+            output_dir : str, directory for products and status.json
+            processes : int, maximum number of pairs processed concurrently
+                (number of CPUs if None)
+            memory : int, memory budget, bytes (80% of physical memory if
+                None)
+            factor : float, subsampling factor (as in get_n)
+            bytes_per_pixel : int, memory per pixel (estimate_pair_memory)
+            overhead : int, memory per pair (estimate_pair_memory)
+            ft_kwargs : dict, parameters for SeaIceDrift.get_drift_FT
+            pm_kwargs : dict, parameters for SeaIceDrift.get_drift_PM
+            verbose : bool, print status of pairs?
+            pair_func : function which processes one pair (see process_pair)
+            **kwargs : parameters for SeaIceDrift
+        '''
+        self.pairs = [tuple(pair) for pair in pairs]
+        self.grid = grid
+        self.output_dir = output_dir
+        self.processes = processes or multiprocessing.cpu_count()
+        self.memory = memory or get_available_memory()
+        self.factor = factor
+        self.bytes_per_pixel = bytes_per_pixel
+        self.overhead = overhead
+        self.ft_kwargs = ft_kwargs
+        self.pm_kwargs = pm_kwargs
+        self.verbose = verbose
+        self.pair_func = pair_func
+        self.kwargs = kwargs
+        self.status_file = os.path.join(output_dir, 'status.json')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.status = self._read_status()
+
+    def _read_status(self):
+        ''' Read status of pairs from previous runs '''
+        if os.path.exists(self.status_file):
+            with open(self.status_file) as f:
+                return json.load(f)
+        return {}
+
+    def _write_status(self):
+        ''' Write status of all pairs (atomic replacement of the file) '''
+        tmp_file = self.status_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.status, f, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.status_file)
+
+    def _set_status(self, pair_id, **kwargs):
+        ''' Update status of a pair and write all statuses '''
+        self.status.setdefault(pair_id, {}).update(kwargs)
+        self._write_status()
+        if self.verbose:
+            print('%s: %s' % (pair_id, self.status[pair_id]['status']))
+
+    def get_pending(self):
+        ''' Return dict with ids and filenames of pairs which are not done '''
+        pending = {}
+        for filename1, filename2 in self.pairs:
+            pair_id = get_pair_id(filename1, filename2)
+            output = os.path.join(self.output_dir, pair_id + '.npz')
+            if (self.status.get(pair_id, {}).get('status') == 'done' and
+                    os.path.exists(output)):
+                continue
+            pending[pair_id] = (filename1, filename2, output)
+        return pending
+
+    def run(self):
+        ''' Process all pending pairs
+        Returns
+        -------
+            status : dict, status of each pair
+        '''
+        pending = self.get_pending()
+        memory = {}
+        for pair_id in sorted(pending):
+            try:
+                memory[pair_id] = estimate_pair_memory(
+                    pending[pair_id][0], pending[pair_id][1], self.factor,
+                    self.bytes_per_pixel, self.overhead)
+            except IOError as e:
+                self._set_status(pair_id, status='failed', error=str(e),
+                                 filename1=pending[pair_id][0],
+                                 filename2=pending[pair_id][1])
+                del pending[pair_id]
+                continue
+            self._set_status(pair_id, status='pending',
+                             memory=memory[pair_id])
+
+        # the largest pairs first to use the budget better
+        order = sorted(pending, key=lambda p: -memory[p])
+        memory_used = 0
+        # process and receiving end of pipe for each running pair
+        running = {}
+        try:
+            while len(order) > 0 or len(running) > 0:
+                pair_id = None
+                if len(running) < self.processes:
+                    pair_id = _get_next_pair(order, memory, memory_used,
+                                             len(running), self.memory)
+                if pair_id is not None:
+                    order.remove(pair_id)
+                    self._set_status(pair_id, status='running',
+                                     started=time.time())
+                    kwargs = dict(self.kwargs, factor=self.factor,
+                                  ft_kwargs=self.ft_kwargs,
+                                  pm_kwargs=self.pm_kwargs)
+                    receiver, sender = multiprocessing.Pipe(duplex=False)
+                    process = multiprocessing.Process(target=_process_pair_mp,
+                        args=(sender, self.pair_func,
+                              pending[pair_id] + (self.grid,), kwargs))
+                    try:
+                        process.start()
+                    except Exception as e:
+                        # e.g. arguments cannot be pickled
+                        self._set_status(pair_id, status='failed',
+                                         error='%s: %s' % (type(e).__name__, e))
+                        continue
+                    finally:
+                        sender.close()
+                    memory_used += memory[pair_id]
+                    running[pair_id] = (process, receiver)
+                    continue
+                # wait until a running pair sends status or its process exits
+                for pair_id in _wait_finished(running):
+                    process, receiver = running[pair_id]
+                    status = _get_finished_status(process, receiver)
+                    process.join()
+                    receiver.close()
+                    del running[pair_id]
+                    memory_used -= memory[pair_id]
+                    self._set_status(pair_id, **status)
+        finally:
+            for process, receiver in running.values():
+                process.terminate()
+                process.join()
+                receiver.close()
+        return self.status
+
+def run_batch(pairs, grid, output_dir, **kwargs):
+    ''' Process many pairs concurrently (see BatchRunner)
+    Parameters
+    ----------
+        pairs : list of (filename1, filename2)
+        grid : dict, lon and lat (or x, y and nsr) of the PM grid
+        output_dir : str, directory for products and status.json
+        **kwargs : parameters for BatchRunner
+    Returns
+    -------
+        status : dict, status of each pair
+    '''
+    return BatchRunner(pairs, grid, output_dir, **kwargs).run()
+
+def read_pairs(filename):
+    ''' Read pairs of file names (two names per line) from text file '''
+    pairs = []
+    with open(filename) as f:
+        for line in f:
+            names = line.split()
+            if len(names) == 2 and not line.startswith('#'):
+                pairs.append(tuple(names))
+    return pairs
+
+def read_grid(filename):
+    ''' Read PM grid (lon, lat or x, y, nsr) from .npz file '''
+    npz = np.load(filename)
+    if 'lon' in npz and 'lat' in npz:
+        return dict(lon=npz['lon'], lat=npz['lat'])
+    return dict(x=npz['x'], y=npz['y'], nsr=str(npz['nsr']))
+
+def main(args=None):
+    ''' Console entry point: process pairs listed in a text file '''
+    parser = argparse.ArgumentParser(
+        description='Retrieve sea ice drift from many pairs of scenes')
+    parser.add_argument('pairs',
+        help='text file with two names of input files on each line')
+    parser.add_argument('grid',
+        help='.npz file with PM grid: arrays lon and lat or x, y and nsr')
+    parser.add_argument('output_dir', help='directory for products')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+        help='maximum number of pairs processed concurrently')
+    parser.add_argument('-m', '--memory', type=float, default=None,
+        help='memory budget, GB')
+    parser.add_argument('-f', '--factor', type=float, default=0.5,
+        help='subsampling factor')
+    args = parser.parse_args(args)
+
+    memory = None
+    if args.memory is not None:
+        memory = int(args.memory * 1024**3)
+    status = run_batch(read_pairs(args.pairs), read_grid(args.grid),
+                       args.output_dir, processes=args.processes,
+                       memory=memory, factor=args.factor)
+    failed = [p for p in status if status[p]['status'] != 'done']
+    print('%d pairs done, %d failed' % (len(status) - len(failed),
+                                        len(failed)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
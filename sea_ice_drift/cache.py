@@ -0,0 +1,175 @@
+# Name:    cache.py
+# Purpose: Container of on-disk cache of arrays
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+CACHE_DIR_ENV = 'ICE_DRIFT_CACHE_DIR'
+
+class ArrayCache(object):
+    ''' Size-bounded on-disk cache of numpy arrays
+
+    Each entry is a directory <path>/<key> with one .npy file per array and
+    optional metadata in JSON sidecar. Arrays are memory-mapped on load.
+    The least recently used entries are removed when total size of the cache
+    exceeds <max_size>.
+    '''
+    def __init__(self, path, max_size=4*1024**3):
+        ''' Initialize cache
+        Parameters
+        ----------
+            path : str, directory with the cache (created if needed)
+            max_size : int, maximum size of the cache, bytes
+        '''
+        self.path = path
+        self.max_size = max_size
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # created by another process
+                pass
+
+    @staticmethod
+    def get_key(*args, **kwargs):
+        ''' Compute key from arrays (by content) and other parameters
+        Parameters
+        ----------
+            *args : numpy arrays or strings
+            **kwargs : other parameters (converted to str)
+        Returns
+        -------
+            key : str, SHA1 hash
+        '''
+        sha = hashlib.sha1()
+        for arg in args:
+            if isinstance(arg, np.ndarray):
+                sha.update(str((arg.shape, arg.dtype.str)).encode('utf-8'))
+                sha.update(np.ascontiguousarray(arg).data)
+            else:
+                sha.update(str(arg).encode('utf-8'))
+        for name in sorted(kwargs):
+            sha.update(('%s=%s;' % (name, kwargs[name])).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self._entry(key), 'metadata.json'))
+
+    def get(self, key, mmap_mode='r'):
+        ''' Get arrays and metadata from cache
+        Parameters
+        ----------
+            key : str, key of the entry
+            mmap_mode : str, mode for memory mapping of arrays (None to read)
+        Returns
+        -------
+            arrays : dict with numpy arrays or None if key is not in cache
+            metadata : dict with metadata or None if key is not in cache
+        '''
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'metadata.json')) as f:
+                metadata = json.load(f)
+            arrays = dict([(name, np.load(os.path.join(entry, name + '.npy'),
+                                          mmap_mode=mmap_mode))
+                           for name in metadata['arrays']])
+            # mark the entry as recently used
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None, None
+        return arrays, metadata['metadata']
+
+    def put(self, key, arrays, metadata=None):
+        ''' Put arrays and metadata into cache
+        Parameters
+        ----------
+            key : str, key of the entry
+            arrays : dict with numpy arrays
+            metadata : dict with JSON serializable metadata
+        '''
+        tmpdir = tempfile.mkdtemp(prefix='.tmp', dir=self.path)
+        try:
+            for name in arrays:
+                np.save(os.path.join(tmpdir, name + '.npy'),
+                        np.ascontiguousarray(arrays[name]))
+            with open(os.path.join(tmpdir, 'metadata.json'), 'w') as f:
+                json.dump(dict(arrays=sorted(arrays), metadata=metadata), f)
+            # atomic replacement of the entry
+            os.rename(tmpdir, self._entry(key))
+        except OSError:
+            # entry already written by another process
+            pass
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        self.evict()
+
+    def size(self):
+        ''' Return total size of all entries in the cache, bytes '''
+        return sum(s for s, t, e in self._get_entries())
+
+    def _get_entries(self):
+        ''' Return list of (size, access time, path) of all entries '''
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name.startswith('.tmp') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                           for f in os.listdir(entry))
+                entries.append((size, os.path.getmtime(entry), entry))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        ''' Remove least recently used entries to fit into <max_size> '''
+        entries = sorted(self._get_entries(), key=lambda e: e[1])
+        total = sum(e[0] for e in entries)
+        for size, mtime, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def get_cache(cache, name):
+    ''' Get ArrayCache
+    Parameters
+    ----------
+        cache : ArrayCache or str (root directory) or None. If None, root
+            directory is read from environment variable ICE_DRIFT_CACHE_DIR
+            and if it is not set, None is returned (no cache)
+        name : str, name of subdirectory in the root directory
+    Returns
+    -------
+        cache : ArrayCache or None
+    '''
+    if isinstance(cache, ArrayCache):
+        return cache
+    if cache is None:
+        cache = os.getenv(CACHE_DIR_ENV)
+    if not cache:
+        return None
+    return ArrayCache(os.path.join(cache, name))
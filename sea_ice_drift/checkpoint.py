@@ -0,0 +1,155 @@
+# Name:    checkpoint.py
+# Purpose: Container of checkpoints of pattern matching
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import
+
+import os
+import time
+
+import numpy as np
+
+from sea_ice_drift.cache import ArrayCache
+from sea_ice_drift.reader import BlockReader
+
+class Checkpoint(object):
+    ''' On-disk store of results of pattern matching for resuming long runs
+
+    Results of finished points are saved into <path>/<key>.npz not more
+    often than every <interval> seconds and after the last point. The file
+    is replaced atomically, so a killed process leaves the last complete
+    checkpoint. A rerun with the same key computes only the remaining
+    points. Files are not removed after the run (see remove()).
+    '''
+    def __init__(self, path, interval=60.):
+        ''' Initialize store
+        Parameters
+        ----------
+            path : str, directory with checkpoints (created if needed)
+            interval : float, minimum time between saving, seconds
+        '''
+        self.path = path
+        self.interval = interval
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # created by another process
+                pass
+
+    @staticmethod
+    def get_key(img1, img2, arrays, params):
+        ''' Compute key from the pair of images, points and PM parameters
+        Parameters
+        ----------
+            img1, img2 : 2D arrays (hashed by content) or BlockReader
+                (identified by name of file)
+            arrays : dict with vectors of coordinates of points, first guess,
+                border and angle_prior (see use_mcc_chunk)
+            params : dict, other parameters of use_mcc (img_size, angles,
+                hesnorm, ...)
+        Returns
+        -------
+            key : str
+        '''
+        images = [(img.name or img[:, :]) if isinstance(img, BlockReader)
+                  else img for img in [img1, img2]]
+        return ArrayCache.get_key(*(images + [np.asarray(arrays[name])
+                                              for name in sorted(arrays)] +
+                                    sorted(arrays)), **params)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def load(self, key, size):
+        ''' Load results of finished points
+        Parameters
+        ----------
+            key : str, key of the run
+            size : int, number of points
+        Returns
+        -------
+            results : 2D array, x2, y2, r, a, h for each point (nan if the
+                point is not finished)
+            done : 1D bool vector, is the point finished?
+        '''
+        try:
+            with np.load(self._filename(key)) as data:
+                results, done = data['results'], data['done']
+            if results.shape == (size, 5) and done.shape == (size,):
+                return results, done
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return np.zeros((size, 5)) + np.nan, np.zeros(size, bool)
+
+    def save(self, key, results, done):
+        ''' Save results of finished points (atomic replacement of file)
+        Parameters
+        ----------
+            key : str, key of the run
+            results : 2D array, x2, y2, r, a, h for each point
+            done : 1D bool vector, is the point finished?
+        '''
+        tmpfile = self._filename(key) + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmpfile, results=results, done=done)
+        os.rename(tmpfile, self._filename(key))
+
+    def remove(self, key):
+        ''' Remove checkpoint of a run '''
+        if os.path.exists(self._filename(key)):
+            os.remove(self._filename(key))
+
+    def iter_results(self, key, chunks, size):
+        ''' Yield results of finished points from checkpoint and then from
+        <chunks> of new results, saving them periodically
+        Parameters
+        ----------
+            key : str, key of the run
+            chunks : function(todo) which returns iterator of chunks of
+                results (positions in <todo>, results) for the points <todo>
+            size : int, number of points
+        Yields
+        ------
+            positions : 1D vector, indices of points in the chunk
+            results : 2D array, x2, y2, r, a, h for each point in the chunk
+        '''
+        results, done = self.load(key, size)
+        if done.any():
+            print('Checkpoint: %d of %d points are done' % (done.sum(), size))
+            yield np.nonzero(done)[0], results[done]
+        todo = np.nonzero(~done)[0]
+        if todo.size == 0:
+            return
+        saved = time.time()
+        for positions, chunk_results in chunks(todo):
+            positions = todo[positions]
+            results[positions] = chunk_results
+            done[positions] = True
+            if time.time() - saved >= self.interval:
+                self.save(key, results, done)
+                saved = time.time()
+            yield positions, chunk_results
+        self.save(key, results, done)
+
+def get_checkpoint(checkpoint):
+    ''' Get Checkpoint
+    Parameters
+    ----------
+        checkpoint : Checkpoint, str (directory) or None (no checkpoint)
+    Returns
+    -------
+        checkpoint : Checkpoint or None
+    '''
+    if checkpoint is None or isinstance(checkpoint, Checkpoint):
+        return checkpoint
+    return Checkpoint(checkpoint)
@@ -0,0 +1,285 @@
+# Name:    executors.py
+# Purpose: Container of executors running pattern matching in parallel
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import
+
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from sea_ice_drift.shared import SharedArrays, finalize
+
+# modules imported once in the forkserver process
+PRELOAD_MODULES = ['numpy', 'scipy.ndimage', 'cv2', 'sea_ice_drift.pmlib']
+
+def _run_chunk(args):
+    ''' Open shared arrays and apply function to a chunk of points in a
+    worker process '''
+    func, files, objects, outputs, params, start, stop = args
+    data = SharedArrays.load(files)
+    data.update(objects)
+    for name in outputs:
+        data[name] = np.load(files[name], mmap_mode='r+')
+    func(data, params, start, stop)
+    for name in outputs:
+        data[name].flush()
+    return start, stop
+
+def _get_token(array):
+    ''' Cheap token of the content of array (shape, type and checksum) '''
+    array = np.ascontiguousarray(array)
+    return array.shape, array.dtype.str, zlib.adler32(array.data)
+
+class SerialExecutor(object):
+    ''' Apply function to chunks of points one by one in the current process
+
+    Useful for debugging and profiling. Base class for other executors which
+    have the same interface: map_chunks(), imap_chunks() and close().
+    '''
+    def __init__(self, threads=1, chunksize=None):
+        ''' Initialize executor
+        Parameters
+        ----------
+            threads : int, number of workers
+            chunksize : int, number of points processed by a worker in one
+                task. If None, each worker gets about 4 tasks per call.
+        '''
+        self.threads = threads
+        self.chunksize = chunksize
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_chunks(self, size):
+        ''' Split range of <size> points into chunks
+        Returns
+        -------
+            chunks : list of (start, stop) tuples
+        '''
+        chunksize = self.chunksize
+        if chunksize is None:
+            chunksize = int(np.ceil(size / float(self.threads * 4)))
+        chunksize = max(chunksize, 1)
+        return [(start, min(start + chunksize, size))
+                for start in range(0, size, chunksize)]
+
+    def map_chunks(self, func, data, outputs, params, size):
+        ''' Apply func(data, params, start, stop) to all chunks of points
+        Parameters
+        ----------
+            func : function which writes results for points from start to
+                stop into arrays <outputs> in <data>
+            data : dict with input and output arrays
+            outputs : list of str, names of output arrays in <data>
+            params : dict, other parameters of <func>
+            size : int, number of points
+        '''
+        for chunk in self.imap_chunks(func, data, outputs, params, size):
+            pass
+
+    def imap_chunks(self, func, data, outputs, params, size):
+        ''' Apply func(data, params, start, stop) to all chunks of points and
+        yield each chunk as soon as it is finished (chunks can be finished in
+        any order). Parameters are the same as in map_chunks.
+        Yields
+        ------
+            start, stop : int, range of points of the finished chunk. Arrays
+                <outputs> in <data> are filled for these points.
+        '''
+        for start, stop in self.get_chunks(size):
+            func(data, params, start, stop)
+            yield start, stop
+
+    def close(self):
+        ''' Release resources of the executor '''
+        pass
+
+class ThreadExecutor(SerialExecutor):
+    ''' Apply function to chunks of points in a pool of threads
+
+    Data are used by threads directly (without copying or pickling). Suitable
+    for functions which release the GIL (e.g. cv2.matchTemplate).
+    '''
+    def __init__(self, threads=5, chunksize=None):
+        super(ThreadExecutor, self).__init__(threads, chunksize)
+        self._pool = None
+
+    def imap_chunks(self, func, data, outputs, params, size):
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+
+        def run_chunk(chunk):
+            func(data, params, *chunk)
+            return chunk
+
+        for chunk in self._pool.imap_unordered(run_chunk,
+                                               self.get_chunks(size)):
+            yield chunk
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+class ProcessExecutor(SerialExecutor):
+    ''' Apply function to chunks of points in a long-lived pool of processes
+
+    The pool is started at the first call of map_chunks() and reused until
+    close(). Input arrays are shared with workers through memory-mapped files
+    and workers write into shared output arrays. An input array which was
+    already shared in the previous call (the same object with the same
+    checksum of content, e.g. an image) is not written again, so a scene
+    pair can be reused or replaced by another without restarting the
+    workers. Other input objects (e.g. BlockReader) are pickled and sent
+    with each task. Calls of imap_chunks() cannot overlap (e.g. a
+    generator of the previous call has to be finished or closed). Workers
+    are terminated if the executor is garbage collected without close().
+    '''
+    def __init__(self, threads=5, chunksize=None, start_method=None,
+                 preload=PRELOAD_MODULES):
+        ''' Initialize executor (workers are not started yet)
+        Parameters
+        ----------
+            threads : int, number of worker processes
+            chunksize : int, number of points processed by a worker in one
+                task. If None, each worker gets about 4 tasks per call.
+            start_method : str, 'fork', 'spawn', 'forkserver' or None
+                (default of the platform). Ignored on Python 2.
+            preload : list of str, modules imported in the forkserver
+        '''
+        super(ProcessExecutor, self).__init__(threads, chunksize)
+        self.start_method = start_method
+        self.preload = preload
+        self._pool = None
+        self._pool_finalizer = None
+        self._shared = None
+        self._arrays = {}
+        self._busy = False
+
+    def _get_pool(self):
+        ''' Start pool of workers if needed '''
+        if self._pool is None:
+            if (self.start_method is None or
+                    not hasattr(multiprocessing, 'get_context')):
+                # default or Python 2
+                context = multiprocessing
+            else:
+                context = multiprocessing.get_context(self.start_method)
+                if self.start_method == 'forkserver':
+                    context.set_forkserver_preload(self.preload)
+            self._pool = context.Pool(self.threads)
+            self._pool_finalizer = finalize(self, self._pool.terminate)
+        return self._pool
+
+    def __del__(self):
+        # needed only on Python 2 (see shared.finalize)
+        if getattr(self, '_pool_finalizer', None) is not None:
+            self._pool_finalizer()
+
+    def share(self, arrays):
+        ''' Share input arrays with workers (if they are not shared already)
+        Parameters
+        ----------
+            arrays : dict with arrays
+        Returns
+        -------
+            files : dict, names of files with shared arrays
+        '''
+        if self._shared is None:
+            self._shared = SharedArrays()
+        for name in arrays:
+            token = _get_token(arrays[name])
+            if (name not in self._arrays or
+                    self._arrays[name][0] is not arrays[name] or
+                    self._arrays[name][1] != token):
+                self._shared.put(name, arrays[name])
+                self._arrays[name] = (arrays[name], token)
+        return dict([(name, self._shared.files[name]) for name in arrays])
+
+    def imap_chunks(self, func, data, outputs, params, size):
+        if self._busy:
+            # queued tasks of the running call use the shared arrays
+            raise RuntimeError('ProcessExecutor is used by another unfinished '
+                               'call of imap_chunks')
+        self._busy = True
+        try:
+            inputs = [name for name in data if name not in outputs]
+            files = self.share(dict([(name, data[name]) for name in inputs
+                                     if isinstance(data[name], np.ndarray)]))
+            # other objects (e.g. BlockReader) are pickled with each task
+            objects = dict([(name, data[name]) for name in inputs
+                            if not isinstance(data[name], np.ndarray)])
+            with SharedArrays() as shared:
+                shared_outputs = dict([(name, shared.create(name,
+                                                            data[name].shape,
+                                                            data[name].dtype))
+                                       for name in outputs])
+                files.update(shared.files)
+                tasks = [(func, files, objects, outputs, params, start, stop)
+                         for start, stop in self.get_chunks(size)]
+                for start, stop in self._get_pool().imap_unordered(_run_chunk,
+                                                                   tasks):
+                    # copy results of the finished chunk
+                    for name in outputs:
+                        data[name][start:stop] = shared_outputs[name][
+                                                                start:stop]
+                    yield start, stop
+        finally:
+            self._busy = False
+
+    def close(self):
+        ''' Stop workers and remove shared arrays '''
+        if self._pool is not None:
+            self._pool_finalizer.detach()
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+            self._arrays = {}
+
+def get_executor(backend='processes', threads=5, chunksize=None, **kwargs):
+    ''' Get executor for running functions on chunks of points
+    Parameters
+    ----------
+        backend : str or executor
+            'serial' : SerialExecutor (one by one in the current process)
+            'threads' : ThreadExecutor (pool of threads)
+            'processes' : ProcessExecutor (pool of processes)
+            executor object (e.g. ProcessExecutor) is returned as is
+        threads : int, number of threads or processes
+        chunksize : int, number of points in one task
+        **kwargs : other parameters for ProcessExecutor (e.g. start_method)
+    Returns
+    -------
+        executor : SerialExecutor, ThreadExecutor or ProcessExecutor
+    '''
+    if hasattr(backend, 'map_chunks'):
+        return backend
+    if backend == 'serial':
+        return SerialExecutor(1, chunksize)
+    if backend == 'threads':
+        return ThreadExecutor(threads, chunksize)
+    if backend == 'processes':
+        return ProcessExecutor(threads, chunksize,
+                               kwargs.get('start_method'),
+                               kwargs.get('preload', PRELOAD_MODULES))
+    raise ValueError('Unknown backend: %s' % backend)
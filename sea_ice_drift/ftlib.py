@@ -15,18 +15,206 @@
 from __future__ import absolute_import, print_function
 
 import time
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 
 import cv2
 
+from sea_ice_drift.cache import get_cache
 from sea_ice_drift.lib import (get_speed_ms,
-                               x2y2_interpolation_poly)
+                               get_displacement_km,
+                               PolyDriftModel)
+
+FLANN_INDEX_LSH = 6
+KEYPOINT_DTYPE = np.dtype([('x', np.float32),
+                           ('y', np.float32),
+                           ('size', np.float32),
+                           ('angle', np.float32),
+                           ('response', np.float32),
+                           ('octave', np.int32)])
+
+class KeyPoints(object):
+    ''' Compact set of keypoints stored as arrays (struct-of-arrays)
+
+    Replaces list of cv2.KeyPoint objects. Coordinates and attributes of all
+    keypoints are kept in 1D vectors and descriptors in one 2D matrix, so that
+    filtering and extraction of coordinates are vectorized.
+    '''
+    def __init__(self, x, y, size=None, angle=None, response=None,
+                 octave=None, descriptors=None):
+        ''' Initialize from arrays
+        Parameters
+        ----------
+            x : 1D vector - X coordinates of keypoints
+            y : 1D vector - Y coordinates of keypoints
+            size : 1D vector - diameter of keypoint neighborhood
+            angle : 1D vector - orientation of keypoints, degrees
+            response : 1D vector - detector response
+            octave : 1D vector - pyramid level where keypoint was detected
+            descriptors : 2D UInt8 array - binary descriptors of keypoints
+        '''
+        self.x = np.asarray(x, dtype=np.float32).ravel()
+        self.y = np.asarray(y, dtype=np.float32).ravel()
+        n = len(self.x)
+        self.size = self._as_vector(size, n, np.float32)
+        self.angle = self._as_vector(angle, n, np.float32)
+        self.response = self._as_vector(response, n, np.float32)
+        self.octave = self._as_vector(octave, n, np.int32)
+        if descriptors is not None:
+            descriptors = np.asarray(descriptors)
+        self.descriptors = descriptors
+
+    @staticmethod
+    def _as_vector(values, n, dtype):
+        ''' Convert <values> to 1D vector of length <n> (zeros if None) '''
+        if values is None:
+            return np.zeros(n, dtype)
+        return np.asarray(values, dtype=dtype).ravel()
+
+    @classmethod
+    def from_cv2(cls, keyPoints, descriptors=None):
+        ''' Create KeyPoints from list of cv2.KeyPoint and descriptors '''
+        if len(keyPoints) == 0:
+            return cls([], [], descriptors=descriptors)
+        attrs = np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle,
+                           kp.response, kp.octave) for kp in keyPoints])
+        return cls(attrs[:, 0], attrs[:, 1], attrs[:, 2], attrs[:, 3],
+                   attrs[:, 4], attrs[:, 5], descriptors)
+
+    @classmethod
+    def concatenate(cls, keyPointsList):
+        ''' Join several KeyPoints (e.g. from different tiles) into one '''
+        keyPointsList = list(keyPointsList)
+        if len(keyPointsList) == 0:
+            return cls([], [])
+        descriptors = [kp.descriptors for kp in keyPointsList
+                       if kp.descriptors is not None and len(kp) > 0]
+        if len(descriptors) > 0:
+            descriptors = np.vstack(descriptors)
+        else:
+            descriptors = keyPointsList[0].descriptors
+        return cls(*[np.hstack([getattr(kp, attr) for kp in keyPointsList])
+                     for attr in ('x', 'y', 'size', 'angle',
+                                  'response', 'octave')],
+                   descriptors=descriptors)
+
+    @classmethod
+    def from_record(cls, record, descriptors=None):
+        ''' Create KeyPoints from structured array (e.g. memory-mapped) '''
+        return cls(*[record[attr] for attr in KEYPOINT_DTYPE.names],
+                   descriptors=descriptors)
+
+    def to_record(self):
+        ''' Return keypoints as compact structured array '''
+        record = np.empty(len(self), KEYPOINT_DTYPE)
+        for attr in KEYPOINT_DTYPE.names:
+            record[attr] = getattr(self, attr)
+        return record
+
+    def to_cv2(self):
+        ''' Return list of cv2.KeyPoint (e.g. for cv2.drawKeypoints) '''
+        return [cv2.KeyPoint(float(x), float(y), float(s), float(a),
+                             float(r), int(o))
+                for x, y, s, a, r, o in zip(self.x, self.y, self.size,
+                                            self.angle, self.response,
+                                            self.octave)]
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, gpi):
+        ''' Return subset of keypoints (and descriptors) selected by
+        boolean mask or integer indices <gpi> '''
+        descriptors = self.descriptors
+        if descriptors is not None:
+            descriptors = descriptors[gpi]
+        return KeyPoints(self.x[gpi], self.y[gpi], self.size[gpi],
+                         self.angle[gpi], self.response[gpi],
+                         self.octave[gpi], descriptors)
+
+
+class Matches(object):
+    ''' Result of k-nearest (k=2) matching stored as arrays
+
+    query_idx, train_idx and distance describe the best match of each query
+    descriptor, distance2 is distance to the second best match (inf if the
+    matcher did not return the second match, e.g. if only one candidate was
+    available within the search radius).
+    '''
+    def __init__(self, query_idx, train_idx, distance, distance2):
+        self.query_idx = np.asarray(query_idx, dtype=np.int32).ravel()
+        self.train_idx = np.asarray(train_idx, dtype=np.int32).ravel()
+        self.distance = np.asarray(distance, dtype=np.float32).ravel()
+        self.distance2 = np.asarray(distance2, dtype=np.float32).ravel()
+
+    @classmethod
+    def from_cv2(cls, knnMatches):
+        ''' Create Matches from output of cv2 matcher.knnMatch(k=2) '''
+        knnMatches = [m for m in knnMatches if len(m) > 0]
+        if len(knnMatches) == 0:
+            return cls([], [], [], [])
+        attrs = np.array([(m[0].queryIdx, m[0].trainIdx, m[0].distance,
+                           m[1].distance if len(m) > 1 else np.inf)
+                          for m in knnMatches])
+        return cls(attrs[:, 0], attrs[:, 1], attrs[:, 2], attrs[:, 3])
+
+    def ratio_test(self, ratio, keep_single=False):
+        ''' Return matches which pass ratio test from Lowe
+        Parameters
+        ----------
+            ratio : float - Lowe ratio
+            keep_single : bool - keep matches without the second match
+                (distance2 is inf)? They cannot be tested and are rejected
+                by default.
+        Returns
+        -------
+            matches : Matches
+        '''
+        gpi = self.distance < ratio * self.distance2
+        if not keep_single:
+            gpi *= np.isfinite(self.distance2)
+        return self[gpi]
+
+    def __len__(self):
+        return len(self.query_idx)
+
+    def __getitem__(self, gpi):
+        return Matches(self.query_idx[gpi], self.train_idx[gpi],
+                       self.distance[gpi], self.distance2[gpi])
+
+
+def _as_keypoints(keyPoints, descriptors):
+    ''' Convert list of cv2.KeyPoint to KeyPoints (if needed) '''
+    if isinstance(keyPoints, KeyPoints):
+        return keyPoints
+    return KeyPoints.from_cv2(keyPoints, descriptors)
+
+def _get_detector(edgeThreshold, nFeatures, nLevels, patchSize):
+    ''' Initiate ORB detector '''
+    if hasattr(cv2, 'ORB_create'):
+        detector = cv2.ORB_create()
+        detector.setEdgeThreshold(edgeThreshold)
+        detector.setMaxFeatures(nFeatures)
+        detector.setNLevels(nLevels)
+        detector.setPatchSize(patchSize)
+    else:
+        detector = cv2.ORB()
+        detector.setInt('edgeThreshold', edgeThreshold)
+        detector.setInt('nFeatures', nFeatures)
+        detector.setInt('nLevels', nLevels)
+        detector.setInt('patchSize', patchSize)
+    return detector
 
 def find_key_points(image,
                     edgeThreshold=34,
                     nFeatures=100000,
                     nLevels=7,
                     patchSize=34,
+                    tile_size=None,
+                    tile_overlap=None,
+                    tile_threads=4,
+                    keypoint_cache=None,
                     **kwargs):
     ''' Initiate detector and find key points on an image
     Parameters
@@ -36,28 +224,115 @@ def find_key_points(image,
         nFeatures : int - parameter for OpenCV detector
         nLevels : int - parameter for OpenCV detector
         patchSize : int - parameter for OpenCV detector
+        tile_size : int - if given, detect keypoints in tiles of that size
+        tile_overlap : int - overlap between tiles (default is edgeThreshold
+            on the coarsest level of ORB pyramid)
+        tile_threads : int - number of parallel threads for tiles
+        keypoint_cache : ArrayCache or str - cache (or root directory of
+            cache) for keypoints. If None, the ICE_DRIFT_CACHE_DIR environment
+            variable is used (if set). Key of the cache is computed from
+            content of the image and from the detector parameters.
     Returns
     -------
-        keyPoints : list - coordinates of keypoint on image
-        descriptors : list - binary descriptos of kepoints
+        keyPoints : KeyPoints - coordinates of keypoint on image
+        descriptors : 2D array - binary descriptos of kepoints
     '''
-    if cv2.__version__.startswith('3.'):
-        detector = cv2.ORB_create()
-        detector.setEdgeThreshold(edgeThreshold)
-        detector.setMaxFeatures(nFeatures)
-        detector.setNLevels(nLevels)
-        detector.setPatchSize(patchSize)
+    cache = get_cache(keypoint_cache, 'keypoints')
+    if cache is not None:
+        key = cache.get_key(image, edgeThreshold=edgeThreshold,
+                            nFeatures=nFeatures, nLevels=nLevels,
+                            patchSize=patchSize, tile_size=tile_size,
+                            tile_overlap=tile_overlap)
+        arrays, metadata = cache.get(key)
+        if arrays is not None:
+            keyPoints = KeyPoints.from_record(arrays['keypoints'],
+                                              arrays['descriptors'])
+            print('Key points read from cache: %d' % len(keyPoints))
+            return keyPoints, keyPoints.descriptors
+
+    if tile_size is not None:
+        keyPoints = _find_key_points_tiled(image, edgeThreshold, nFeatures,
+                                           nLevels, patchSize, tile_size,
+                                           tile_overlap, tile_threads)
+        print('Key points found in tiles: %d' % len(keyPoints))
     else:
-        detector = cv2.ORB()
-        detector.setInt('edgeThreshold', edgeThreshold)
-        detector.setInt('nFeatures', nFeatures)
-        detector.setInt('nLevels', nLevels)
-        detector.setInt('patchSize', patchSize)
-    print('ORB detector initiated')
+        detector = _get_detector(edgeThreshold, nFeatures, nLevels, patchSize)
+        print('ORB detector initiated')
+        keyPoints, descriptors = detector.detectAndCompute(image, None)
+        keyPoints = KeyPoints.from_cv2(keyPoints, descriptors)
+        print('Key points found: %d' % len(keyPoints))
+
+    if cache is not None:
+        descriptors = keyPoints.descriptors
+        if descriptors is None:
+            descriptors = np.zeros((0, 32), np.uint8)
+        cache.put(key, dict(keypoints=keyPoints.to_record(),
+                            descriptors=descriptors))
+    return keyPoints, keyPoints.descriptors
+
+def _get_tiles(shape, tile_size, tile_overlap):
+    ''' Return list of tiles (row0, row1, col0, col1) of the core and the
+    extended (with overlap) window: [core, extended] '''
+    tiles = []
+    for r0 in range(0, shape[0], tile_size):
+        for c0 in range(0, shape[1], tile_size):
+            r1 = min(r0 + tile_size, shape[0])
+            c1 = min(c0 + tile_size, shape[1])
+            tiles.append([(r0, r1, c0, c1),
+                          (max(r0 - tile_overlap, 0),
+                           min(r1 + tile_overlap, shape[0]),
+                           max(c0 - tile_overlap, 0),
+                           min(c1 + tile_overlap, shape[1]))])
+    return tiles
 
-    keyPoints, descriptors = detector.detectAndCompute(image, None)
-    print('Key points found: %d' % len(keyPoints))
-    return keyPoints, descriptors
+def _find_key_points_tile(image, tile, edgeThreshold, nFeatures,
+                          nLevels, patchSize):
+    ''' Find keypoints in one tile and keep only keypoints from the core
+    part of the tile (not more than <nFeatures> with highest response) '''
+    (r0, r1, c0, c1), (er0, er1, ec0, ec1) = tile
+    extended_area = float((er1 - er0) * (ec1 - ec0))
+    core_area = (r1 - r0) * (c1 - c0)
+    detector = _get_detector(edgeThreshold,
+                             int(np.ceil(nFeatures * extended_area / core_area)),
+                             nLevels, patchSize)
+    keyPoints, descriptors = detector.detectAndCompute(image[er0:er1, ec0:ec1],
+                                                       None)
+    keyPoints = KeyPoints.from_cv2(keyPoints, descriptors)
+    keyPoints.x += ec0
+    keyPoints.y += er0
+    # each keypoint belongs to the core of only one tile (no duplicates)
+    gpi = ((keyPoints.x >= c0) * (keyPoints.x < c1) *
+           (keyPoints.y >= r0) * (keyPoints.y < r1))
+    keyPoints = keyPoints[gpi]
+    if len(keyPoints) > nFeatures:
+        keyPoints = keyPoints[np.argsort(-keyPoints.response)[:nFeatures]]
+    return keyPoints
+
+def _find_key_points_tiled(image, edgeThreshold, nFeatures, nLevels,
+                           patchSize, tile_size, tile_overlap, tile_threads):
+    ''' Find keypoints in overlapping tiles in parallel threads
+    Number of keypoints per tile is proportional to the tile area '''
+    if tile_overlap is None:
+        tile_overlap = int(np.ceil(max(edgeThreshold, patchSize) *
+                                   1.2 ** (nLevels - 1)))
+    tiles = _get_tiles(image.shape, tile_size, tile_overlap)
+    image_area = float(image.shape[0] * image.shape[1])
+    tile_features = [int(np.ceil(nFeatures * (t[0][1] - t[0][0]) *
+                                 (t[0][3] - t[0][2]) / image_area))
+                     for t in tiles]
+
+    def detect(i):
+        return _find_key_points_tile(image, tiles[i], edgeThreshold,
+                                     tile_features[i], nLevels, patchSize)
+
+    pool = ThreadPool(tile_threads)
+    try:
+        keyPoints = pool.map(detect, range(len(tiles)))
+    finally:
+        pool.close()
+        pool.join()
+
+    return KeyPoints.concatenate(keyPoints)
 
 
 def get_match_coords(keyPoints1, descriptors1,
@@ -66,52 +341,202 @@ def get_match_coords(keyPoints1, descriptors1,
                                     norm=cv2.NORM_HAMMING,
                                     ratio_test=0.7,
                                     verbose=True,
+                                    search_radius=None,
+                                    x2n1=None, y2n1=None,
+                                    keep_single=False,
+                                    spatial_knn=16,
                                     **kwargs):
     ''' Filter matching keypoints and convert to X,Y coordinates
     Parameters
     ----------
-        keyPoints1 : list - keypoints on img1 from find_key_points()
-        descriptors1 : list - descriptors on img1 from find_key_points()
-        keyPoints2 : list - keypoints on img2 from find_key_points()
-        descriptors2 : list - descriptors on img2 from find_key_points()
-        matcher : matcher from CV2
+        keyPoints1 : KeyPoints - keypoints on img1 from find_key_points()
+        descriptors1 : 2D array - descriptors on img1 from find_key_points()
+        keyPoints2 : KeyPoints - keypoints on img2 from find_key_points()
+        descriptors2 : 2D array - descriptors on img2 from find_key_points()
+        matcher : str or matcher from CV2 - see get_matcher()
         norm : int - type of distance
         ratio_test : float - Lowe ratio
         verbose : bool - print some output ?
+        search_radius : float - if given, match only keypoints closer than
+            <search_radius> pixels of image 1 (spatially constrained matching)
+        x2n1 : 1D vector - X coordinates of keyPoints2 on image 1
+        y2n1 : 1D vector - Y coordinates of keyPoints2 on image 1
+        keep_single : bool - keep matches which have only one candidate
+            (e.g. within <search_radius>) and cannot pass the ratio test?
+        spatial_knn : int - number of nearest neighbours requested from
+            matchers without mask support (e.g. 'lsh') before filtering by
+            <search_radius>. LSH is approximate: in-radius candidates which
+            are not among these neighbours are missed, so it may find fewer
+            (and sometimes different) matches than 'bf'.
     Returns
     -------
         x1, y1, x2, y2 : coordinates of start and end of displacement [pixels]
     '''
-    matches = _get_matches(descriptors1,
-                           descriptors2, matcher, norm, verbose)
+    keyPoints1 = _as_keypoints(keyPoints1, descriptors1)
+    keyPoints2 = _as_keypoints(keyPoints2, descriptors2)
+    bf = get_matcher(matcher, norm, **kwargs)
+    if search_radius is None:
+        matches = _get_matches(descriptors1, descriptors2, bf, verbose)
+    else:
+        if x2n1 is None or y2n1 is None:
+            x2n1, y2n1 = keyPoints2.x, keyPoints2.y
+        matches = _get_matches_spatial(keyPoints1.x, keyPoints1.y,
+                                       descriptors1, x2n1, y2n1,
+                                       descriptors2, search_radius,
+                                       bf, verbose, knn=spatial_knn)
     x1, y1, x2, y2 = _filter_matches(matches, ratio_test,
-                                     keyPoints1, keyPoints2, verbose)
+                                     keyPoints1, keyPoints2, verbose,
+                                     keep_single)
     return x1, y1, x2, y2
 
-def _get_matches(descriptors1, descriptors2, matcher, norm, verbose):
-    ''' Match keypoints using BFMatcher with cv2.NORM_HAMMING '''
+def get_matcher(matcher='bf', norm=cv2.NORM_HAMMING,
+                lsh_tables=6, lsh_key_size=12, lsh_probes=1, lsh_checks=50,
+                **kwargs):
+    ''' Create descriptor matcher by name
+    Parameters
+    ----------
+        matcher : str or class of CV2 matcher:
+            'bf' - exact brute force matcher (cv2.BFMatcher)
+            'lsh' - approximate matcher (FLANN with LSH index)
+            callable - is called as matcher(norm)
+        norm : int - type of distance (for the brute force matcher)
+        lsh_tables : int - number of hash tables in LSH index
+        lsh_key_size : int - length of hash key, bits
+        lsh_probes : int - number of neighbouring buckets to probe
+        lsh_checks : int - maximum number of candidates to check
+    Returns
+    -------
+        matcher : CV2 matcher object with knnMatch() method
+    '''
+    if matcher == 'bf':
+        return cv2.BFMatcher(norm)
+    elif matcher == 'lsh':
+        index_params = dict(algorithm=FLANN_INDEX_LSH,
+                            table_number=lsh_tables,
+                            key_size=lsh_key_size,
+                            multi_probe_level=lsh_probes)
+        return cv2.FlannBasedMatcher(index_params, dict(checks=lsh_checks))
+    elif callable(matcher):
+        return matcher(norm)
+    raise ValueError('Unknown matcher: %s' % str(matcher))
+
+def _get_matches(descriptors1, descriptors2, bf, verbose):
+    ''' Match keypoints using given matcher <bf> (e.g. from get_matcher) '''
     t0 = time.time()
-    bf = matcher(norm)
-    matches = bf.knnMatch(descriptors1, descriptors2, k=2)
+    matches = Matches.from_cv2(bf.knnMatch(descriptors1, descriptors2, k=2))
     t1 = time.time()
     if verbose:
         print('Keypoints matched', t1 - t0)
     return matches
 
-def _filter_matches(matches, ratio_test, keyPoints1, keyPoints2, verbose):
+def _get_matches_spatial(x1, y1, descriptors1, x2, y2, descriptors2,
+                         search_radius, bf, verbose, max_cells=64, knn=16):
+    ''' Match keypoints only with candidates within <search_radius>
+
+    Keypoints of image 2 (with coordinates <x2>, <y2> in pixels of image 1)
+    are binned into a regular grid with cell size not smaller than
+    <search_radius>. Queries from each cell of image 1 are matched only with
+    candidates from the 3x3 neighbouring cells, and the mask excludes
+    candidates further than <search_radius>. Matchers without mask support
+    (e.g. FLANN) return <knn> nearest neighbours which are filtered by
+    distance, and the best two in-radius neighbours are used for the ratio
+    test (approximate: candidates outside the <knn> neighbours are missed).
+    '''
+    t0 = time.time()
+    x1, y1, x2, y2 = [np.asarray(v, dtype=np.float64)
+                      for v in (x1, y1, x2, y2)]
+    # keypoints of image 2 which fall outside image 1 are not used
+    valid2 = np.nonzero(np.isfinite(x2) * np.isfinite(y2))[0]
+    if len(x1) == 0 or len(valid2) == 0:
+        return Matches([], [], [], [])
+    xmin = min(x1.min(), x2[valid2].min())
+    ymin = min(y1.min(), y2[valid2].min())
+    span = max(x1.max(), x2[valid2].max(),
+               y1.max(), y2[valid2].max()) - min(xmin, ymin)
+    cell = max(search_radius, span / float(max_cells), 1)
+
+    col1 = np.floor((x1 - xmin) / cell).astype(np.int64)
+    row1 = np.floor((y1 - ymin) / cell).astype(np.int64)
+    col2 = np.floor((x2[valid2] - xmin) / cell).astype(np.int64)
+    row2 = np.floor((y2[valid2] - ymin) / cell).astype(np.int64)
+    ncols = max(col1.max(), col2.max()) + 2
+    cell1 = row1 * ncols + col1
+    cell2 = row2 * ncols + col2
+
+    # sort candidates by cell for fast lookup of neighbouring cells
+    sort2 = np.argsort(cell2, kind='mergesort')
+    cell2sorted = cell2[sort2]
+    sort2 = valid2[sort2]
+    neighbours = np.array([dr * ncols + dc
+                           for dr in (-1, 0, 1) for dc in (-1, 0, 1)])
+
+    use_mask = not isinstance(bf, cv2.FlannBasedMatcher)
+    matches = []
+    for cellid in np.unique(cell1):
+        qidx = np.nonzero(cell1 == cellid)[0]
+        starts = np.searchsorted(cell2sorted, cellid + neighbours, 'left')
+        stops = np.searchsorted(cell2sorted, cellid + neighbours, 'right')
+        tidx = np.hstack([sort2[i0:i1] for i0, i1 in zip(starts, stops)])
+        if len(tidx) == 0:
+            continue
+        if use_mask:
+            mask = (np.hypot(x1[qidx][:, None] - x2[tidx][None],
+                             y1[qidx][:, None] - y2[tidx][None])
+                    <= search_radius).astype(np.uint8)
+            m = Matches.from_cv2(bf.knnMatch(descriptors1[qidx],
+                                             descriptors2[tidx],
+                                             k=2, mask=mask))
+        else:
+            m = bf.knnMatch(descriptors1[qidx], descriptors2[tidx],
+                            k=min(knn, len(tidx)))
+            m = _knn_within_radius(m, x1[qidx], y1[qidx], x2[tidx], y2[tidx],
+                                   search_radius)
+        m.query_idx = qidx[m.query_idx].astype(np.int32)
+        m.train_idx = tidx[m.train_idx].astype(np.int32)
+        matches.append(m)
+
+    if len(matches) == 0:
+        return Matches([], [], [], [])
+    matches = Matches(*[np.hstack([getattr(m, attr) for m in matches])
+                        for attr in ('query_idx', 'train_idx',
+                                     'distance', 'distance2')])
+    t1 = time.time()
+    if verbose:
+        print('Keypoints matched within %.1f pix' % search_radius, t1 - t0)
+    return matches
+
+def _knn_within_radius(knnMatches, x1, y1, x2, y2, search_radius):
+    ''' Create Matches from the best two of k nearest neighbours (output of
+    cv2 matcher.knnMatch sorted by distance) which are within <search_radius>
+    '''
+    attrs = np.array([(n.queryIdx, n.trainIdx, n.distance)
+                      for ms in knnMatches for n in ms]).reshape(-1, 3)
+    qi, ti = attrs[:, 0].astype(np.int64), attrs[:, 1].astype(np.int64)
+    gpi = np.hypot(x1[qi] - x2[ti], y1[qi] - y2[ti]) <= search_radius
+    qi, ti, dist = qi[gpi], ti[gpi], attrs[gpi, 2]
+    if len(qi) == 0:
+        return Matches([], [], [], [])
+    # rank of neighbour within each query
+    pos = np.arange(len(qi))
+    first = np.hstack([[True], qi[1:] != qi[:-1]])
+    rank = pos - np.maximum.accumulate(np.where(first, pos, 0))
+    ifirst = np.nonzero(first)[0]
+    isecond = np.minimum(ifirst + 1, len(qi) - 1)
+    dist2 = np.where(rank[isecond] == 1, dist[isecond], np.inf)
+    return Matches(qi[ifirst], ti[ifirst], dist[ifirst], dist2)
+
+def _filter_matches(matches, ratio_test, keyPoints1, keyPoints2, verbose,
+                    keep_single=False):
     ''' Apply ratio test from Lowe '''
-    good = []
-    for m,n in matches:
-        if m.distance < ratio_test*n.distance:
-            good.append(m)
+    good = matches.ratio_test(ratio_test, keep_single)
     if verbose:
         print('Ratio test %f found %d keypoints' % (ratio_test, len(good)))
 
     # Coordinates for start, end point of vectors
-    x1 = np.array([keyPoints1[m.queryIdx].pt[0] for m in good])
-    y1 = np.array([keyPoints1[m.queryIdx].pt[1] for m in good])
-    x2 = np.array([keyPoints2[m.trainIdx].pt[0] for m in good])
-    y2 = np.array([keyPoints2[m.trainIdx].pt[1] for m in good])
+    x1 = keyPoints1.x[good.query_idx].astype(np.float64)
+    y1 = keyPoints1.y[good.query_idx].astype(np.float64)
+    x2 = keyPoints2.x[good.train_idx].astype(np.float64)
+    y2 = keyPoints2.y[good.train_idx].astype(np.float64)
     return x1, y1, x2, y2
 
 def domain_filter(n, keyPoints, descr, domain, domainMargin=0, **kwargs):
@@ -119,17 +544,18 @@ def domain_filter(n, keyPoints, descr, domain, domainMargin=0, **kwargs):
     Parameters
     ----------
         n : source Nansat object
-        keyPoints : list - keypoints on image from <n>
-        descr : list - descriptors of <keyPoints>
+        keyPoints : KeyPoints - keypoints on image from <n>
+        descr : 2D array - descriptors of <keyPoints>
         domain : destination Domain
         domainMargin : int - margin to crop points
     Returns
     -------
-        keyPointsFilt : list of filtered keypoints
-        descrFilt : list - descriptors of <keyPointsFilt>
+        keyPointsFilt : KeyPoints - filtered keypoints
+        descrFilt : 2D array - descriptors of <keyPointsFilt>
     '''
-    cols = [kp.pt[0] for kp in keyPoints]
-    rows = [kp.pt[1] for kp in keyPoints]
+    keyPoints = _as_keypoints(keyPoints, descr)
+    cols = keyPoints.x.astype(np.float64)
+    rows = keyPoints.y.astype(np.float64)
     lon, lat = n.transform_points(cols, rows, 0)
     colsD, rowsD = domain.transform_points(lon, lat, 1)
     gpi = ((colsD >= 0 + domainMargin) *
@@ -138,7 +564,7 @@ def domain_filter(n, keyPoints, descr, domain, domainMargin=0, **kwargs):
            (rowsD <= domain.shape()[0] - domainMargin))
 
     print('Domain filter: %d -> %d' % (len(keyPoints), len(gpi[gpi])))
-    return list(np.array(keyPoints)[gpi]), descr[gpi]
+    return keyPoints[gpi], descr[gpi]
 
 def max_drift_filter(n1, x1, y1, n2, x2, y2, maxDrift=0.5, **kwargs):
     ''' Filter out too high drift (m/s)
@@ -162,7 +588,29 @@ def max_drift_filter(n1, x1, y1, n2, x2, y2, maxDrift=0.5, **kwargs):
     print('MaxDrift filter: %d -> %d' % (len(x1), len(gpi[gpi])))
     return x1[gpi], y1[gpi], x2[gpi], y2[gpi]
 
-def lstsq_filter(x1, y1, x2, y2, psi=200, order=2, **kwargs):
+def get_max_drift_pix(n1, n2, maxDrift=0.5, **kwargs):
+    ''' Find maximum displacement in pixels of image 1 for the given maximum
+    drift speed and time between acquisition of two images
+    Parameters
+    ----------
+        n1 : First Nansat object
+        n2 : Second Nansat object
+        maxDrift : float - maximum allowed ice drift speed, m/s
+    Returns
+    -------
+        radius : float - maximum displacement, pix
+    '''
+    dt = (n2.time_coverage_start - n1.time_coverage_start).total_seconds()
+    rows, cols = n1.shape()[:2]
+    # pixel size at centre and at quarters of the image (smallest is used)
+    x = np.array([0.5, 0.25, 0.75, 0.25, 0.75]) * cols
+    y = np.array([0.5, 0.25, 0.25, 0.75, 0.75]) * rows
+    step = max(min(rows, cols) / 20., 1)
+    pix_km = get_displacement_km(n1, x, y, n1, x + step, y + step) / np.hypot(step, step)
+    return maxDrift * abs(dt) / 1000. / np.nanmin(pix_km) + 1
+
+def lstsq_filter(x1, y1, x2, y2, psi=200, order=2, return_model=False,
+                 **kwargs):
     ''' Remove vectors that don't fit the model x1 = f(x2, y2)^n
 
     Fit the model x1 = f(x2, y2)^n using least squares method
@@ -172,17 +620,24 @@ def lstsq_filter(x1, y1, x2, y2, psi=200, order=2, **kwargs):
     ----------
         x1, y1, x2, y2 : coordinates of start and end of displacement [pixels]
         psi : threshold error between actual and simulated x1 [pixels]
+        order : int - order of polynomial
+        return_model : bool - also return PolyDriftModel fitted to the
+            filtered vectors (e.g. for prepare_first_guess) ?
     Returns
     -------
         x1 : 1D vector - filtered source X coordinates on img1, pix
         y1 : 1D vector - filtered source Y coordinates on img1, pix
         x2 : 1D vector - filtered destination X coordinates on img2, pix
         y2 : 1D vector - filtered destination Y coordinates on img2, pix
+        model : PolyDriftModel - only if return_model is True
     '''
     if len(x1) == 0:
+        if return_model:
+            return [np.array([])]*4 + [None]
         return map(np.array, [[],[],[],[]])
     # interpolate using N-order polynomial
-    x2sim, y2sim = x2y2_interpolation_poly(x1, y1, x2, y2, x1, y1, order=order)
+    model = PolyDriftModel(x1, y1, x2, y2, order)
+    x2sim, y2sim = model(x1, y1)
 
     # find error between actual and simulated x1
     err = np.hypot(x2 - x2sim, y2 - y2sim)
@@ -191,17 +646,29 @@ def lstsq_filter(x1, y1, x2, y2, psi=200, order=2, **kwargs):
     gpi = err < psi
 
     print('LSTSQ filter: %d -> %d' % (len(x1), len(gpi[gpi])))
-    return x1[gpi], y1[gpi], x2[gpi], y2[gpi]
+    x1, y1, x2, y2 = x1[gpi], y1[gpi], x2[gpi], y2[gpi]
+    if return_model:
+        if len(x1) > 0:
+            model = PolyDriftModel(x1, y1, x2, y2, order)
+        return x1, y1, x2, y2, model
+    return x1, y1, x2, y2
 
 
-def feature_tracking(n1, n2, **kwargs):
+def feature_tracking(n1, n2, spatial_matching=False, img1=None, img2=None,
+                     **kwargs):
     ''' Run Feature Tracking Algrotihm on two images
     Parameters
     ----------
         n1 : First Nansat object with 2D UInt8 matrix
         n2 : Second Nansat object with 2D UInt8 matrix
+        spatial_matching : bool - match only keypoints within distance
+            allowed by maxDrift and time between images ?
+        img1 : 2D UInt8 matrix - image from n1 (read from n1 if None)
+        img2 : 2D UInt8 matrix - image from n2 (read from n2 if None)
         domainMargin : int - how much to crop from size of domain
         maxDrift : float - maximum allow ice displacement, km
+        keypoint_cache : ArrayCache or str - cache for keypoints, reused
+            when the same image is processed in several pairs
         **kwargs : parameters for functions:
             find_key_points
             get_match_coords
@@ -214,8 +681,12 @@ def feature_tracking(n1, n2, **kwargs):
         y2 : 1D vector - destination Y coordinates on img2, pix
     '''
     # find many key points
-    kp1, descr1 = find_key_points(n1[1], **kwargs)
-    kp2, descr2 = find_key_points(n2[1], **kwargs)
+    if img1 is None:
+        img1 = n1[1]
+    if img2 is None:
+        img2 = n2[1]
+    kp1, descr1 = find_key_points(img1, **kwargs)
+    kp2, descr2 = find_key_points(img2, **kwargs)
 
     # filter keypoints by Domain
     kp1, descr1 = domain_filter(n1, kp1, descr1, n2, **kwargs)
@@ -225,6 +696,14 @@ def feature_tracking(n1, n2, **kwargs):
     if len(kp2) == 0:
         return (np.array([]),)*4
 
+    if spatial_matching:
+        # positions of keypoints from image 2 on image 1 and search radius
+        lon2, lat2 = n2.transform_points(kp2.x.astype(np.float64),
+                                         kp2.y.astype(np.float64), 0)
+        kwargs['x2n1'], kwargs['y2n1'] = n1.transform_points(lon2, lat2, 1)
+        if kwargs.get('search_radius') is None:
+            kwargs['search_radius'] = get_max_drift_pix(n1, n2, **kwargs)
+
     # find coordinates of matching key points
     x1, y1, x2, y2 = get_match_coords(kp1, descr1, kp2, descr2, **kwargs)
 
@@ -0,0 +1,345 @@
+# Name:    geolocation.py
+# Purpose: Container of fast approximation of geolocation
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import, print_function
+
+import numpy as np
+from scipy import ndimage as nd
+from scipy.interpolate import LinearNDInterpolator
+
+import osr
+from nansat import NSR
+
+_projectors = {}
+
+
+def lonlat2ortho(lon, lat, lon0, lat0):
+    ''' Convert lon/lat to orthographic coordinates on unit sphere
+    Parameters
+    ----------
+        lon, lat : 1D vectors - coordinates, degrees
+        lon0, lat0 : float - centre of projection, degrees
+    Returns
+    -------
+        u, v : 1D vectors - eastward and northward coordinates
+    '''
+    lon, lat, lon0, lat0 = map(np.radians, (lon, lat, lon0, lat0))
+    u = np.cos(lat) * np.sin(lon - lon0)
+    v = (np.cos(lat0) * np.sin(lat) -
+         np.sin(lat0) * np.cos(lat) * np.cos(lon - lon0))
+    return u, v
+
+def ortho2lonlat(u, v, lon0, lat0):
+    ''' Convert orthographic coordinates on unit sphere to lon/lat
+    Parameters
+    ----------
+        u, v : 1D vectors - eastward and northward coordinates
+        lon0, lat0 : float - centre of projection, degrees
+    Returns
+    -------
+        lon, lat : 1D vectors - coordinates, degrees
+    '''
+    lon0, lat0 = np.radians(lon0), np.radians(lat0)
+    rho = np.hypot(u, v)
+    c = np.arcsin(np.clip(rho, 0, 1))
+    # avoid division by zero in the centre of projection
+    rho_safe = np.where(rho == 0, 1, rho)
+    lat = np.arcsin(np.cos(c) * np.sin(lat0) +
+                    v * np.sin(c) * np.cos(lat0) / rho_safe)
+    lon = lon0 + np.arctan2(u * np.sin(c),
+                            rho * np.cos(c) * np.cos(lat0) -
+                            v * np.sin(c) * np.sin(lat0))
+    lon = (np.degrees(lon) + 180) % 360 - 180
+    return lon, np.degrees(lat)
+
+
+class FastGeolocation(object):
+    ''' Fast approximation of geolocation of a Nansat object
+
+    Pixel/line <-> lon/lat transformation of the Nansat object (e.g. with
+    TPS) is computed once on a coarse regular grid of pixels. Further calls of
+    transform_points use vectorized bilinear interpolation (forward) and
+    linear interpolation on triangulated grid nodes (inverse) in orthographic
+    coordinates centred on the scene, which is valid also near the pole and
+    the dateline. Points outside the grid are transformed by the Nansat object.
+    All other attributes are taken from the Nansat object, so FastGeolocation
+    can be used instead of Nansat in the functions of sea_ice_drift.
+    '''
+    def __init__(self, n, step=50, max_error=0.5, min_step=5, verbose=True):
+        ''' Build lookup grid
+        Parameters
+        ----------
+            n : Nansat object
+            step : int, initial step of the grid, pixels
+            max_error : float, maximum allowed error, pixels. Step of the grid
+                is halved until the error is below max_error (or step is
+                smaller than min_step)
+            min_step : int, minimum step of the grid, pixels
+            verbose : bool, print error of approximation?
+        '''
+        self.n = n
+        step = max(int(step), 1)
+        while True:
+            self._build_grid(step)
+            self.error = self._get_error()
+            if self.error <= max_error or step // 2 < min_step:
+                break
+            step //= 2
+        self.step = step
+        if verbose:
+            print('Geolocation grid step %d, max error %.3f pix' % (
+                  self.step, self.error))
+
+    def __getattr__(self, name):
+        # avoid recursion when n is not set yet (e.g. while unpickling)
+        if name == 'n':
+            raise AttributeError(name)
+        return getattr(self.n, name)
+
+    def __getitem__(self, key):
+        return self.n[key]
+
+    def _build_grid(self, step):
+        ''' Transform grid of pixels with given <step> to lon/lat '''
+        rows, cols = self.n.shape()[:2]
+        self.xnodes = np.linspace(0, cols, int(np.ceil(cols / float(step))) + 1)
+        self.ynodes = np.linspace(0, rows, int(np.ceil(rows / float(step))) + 1)
+        xgrd, ygrd = np.meshgrid(self.xnodes, self.ynodes)
+        lon, lat = self.n.transform_points(xgrd.flatten(), ygrd.flatten(), 0)
+        lon, lat = np.asarray(lon), np.asarray(lat)
+        icentre = len(lon) // 2
+        self.lon0, self.lat0 = lon[icentre], lat[icentre]
+        u, v = lonlat2ortho(lon, lat, self.lon0, self.lat0)
+        self.ugrd = u.reshape(xgrd.shape)
+        self.vgrd = v.reshape(xgrd.shape)
+        self.inverse = LinearNDInterpolator(np.array([u, v]).T,
+                                            np.array([xgrd.flatten(),
+                                                      ygrd.flatten()]).T)
+
+    def _get_error(self, max_points=10000):
+        ''' Find maximum error (pixels) of forward and inverse transformation
+        in the centres of grid cells (farthest from the nodes) '''
+        xmid = (self.xnodes[1:] + self.xnodes[:-1]) / 2.
+        ymid = (self.ynodes[1:] + self.ynodes[:-1]) / 2.
+        xmid, ymid = [g.flatten() for g in np.meshgrid(xmid, ymid)]
+        if len(xmid) > max_points:
+            idx = np.linspace(0, len(xmid) - 1, max_points).astype(int)
+            xmid, ymid = xmid[idx], ymid[idx]
+        lon, lat = self.n.transform_points(xmid, ymid, 0)
+        u, v = lonlat2ortho(np.asarray(lon), np.asarray(lat),
+                            self.lon0, self.lat0)
+
+        # inverse error in pixels
+        xinv, yinv = self.inverse(u, v).T
+        err_inv = np.nanmax(np.hypot(xinv - xmid, yinv - ymid))
+
+        # forward error converted to pixels using size of pixel
+        ufwd, vfwd = self._forward_ortho(xmid, ymid)
+        pix_size = np.median(np.hypot(np.diff(self.ugrd, axis=1),
+                                      np.diff(self.vgrd, axis=1)) /
+                             np.diff(self.xnodes)[0])
+        err_fwd = np.nanmax(np.hypot(ufwd - u, vfwd - v)) / pix_size
+
+        return max(err_inv, err_fwd)
+
+    def _forward_ortho(self, x, y):
+        ''' Bilinear interpolation of orthographic coordinates from grid '''
+        icol = np.interp(x, self.xnodes, np.arange(len(self.xnodes)))
+        irow = np.interp(y, self.ynodes, np.arange(len(self.ynodes)))
+        u = nd.map_coordinates(self.ugrd, [irow, icol], order=1)
+        v = nd.map_coordinates(self.vgrd, [irow, icol], order=1)
+        return u, v
+
+    def transform_points(self, colVector, rowVector, DstToSrc=0, **kwargs):
+        ''' Transform given lists of X,Y coordinates into lon/lat or inverse
+        Parameters
+        ----------
+            colVector : lists of X coordinates (or longitudes)
+            rowVector : lists of Y coordinates (or latitudes)
+            DstToSrc : 0 - forward transform (pix/line => lon/lat)
+                       1 - inverse transformation (lon/lat => pix/line)
+        Returns
+        -------
+            X, Y : numpy arrays with transformed coordinates
+        '''
+        col = np.asarray(colVector, dtype=np.float64).flatten()
+        row = np.asarray(rowVector, dtype=np.float64).flatten()
+        if DstToSrc == 0:
+            outside = ((col < self.xnodes[0]) + (col > self.xnodes[-1]) +
+                       (row < self.ynodes[0]) + (row > self.ynodes[-1]) +
+                       ~np.isfinite(col) + ~np.isfinite(row))
+            u, v = self._forward_ortho(col, row)
+            out1, out2 = ortho2lonlat(u, v, self.lon0, self.lat0)
+        else:
+            u, v = lonlat2ortho(col, row, self.lon0, self.lat0)
+            out1, out2 = self.inverse(u, v).T
+            outside = ~np.isfinite(out1) + ~np.isfinite(out2)
+        # points outside of the grid are transformed by Nansat
+        if np.any(outside):
+            out1[outside], out2[outside] = self.n.transform_points(
+                                col[outside], row[outside], DstToSrc, **kwargs)
+        return out1, out2
+
+
+class TileGeolocation(object):
+    ''' Geolocation of a window (tile) of a Nansat object
+
+    Pixel/line coordinates are counted from the upper left corner of the
+    window and shape() is the shape of the window. All other attributes are
+    taken from the Nansat object (or FastGeolocation), so TileGeolocation can
+    be used with a subimage instead of Nansat in the functions of
+    sea_ice_drift (e.g. feature_tracking, pattern_matching). If several tiles
+    of the same Nansat object are used in parallel threads, they should share
+    a <lock>, because GDAL transformers of Nansat are not thread-safe.
+    '''
+    def __init__(self, n, row0, col0, rows, cols, lock=None):
+        ''' Set window
+        Parameters
+        ----------
+            n : Nansat or FastGeolocation object
+            row0, col0 : int, upper left corner of the window
+            rows, cols : int, shape of the window
+            lock : threading.Lock, serializes calls of methods of <n> (no
+                lock if None)
+        '''
+        self.n = n
+        self.row0 = row0
+        self.col0 = col0
+        self.rows = rows
+        self.cols = cols
+        self.lock = lock
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        # avoid recursion when n is not set yet (e.g. while unpickling)
+        if name in ('n', 'lock'):
+            raise AttributeError(name)
+        attr = getattr(self.n, name)
+        if self.lock is None or not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            return self._call(attr, *args, **kwargs)
+        return locked
+
+    def _call(self, func, *args, **kwargs):
+        ''' Call method of <n> holding the lock '''
+        if self.lock is None:
+            return func(*args, **kwargs)
+        with self.lock:
+            return func(*args, **kwargs)
+
+    def shape(self):
+        return self.rows, self.cols
+
+    def transform_points(self, colVector, rowVector, DstToSrc=0, **kwargs):
+        ''' Transform given lists of X,Y coordinates of the window into
+        lon/lat or inverse (see FastGeolocation.transform_points) '''
+        col = np.asarray(colVector, dtype=np.float64).flatten()
+        row = np.asarray(rowVector, dtype=np.float64).flatten()
+        if DstToSrc == 0:
+            return self._call(self.n.transform_points, col + self.col0,
+                              row + self.row0, 0, **kwargs)
+        col, row = self._call(self.n.transform_points, col, row, 1, **kwargs)
+        return (np.asarray(col, dtype=np.float64) - self.col0,
+                np.asarray(row, dtype=np.float64) - self.row0)
+
+
+class Projector(object):
+    ''' Vectorized transformation between lon/lat and projected coordinates
+
+    Uses OSR coordinate transformation directly (without GDAL dataset).
+    Use get_projector() to get a cached Projector for the given NSR.
+    '''
+    def __init__(self, nsr=None):
+        ''' Initialize transformations
+        Parameters
+        ----------
+            nsr : Nansat.NSR or anything accepted by NSR (EPSG code, proj4
+                or WKT string), projection of the destination coordinates.
+                If None, lon/lat WGS84 is used.
+        '''
+        if not isinstance(nsr, NSR):
+            nsr = NSR(nsr) if nsr is not None else NSR()
+        self.nsr = nsr
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(nsr.wkt)
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        # keep lon/lat axis order in GDAL >= 3
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self._forward = osr.CoordinateTransformation(wgs84, srs)
+        self._inverse = osr.CoordinateTransformation(srs, wgs84)
+
+    @staticmethod
+    def _transform(ct, x, y):
+        ''' Transform vectors of coordinates with CoordinateTransformation '''
+        x = np.asarray(x, dtype=np.float64)
+        shape = x.shape
+        x = x.flatten()
+        y = np.asarray(y, dtype=np.float64).flatten()
+        if len(x) == 0:
+            return x.reshape(shape), y.reshape(shape)
+        xyz = np.array(ct.TransformPoints(np.array([x, y]).T.tolist()))
+        return xyz[:, 0].reshape(shape), xyz[:, 1].reshape(shape)
+
+    def forward(self, lon, lat):
+        ''' Convert lon/lat to projected coordinates '''
+        return self._transform(self._forward, lon, lat)
+
+    def inverse(self, x, y):
+        ''' Convert projected coordinates to lon/lat '''
+        return self._transform(self._inverse, x, y)
+
+    def get_drift(self, x1, y1, lon2, lat2):
+        ''' Find drift from start points given directly in projected
+        coordinates (e.g. a regular polar stereographic grid) to end points
+        given as lon/lat
+        Parameters
+        ----------
+            x1, y1 : arrays - projected coordinates of start points
+            lon2, lat2 : arrays - coordinates of end points
+        Returns
+        -------
+            u : array - displacement along X axis of the projection
+            v : array - displacement along Y axis of the projection
+        '''
+        x2, y2 = self.forward(lon2, lat2)
+        return x2 - x1, y2 - y1
+
+def get_projector(nsr=None):
+    ''' Get Projector for the given <nsr> (cached)
+    Parameters
+    ----------
+        nsr : Nansat.NSR, EPSG code, proj4 or WKT string, None (lon/lat)
+    Returns
+    -------
+        projector : Projector
+    '''
+    if isinstance(nsr, NSR):
+        key = nsr.wkt
+    else:
+        key = nsr
+    if key not in _projectors:
+        _projectors[key] = Projector(nsr)
+    return _projectors[key]
@@ -14,32 +14,76 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 from __future__ import absolute_import, print_function
 
+import os
+
 import numpy as np
 
-from scipy.interpolate import griddata
+from multiprocessing.pool import ThreadPool
+
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy.spatial import Delaunay, cKDTree
 
+import gdal
 from nansat import Nansat, Domain, NSR
 
+from sea_ice_drift.cache import ArrayCache, get_cache
+from sea_ice_drift.geolocation import get_projector
+
 AVG_EARTH_RADIUS = 6371  # in km
+BLOCK_SIZE = 2**22  # number of pixels processed at once
 
-def get_uint8_image(image, vmin, vmax):
+def get_uint8_image(image, vmin, vmax, dB=False, out=None):
     ''' Scale image from float (or any) input array to uint8
+    Image is processed by blocks of rows in float32 to limit memory usage
     Parameters
     ----------
         image : 2D matrix
         vmin : float - minimum value
         vmax : float - maximum value
+        dB : bool - convert to dB before scaling ?
+        out : 2D UInt8 matrix - output array (created if None)
     Returns
     -------
         2D matrix
     '''
+    if out is None:
+        out = np.empty(image.shape, np.uint8)
+    rows = max(BLOCK_SIZE // max(image.shape[-1], 1), 1)
+    for r0 in range(0, image.shape[0], rows):
+        _scale_block(image[r0:r0+rows], vmin, vmax, dB, out[r0:r0+rows])
+    return out
+
+def _scale_block(block, vmin, vmax, dB, out):
+    ''' Convert <block> to dB (optionally), scale to [0,255] and write into
+    UInt8 <out> in one pass. NaN and -inf are set to 0, +inf to 255. '''
+    block = np.array(block, dtype=np.float32)
+    if dB:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.log10(block, out=block)
+        block *= 10
     # redistribute into range [0,255]
-    uint8Image = 255 * (image - vmin) / (vmax - vmin)
-    uint8Image[uint8Image < 0] = 0
-    uint8Image[uint8Image > 255] = 255
-    uint8Image[~np.isfinite(uint8Image)] = 0
+    block -= vmin
+    block *= 255. / (vmax - vmin)
+    np.clip(block, 0, 255, out=block)
+    block[np.isnan(block)] = 0
+    out[...] = block
 
-    return uint8Image.astype('uint8')
+def _get_uint8_band(n, bandName, vmin, vmax, dB):
+    ''' Read band from Nansat <n> by GDAL blocks and scale to UInt8
+    (see get_uint8_image) without reading the full band into memory '''
+    band = n.get_GDALRasterBand(bandName)
+    cols, rows = band.XSize, band.YSize
+    fillValue = band.GetMetadata().get('_FillValue', None)
+    blockRows = band.GetBlockSize()[1]
+    blockRows = max(BLOCK_SIZE // cols // blockRows, 1) * blockRows
+    out = np.empty((rows, cols), np.uint8)
+    for r0 in range(0, rows, blockRows):
+        nrows = min(blockRows, rows - r0)
+        block = band.ReadAsArray(0, r0, cols, nrows).astype(np.float32)
+        if fillValue is not None:
+            block[block == float(fillValue)] = np.nan
+        _scale_block(block, vmin, vmax, dB, out[r0:r0+nrows])
+    return out
 
 def get_displacement_km(n1, x1, y1, n2, x2, y2):
     ''' Find displacement in kilometers using Haversine
@@ -119,7 +163,116 @@ def get_denoised_object(filename, bandName, factor, **kwargs):
 
     return n
 
-def x2y2_interpolation_poly(x1, y1, x2, y2, x1grd, y1grd, order=1, **kwargs):
+class PolyDriftModel(object):
+    ''' Polynomial model of drift x2, y2 = f(x1, y1)
+
+    Coefficients for X and Y are found with one least squares solution.
+    The fitted model can be evaluated many times (e.g. in lstsq_filter and in
+    prepare_first_guess) by chunks of bounded size.
+    '''
+    def __init__(self, x1, y1, x2, y2, order=1):
+        ''' Fit polynomial model
+        Parameters
+        ----------
+            x1 : 1D vector - X coordinates of keypoints on image 1
+            y1 : 1D vector - Y coordinates of keypoints on image 1
+            x2 : 1D vector - X coordinates of keypoints on image 2
+            y2 : 1D vector - Y coordinates of keypoints on image 2
+            order : [1,2,3] - order of polynom
+        '''
+        self.order = order
+        A = self._get_design_matrix(np.asarray(x1, dtype=np.float64),
+                                    np.asarray(y1, dtype=np.float64))
+        B = np.column_stack([x2, y2]).astype(np.float64)
+        # coefficients for X (column 0) and Y (column 1)
+        self.coefs = np.linalg.lstsq(A, B, rcond=-1)[0]
+
+    def _get_design_matrix(self, x1, y1):
+        ''' Create matrix with polynomial terms of <x1>, <y1> '''
+        A = [np.ones(len(x1)), x1, y1]
+        if self.order > 1:
+            A += [x1**2, y1**2, x1*y1]
+        if self.order > 2:
+            A += [x1**3, y1**3, x1**2*y1, y1**2*x1]
+        return np.vstack(A).T
+
+    def __call__(self, x1grd, y1grd, chunk_size=100000, dtype=np.float64):
+        ''' Evaluate model on given coordinates
+        Parameters
+        ----------
+            x1grd : 1D vector or 2D array - X coordinates on image 1
+            y1grd : 1D vector or 2D array - Y coordinates on image 1
+            chunk_size : int - number of points evaluated at once
+            dtype : data type of the output
+        Returns
+        -------
+            x2grd : X coordinates on image 2 (with shape of x1grd)
+            y2grd : Y coordinates on image 2 (with shape of x1grd)
+        '''
+        shape = np.shape(x1grd)
+        x1grdF = np.ravel(x1grd)
+        y1grdF = np.ravel(y1grd)
+        x2grd = np.empty(x1grdF.size, dtype)
+        y2grd = np.empty(x1grdF.size, dtype)
+        for i in range(0, x1grdF.size, chunk_size):
+            A = self._get_design_matrix(
+                    x1grdF[i:i+chunk_size].astype(np.float64),
+                    y1grdF[i:i+chunk_size].astype(np.float64))
+            xy2 = np.dot(A, self.coefs)
+            x2grd[i:i+chunk_size] = xy2[:, 0]
+            y2grd[i:i+chunk_size] = xy2[:, 1]
+        return x2grd.reshape(shape), y2grd.reshape(shape)
+
+    def _get_design_matrix_derivatives(self, x1, y1):
+        ''' Create matrices with derivatives of polynomial terms by X and Y '''
+        zeros, ones = np.zeros(len(x1)), np.ones(len(x1))
+        Ax = [zeros, ones, zeros]
+        Ay = [zeros, zeros, ones]
+        if self.order > 1:
+            Ax += [2*x1, zeros, y1]
+            Ay += [zeros, 2*y1, x1]
+        if self.order > 2:
+            Ax += [3*x1**2, zeros, 2*x1*y1, y1**2]
+            Ay += [zeros, 3*y1**2, x1**2, 2*x1*y1]
+        return np.vstack(Ax).T, np.vstack(Ay).T
+
+    def jacobian(self, x1grd, y1grd):
+        ''' Evaluate Jacobian of the model on given coordinates
+        Parameters
+        ----------
+            x1grd : 1D vector or 2D array - X coordinates on image 1
+            y1grd : 1D vector or 2D array - Y coordinates on image 1
+        Returns
+        -------
+            dx2dx1, dx2dy1, dy2dx1, dy2dy1 : derivatives of X and Y
+                coordinates on image 2 by X and Y on image 1
+        '''
+        shape = np.shape(x1grd)
+        Ax, Ay = self._get_design_matrix_derivatives(
+                    np.ravel(x1grd).astype(np.float64),
+                    np.ravel(y1grd).astype(np.float64))
+        dxy2dx1 = np.dot(Ax, self.coefs)
+        dxy2dy1 = np.dot(Ay, self.coefs)
+        return (dxy2dx1[:, 0].reshape(shape), dxy2dy1[:, 0].reshape(shape),
+                dxy2dx1[:, 1].reshape(shape), dxy2dy1[:, 1].reshape(shape))
+
+    def get_rotation(self, x1grd, y1grd):
+        ''' Estimate local rotation from the Jacobian of the model
+        Parameters
+        ----------
+            x1grd : 1D vector or 2D array - X coordinates on image 1
+            y1grd : 1D vector or 2D array - Y coordinates on image 1
+        Returns
+        -------
+            angle : rotation angle, degrees. Rotation of a template from
+                image 1 by this angle (see pmlib.get_rotated_template) aligns
+                it with image 2.
+        '''
+        dx2dx1, dx2dy1, dy2dx1, dy2dy1 = self.jacobian(x1grd, y1grd)
+        return np.degrees(np.arctan2(dx2dy1 - dy2dx1, dx2dx1 + dy2dy1))
+
+def x2y2_interpolation_poly(x1, y1, x2, y2, x1grd, y1grd, order=1,
+                            model=None, dtype=np.float64, **kwargs):
     ''' Interpolate values of x2/y2 onto full-res grids of x1/y1 using
     polynomial of order 1 (or 2 or 3)
     Parameters
@@ -131,35 +284,111 @@ def x2y2_interpolation_poly(x1, y1, x2, y2, x1grd, y1grd, order=1, **kwargs):
         x1grd : 1D vector - source X coordinate on img1
         y1grd : 1D vector - source Y coordinate on img2
         order : [1,2,3] - order of polynom
+        model : PolyDriftModel - fitted model (if None, it is fitted to
+            x1, y1, x2, y2)
+        dtype : data type of the output
     Returns
     -------
         x2grd : 1D vector - destination X coordinate on img1
         y2grd : 1D vector - destination Y coordinate on img2
     '''
-    A = [np.ones(len(x1)), x1, y1]
-    if order > 1:
-        A += [x1**2, y1**2, x1*y1]
-    if order > 2:
-        A += [x1**3, y1**3, x1**2*y1, y1**2*x1]
-
-    A = np.vstack(A).T
-    Bx = np.linalg.lstsq(A, x2)[0]
-    By = np.linalg.lstsq(A, y2)[0]
-    x1grdF = x1grd.flatten()
-    y1grdF = y1grd.flatten()
-
-    A = [np.ones(len(x1grdF)), x1grdF, y1grdF]
-    if order > 1:
-        A += [x1grdF**2, y1grdF**2, x1grdF*y1grdF]
-    if order > 2:
-        A += [x1grdF**3, y1grdF**3, x1grdF**2*y1grdF, y1grdF**2*x1grdF]
-    A = np.vstack(A).T
-    x2grd = np.dot(A, Bx).reshape(x1grd.shape)
-    y2grd = np.dot(A, By).reshape(x1grd.shape)
+    if model is None:
+        model = PolyDriftModel(x1, y1, x2, y2, order)
+    x2grd, y2grd = model(x1grd, y1grd, dtype=dtype)
 
     return x2grd, y2grd
 
-def x2y2_interpolation_near(x1, y1, x2, y2, x1grd, y1grd, method='linear', **kwargs):
+class ScatteredInterpolator(object):
+    ''' Interpolation of any number of fields from scattered points onto
+    destination points (same as SciPy griddata)
+
+    Delaunay triangulation of the source points and barycentric weights of
+    the destination points are computed only once (by chunks in parallel
+    threads), interpolation of each field is then a weighted sum.
+    '''
+    def __init__(self, x1, y1, x1grd, y1grd, method='linear',
+                 chunk_size=100000, threads=1):
+        ''' Triangulate source points and find weights of destination points
+        Parameters
+        ----------
+            x1 : 1D vector - X coordinates of source points
+            y1 : 1D vector - Y coordinates of source points
+            x1grd : 1D vector or 2D array - X coordinates of destination
+            y1grd : 1D vector or 2D array - Y coordinates of destination
+            method : str - 'linear', 'nearest' or 'cubic' (as in griddata)
+            chunk_size : int - number of destination points in one chunk
+            threads : int - number of parallel threads
+        '''
+        self.method = method
+        self.shape = np.shape(x1grd)
+        src = np.array([y1, x1], dtype=np.float64).T
+        dst = np.array([np.ravel(y1grd), np.ravel(x1grd)],
+                       dtype=np.float64).T
+        chunks = [dst[i:i+chunk_size] for i in range(0, len(dst), chunk_size)]
+
+        if method == 'nearest':
+            tree = cKDTree(src)
+            self.indices = np.hstack([[]] + self._map(
+                lambda d: tree.query(d)[1], chunks, threads)).astype(np.int64)
+        elif method in ['linear', 'cubic']:
+            self.tri = Delaunay(src)
+            if method == 'linear':
+                results = self._map(self._get_weights, chunks, threads)
+                self.vertices = np.vstack([np.zeros((0, 3), np.int64)] +
+                                          [r[0] for r in results])
+                self.weights = np.vstack([np.zeros((0, 3))] +
+                                         [r[1] for r in results])
+            else:
+                self.dst = dst
+        else:
+            raise ValueError('Unknown interpolation method: %s' % method)
+
+    @staticmethod
+    def _map(func, chunks, threads):
+        ''' Apply <func> to <chunks> in parallel threads '''
+        if threads > 1 and len(chunks) > 1:
+            pool = ThreadPool(threads)
+            try:
+                return pool.map(func, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        return [func(chunk) for chunk in chunks]
+
+    def _get_weights(self, dst):
+        ''' Find vertices and barycentric weights of destination points '''
+        simplex = self.tri.find_simplex(dst)
+        vertices = self.tri.simplices[simplex]
+        transform = self.tri.transform[simplex]
+        bary = np.einsum('ijk,ik->ij', transform[:, :2], dst - transform[:, 2])
+        weights = np.column_stack([bary, 1 - bary.sum(axis=1)])
+        # points outside of the convex hull
+        weights[simplex == -1] = np.nan
+        return vertices, weights
+
+    def __call__(self, *values):
+        ''' Interpolate fields onto destination points
+        Parameters
+        ----------
+            *values : 1D vectors - values of fields in source points
+        Returns
+        -------
+            list of interpolated fields (with shape of destination points)
+        '''
+        results = []
+        for v in values:
+            v = np.asarray(v, dtype=np.float64)
+            if self.method == 'nearest':
+                result = v[self.indices]
+            elif self.method == 'linear':
+                result = (v[self.vertices] * self.weights).sum(axis=1)
+            else:
+                result = CloughTocher2DInterpolator(self.tri, v)(self.dst)
+            results.append(result.reshape(self.shape))
+        return results
+
+def x2y2_interpolation_near(x1, y1, x2, y2, x1grd, y1grd, method='linear',
+                            interpolator=None, **kwargs):
     ''' Interpolate values of x2/y2 onto full-res grids of x1/y1 using
     linear interpolation of nearest points
     Parameters
@@ -171,21 +400,22 @@ def x2y2_interpolation_near(x1, y1, x2, y2, x1grd, y1grd, method='linear', **kwa
         x1grd : 1D vector - source X coordinate on img1
         y1grd : 1D vector - source Y coordinate on img2
         method : str - parameter for SciPy griddata
+        interpolator : ScatteredInterpolator - created from x1, y1, x1grd,
+            y1grd (if None, a new one is created)
     Returns
     -------
         x2grd : 1D vector - destination X coordinate on img1
         y2grd : 1D vector - destination Y coordinate on img2
     '''
-    src = np.array([y1, x1]).T
-    dst = np.array([y1grd, x1grd]).T
-    x2grd = griddata(src, x2, dst, method=method).T
-    y2grd = griddata(src, y2, dst, method=method).T
+    if interpolator is None:
+        interpolator = ScatteredInterpolator(x1, y1, x1grd, y1grd, method)
+    x2grd, y2grd = interpolator(x2, y2)
 
     return x2grd, y2grd
 
 def get_n(filename, bandName='sigma0_HV', factor=0.5,
                         vmin=-30, vmax=-5, denoise=False, dB=True,
-                        **kwargs):
+                        scene_cache=None, **kwargs):
     ''' Get Nansat object with image data scaled to UInt8
     Parameters
     ----------
@@ -196,11 +426,22 @@ def get_n(filename, bandName='sigma0_HV', factor=0.5,
         vmax : float - maximum allowed value in the band
         denoise : bool - apply denoising of sigma0 ?
         dB : bool - apply conversion to dB ?
+        scene_cache : ArrayCache or str - cache (or root directory of cache)
+            for the UInt8 image and geolocation. If None, the
+            ICE_DRIFT_CACHE_DIR environment variable is used (if set).
         **kwargs : parameters for get_denoised_object()
     Returns
     -------
         n : Nansat object with one band scaled to UInt8
     '''
+    cache = get_cache(scene_cache, 'scenes')
+    if cache is not None:
+        key = _get_scene_key(filename, bandName, factor, vmin, vmax,
+                             denoise, dB, **kwargs)
+        nout = _read_scene(cache, key)
+        if nout is not None:
+            return nout
+
     if denoise:
         # run denoising
         n = get_denoised_object(filename, bandName, factor, **kwargs)
@@ -208,22 +449,68 @@ def get_n(filename, bandName='sigma0_HV', factor=0.5,
         # open data with Nansat and downsample
         n = Nansat(filename)
         n.resize(factor, eResampleAlg=-1)
-    # get matrix with data
-    img = n[bandName]
-    # convert to dB
-    if not denoise and dB:
-        img = 10 * np.log10(img)
-    # convert to 0 - 255
-    img = get_uint8_image(img, vmin, vmax)
+    # read data by blocks, convert to dB and to 0 - 255
+    img = _get_uint8_band(n, bandName, vmin, vmax, not denoise and dB)
 
     nout = Nansat(domain=n, array=img, parameters={'name': bandName})
     nout.set_metadata(n.get_metadata())
     # improve geonetric accuracy
     nout.reproject_GCPs()
     nout.vrt.tps = True
+
+    if cache is not None:
+        _write_scene(cache, key, nout, img, bandName)
+    return nout
+
+def _get_scene_key(filename, bandName, factor, vmin, vmax, denoise, dB,
+                   **kwargs):
+    ''' Get key of preprocessed scene from file identity and parameters '''
+    stat = os.stat(filename)
+    if not denoise:
+        kwargs = {}
+    return ArrayCache.get_key(os.path.abspath(filename),
+                              stat.st_size, stat.st_mtime,
+                              bandName=bandName, factor=factor,
+                              vmin=vmin, vmax=vmax, denoise=denoise, dB=dB,
+                              **kwargs)
+
+def _write_scene(cache, key, n, img, bandName):
+    ''' Write UInt8 image and geolocation (GCPs or geotransform) of
+    Nansat <n> into cache '''
+    ds = n.vrt.dataset
+    gcps = [(g.GCPPixel, g.GCPLine, g.GCPX, g.GCPY, g.GCPZ)
+            for g in ds.GetGCPs()]
+    metadata = dict(name=bandName,
+                    gcps=gcps,
+                    gcp_projection=ds.GetGCPProjection(),
+                    projection=ds.GetProjection(),
+                    geotransform=ds.GetGeoTransform(),
+                    metadata=n.get_metadata())
+    cache.put(key, dict(image=img), metadata)
+
+def _read_scene(cache, key):
+    ''' Read UInt8 image and geolocation from cache and create Nansat '''
+    arrays, metadata = cache.get(key)
+    if arrays is None:
+        return None
+    img = arrays['image']
+    ds = gdal.GetDriverByName('MEM').Create('', img.shape[1], img.shape[0])
+    if len(metadata['gcps']) > 0:
+        ds.SetGCPs([gdal.GCP(gx, gy, gz, pixel, line)
+                    for pixel, line, gx, gy, gz in metadata['gcps']],
+                   str(metadata['gcp_projection']))
+    else:
+        ds.SetProjection(str(metadata['projection']))
+        ds.SetGeoTransform(metadata['geotransform'])
+
+    nout = Nansat(domain=Domain(ds=ds), array=np.asarray(img),
+                  parameters={'name': metadata['name']})
+    nout.set_metadata(metadata['metadata'])
+    # GCPs in cache are already reprojected
+    nout.vrt.tps = True
     return nout
 
-def get_drift_vectors(n1, x1, y1, n2, x2, y2, nsr=NSR(), **kwargs):
+def get_drift_vectors(n1, x1, y1, n2, x2, y2, nsr=None, **kwargs):
     ''' Find ice drift speed m/s
     Parameters
     ----------
@@ -233,7 +520,7 @@ def get_drift_vectors(n1, x1, y1, n2, x2, y2, nsr=NSR(), **kwargs):
         n2 : Second Nansat object
         x1 : 1D vector - X coordinates of keypoints on image 2
         y1 : 1D vector - Y coordinates of keypoints on image 2
-        nsr: Nansat.NSR(), projection that defines the grid
+        nsr: Nansat.NSR(), projection that defines the grid (lon/lat if None)
     Returns
     -------
         u : 1D vector - eastward ice drift speed
@@ -247,14 +534,12 @@ def get_drift_vectors(n1, x1, y1, n2, x2, y2, nsr=NSR(), **kwargs):
     lon1, lat1 = n1.transform_points(x1, y1)
     lon2, lat2 = n2.transform_points(x2, y2)
 
-    # create domain that converts lon/lat to units of the projection
-    d = Domain(nsr, '-te -10 -10 10 10 -tr 1 1')
-
     # find displacement in needed units
-    x1, y1 = d.transform_points(lon1, lat1, 1)
-    x2, y2 = d.transform_points(lon2, lat2, 1)
+    projector = get_projector(nsr)
+    x1, y1 = projector.forward(lon1, lat1)
+    x2, y2 = projector.forward(lon2, lat2)
 
-    return x2-x1, y1-y2, lon1, lat1, lon2, lat2
+    return x2-x1, y2-y1, lon1, lat1, lon2, lat2
 
 def _fill_gpi(shape, gpi, data):
     ''' Fill 1D <data> into 2D matrix with <shape> based on 1D <gpi> '''
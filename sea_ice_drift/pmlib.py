@@ -14,31 +14,27 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 from __future__ import absolute_import
 
-from multiprocessing import Pool
-
 import numpy as np
 from scipy import ndimage as nd
+from scipy.spatial import cKDTree
+try:
+    from scipy.fft import rfft2, irfft2, next_fast_len
+except ImportError:
+    from numpy.fft import rfft2, irfft2
+    from scipy.fftpack import next_fast_len
 
 import cv2
 import gdal
 
-from sea_ice_drift.lib import (x2y2_interpolation_poly,
+from sea_ice_drift.lib import (PolyDriftModel,
+                               ScatteredInterpolator,
+                               x2y2_interpolation_poly,
                                x2y2_interpolation_near,
                                get_drift_vectors,
                                _fill_gpi)
-
-x1_dst_shared = None
-y1_dst_shared = None
-x2fg_shared = None
-y2fg_shared = None
-border_shared = None
-img_size_shared = None
-img1_shared = None
-img2_shared = None
-angles_shared = None
-alpha0_shared = None
-hesnorm_shared = None
-hessmth_shared = None
+from sea_ice_drift.executors import get_executor
+from sea_ice_drift.reader import get_reader, get_spatial_order
+from sea_ice_drift.checkpoint import get_checkpoint
 
 def get_hessian(ccm, hesnorm=True, hessmth=False):
     ''' Find Hessian of the input cross correlation matrix <ccm> '''
@@ -57,12 +53,112 @@ def get_hessian(ccm, hesnorm=True, hessmth=False):
 
     return hes
 
+def _parabolic_offset(c_minus, c_zero, c_plus):
+    ''' Offset of vertex of parabola through three equidistant points '''
+    den = c_minus - 2 * c_zero + c_plus
+    if den >= 0:
+        return 0.
+    return 0.5 * (c_minus - c_plus) / den
+
+def _second_derivative(f, axis):
+    ''' Second derivative of 2D float32 <f> along <axis> computed as
+    np.gradient(np.gradient(f, axis=axis), axis=axis) '''
+    if f.shape[axis] < 5:
+        return np.gradient(np.gradient(f, axis=axis), axis=axis)
+    kernel = np.array([[0.25, 0, -0.5, 0, 0.25]], np.float32)
+    if axis == 0:
+        kernel = kernel.T
+    d2f = cv2.filter2D(f, -1, kernel, borderType=cv2.BORDER_REPLICATE)
+    # first and last two elements use one-sided differences
+    f = np.moveaxis(f, axis, 0)
+    d = np.moveaxis(d2f, axis, 0)
+    g0, g1, g2 = f[1] - f[0], (f[2] - f[0]) / 2, (f[3] - f[1]) / 2
+    d[0], d[1] = g1 - g0, (g2 - g0) / 2
+    g0, g1, g2 = f[-1] - f[-2], (f[-1] - f[-3]) / 2, (f[-2] - f[-4]) / 2
+    d[-1], d[-2] = g0 - g1, (g0 - g2) / 2
+    return d2f
+
+def _median_inplace(a):
+    ''' Median of array <a> which is partially sorted in place '''
+    a = a.reshape(-1)
+    k = a.size // 2
+    a.partition(k)
+    if a.size % 2:
+        return a[k]
+    return (a[:k].max() + a[k]) / 2.
+
+def get_peak_properties(ccm, ij=None, hesnorm=True, hessmth=False,
+                        min_peak_r=None, peak_radius=2, subpixel=True,
+                        peak_ratio=True, **kwargs):
+    ''' Analyse the peak of cross correlation matrix <ccm>
+
+    Finds in one pass (in float32) what is needed at the peak: Hessian
+    (normalized by median and STD of Hessian of the whole matrix, as in
+    get_hessian), sub-pixel position and ratio of the secondary peak to the
+    main peak. Hessian of the whole matrix is not normalized and not stored.
+    Parameters
+    ----------
+        ccm : 2D array - cross correlation matrix
+        ij : tuple - row, column of the peak (argmax of ccm if None)
+        hesnorm : bool - normalize Hessian?
+        hessmth : bool - smooth ccm before computing Hessian?
+        min_peak_r : float - if CC at peak is below, analysis is skipped
+        peak_radius : int - half size of the main peak excluded from search of
+            the secondary peak (the highest other local maximum)
+        subpixel : bool - find sub-pixel position (dy, dx are 0 otherwise)?
+        peak_ratio : bool - find the secondary peak (ratio is nan otherwise)?
+            It needs a pass over the whole matrix.
+    Returns
+    -------
+        h : float - (normalized) Hessian at the peak
+        dy : float - sub-pixel offset of the peak along rows [-0.5, 0.5]
+        dx : float - sub-pixel offset of the peak along columns [-0.5, 0.5]
+        ratio : float - ratio of the secondary peak to the main peak
+        (nan, 0, 0, nan) if the peak is below min_peak_r
+    '''
+    if ij is None:
+        ij = np.unravel_index(np.argmax(ccm), ccm.shape)
+    i, j = ij
+    r = ccm[i, j]
+    if min_peak_r is not None and not r >= min_peak_r:
+        return np.nan, 0., 0., np.nan
+
+    ccm = np.asarray(ccm, dtype=np.float32)
+    if hessmth:
+        ccm2 = nd.gaussian_filter(ccm, 1)
+    else:
+        ccm2 = ccm
+    # Hessian components
+    hes = _second_derivative(ccm2, 1)
+    np.hypot(hes, _second_derivative(ccm2, 0), out=hes)
+    h = hes[i, j]
+    if hesnorm:
+        hes_std = hes.std()
+        h = (h - _median_inplace(hes)) / hes_std
+
+    # sub-pixel position from parabolic fit
+    dy, dx = 0., 0.
+    if subpixel and 0 < i < ccm.shape[0] - 1:
+        dy = _parabolic_offset(ccm[i-1, j], r, ccm[i+1, j])
+    if subpixel and 0 < j < ccm.shape[1] - 1:
+        dx = _parabolic_offset(ccm[i, j-1], r, ccm[i, j+1])
+
+    # highest local maximum outside of the main peak
+    ratio = np.nan
+    if peak_ratio and r > 0:
+        local_max = cv2.dilate(ccm, np.ones((3, 3), np.uint8)) == ccm
+        local_max[max(i - peak_radius, 0):i + peak_radius + 1,
+                  max(j - peak_radius, 0):j + peak_radius + 1] = False
+        if local_max.any():
+            ratio = ccm[local_max].max() / r
+
+    return h, dy, dx, ratio
 
 def get_rotated_template(img, r, c, size, angle, order=1):
     ''' Get rotated template of a given size
     Parameters
     ----------
-        img : 2D numpy array - original image
+        img : 2D numpy array, BlockReader or gdal.Dataset - original image
         r : int - row coordinate of center
         c : int - column coordinate of center
         size : int - template size
@@ -82,30 +178,44 @@ def get_rotated_template(img, r, c, size, angle, order=1):
     rotBorder2 = int(rotBorder1 + hws + hws)
 
     # read large subimage
-    if isinstance(img, np.ndarray):
+    if isinstance(img, gdal.Dataset):
+        template = img.GetRasterBand(1).ReadAsArray(int(c-hwsrot),
+                                                    int(r-hwsrot),
+                                                    int(hwsrot*2+1),
+                                                    int(hwsrot*2+1))
+    else:
+        # numpy array or BlockReader
         template = img[int(r-hwsrot):int(r+hwsrot+1), int(c-hwsrot):int(c+hwsrot+1)]
-    elif isinstance(img, gdal.Dataset):
-        template = img.ReadAsArray(xoff=int(c[0]-hwsrot),
-                                   yoff=int(r[0]-hwsrot),
-                                   xsize=int(hwsrot*2+1),
-                                   ysize=int(hwsrot*2+1))
 
     templateRot = nd.interpolation.rotate(template, angle, order=order)
     templateRot = templateRot[rotBorder1:rotBorder2, rotBorder1:rotBorder2]
 
     return templateRot
 
-def get_distance_to_nearest_keypoint(x1, y1, shape):
+def get_distance_to_nearest_keypoint(x1, y1, shape, x1_dst=None, y1_dst=None):
     ''' Return full-res matrix with distance to nearest keypoint in pixels
+    or distances only in the given points (using KD-tree)
     Parameters
     ----------
         x1 : 1D vector - X coordinates of keypoints
         y1 : 1D vector - Y coordinates of keypoints
         shape : shape of image
+        x1_dst : 1D vector - X coordinates of points where distance is needed
+        y1_dst : 1D vector - Y coordinates of points where distance is needed
     Returns
     -------
-        dist : 2D numpy array - image with distances
+        dist : 2D numpy array - image with distances (if x1_dst is None)
+               1D vector - distances in x1_dst, y1_dst
     '''
+    if x1_dst is not None and y1_dst is not None:
+        # same pixels as in the full-res matrix, but without allocating it
+        seed = np.unique(np.array([np.uint16(y1), np.uint16(x1)]).T, axis=0)
+        dst = np.array([np.asarray(y1_dst).astype(np.int64),
+                        np.asarray(x1_dst).astype(np.int64)]).T
+        if len(dst) == 0:
+            return np.zeros(0)
+        return cKDTree(seed).query(dst)[0]
+
     seed = np.zeros(shape, dtype=bool)
     seed[np.uint16(y1), np.uint16(x1)] = True
     dist = nd.distance_transform_edt(~seed,
@@ -123,8 +233,149 @@ def get_initial_rotation(n1, n2):
     alpha = np.degrees(np.arctan2(b, a)[0])
     return alpha
 
+def match_templates_fft(image, templates):
+    ''' Normalized cross-correlation (as cv2.matchTemplate with
+    cv2.TM_CCOEFF_NORMED) of several templates of the same size with one image
+
+    Image is transformed to frequency domain only once and correlated with all
+    templates at once. Local means and variances of the image are computed
+    once from integral images.
+    Parameters
+    ----------
+        image : 2D array - search window
+        templates : list of 2D arrays - templates of the same size
+    Returns
+    -------
+        results : 3D array - CC matrix for each template
+    '''
+    image = np.asarray(image, dtype=np.float32)
+    templates = np.array(templates, dtype=np.float32)
+    th, tw = templates.shape[1:]
+    rh, rw = image.shape[0] - th + 1, image.shape[1] - tw + 1
+    fft_shape = (next_fast_len(image.shape[0]), next_fast_len(image.shape[1]))
+
+    # numerator: correlation of image with zero-mean templates
+    templates -= templates.mean(axis=(1, 2))[:, None, None]
+    templates_fft = rfft2(templates, fft_shape)
+    np.conj(templates_fft, out=templates_fft)
+    templates_fft *= rfft2(image, fft_shape)[None]
+    num = irfft2(templates_fft, fft_shape)[:, :rh, :rw]
+
+    # denominator: norm of templates and of image in each window
+    wnorm = get_window_norms(image, (th, tw), dtype=np.float64)
+    tnorm = np.sqrt((templates.astype(np.float64)**2).sum(axis=(1, 2)))
+    den = (wnorm[None] * tnorm[:, None, None]).astype(np.float32)
+    results = _normalize_cc(num, den)
+    # constant templates, same as in OpenCV
+    results[tnorm < np.finfo(np.float64).eps] = 1
+    return results
+
+def _normalize_cc(num, den):
+    ''' Divide cross-correlation by norms with the same handling of (almost)
+    zero denominator as in OpenCV '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results = np.divide(num, den, dtype=np.float32)
+    # |CC| >= 1 (or zero denominator) is rare, fix only these elements
+    bpi = ~(np.abs(results) < 1)
+    if bpi.any():
+        results[bpi] = np.where(np.abs(num[bpi]) < den[bpi] * 1.125,
+                                np.sign(num[bpi]), 0)
+    return results
+
+def get_window_norms(image, shape, dtype=np.float32, block_rows=256):
+    ''' Norm of zero-mean image in each sliding window (square root of the
+    denominator of cv2.TM_CCOEFF_NORMED) computed from integral images
+
+    Integral images are computed by blocks of rows to limit memory usage, so
+    the norms can be computed once for a full size image and shared by all
+    points.
+    Parameters
+    ----------
+        image : 2D array - image
+        shape : tuple - number of rows and columns in the window (template)
+        dtype : data type of the output
+        block_rows : int - number of output rows computed at once
+    Returns
+    -------
+        norms : 2D array - norm of the window with upper left corner at each
+            pixel (same shape as output of cv2.matchTemplate)
+    '''
+    th, tw = shape
+    rows = max(image.shape[0] - th + 1, 0)
+    cols = max(image.shape[1] - tw + 1, 0)
+    norms = np.zeros((rows, cols), dtype)
+    for row0 in range(0, rows, block_rows):
+        row1 = min(row0 + block_rows, rows)
+        block = np.ascontiguousarray(image[row0:row1 + th - 1, :])
+        sum1, sum2 = cv2.integral2(block, sdepth=cv2.CV_64F)
+        wsum = (sum1[th:, tw:] - sum1[:-th, tw:] - sum1[th:, :-tw] + sum1[:-th, :-tw])
+        wsum2 = (sum2[th:, tw:] - sum2[:-th, tw:] - sum2[th:, :-tw] + sum2[:-th, :-tw])
+        norms[row0:row1] = np.sqrt(np.maximum(wsum2 - wsum**2 / float(th * tw), 0))
+    return norms
+
+def match_templates_integral(image, templates, norms=None):
+    ''' Normalized cross-correlation (as cv2.matchTemplate with
+    cv2.TM_CCOEFF_NORMED) of templates with one image using precomputed norms
+    of the image windows
+
+    Only correlation of the image with zero-mean templates (cv2.TM_CCORR) is
+    computed for each template. Norms of the windows are computed once (e.g.
+    for the full image with get_window_norms) instead of for each template
+    and each point.
+    Parameters
+    ----------
+        image : 2D array - search window
+        templates : list of 2D arrays - templates of the same size
+        norms : 2D array - norms of the windows of <image> (see
+            get_window_norms). Computed from <image> if None.
+    Returns
+    -------
+        results : list of 2D arrays - CC matrix for each template
+    '''
+    image = np.asarray(image, dtype=np.float32)
+    if norms is None:
+        norms = get_window_norms(image, templates[0].shape)
+    results = []
+    for template in templates:
+        template = template.astype(np.float32)
+        template -= template.mean()
+        tnorm = np.sqrt((template.astype(np.float64)**2).sum())
+        if tnorm < np.finfo(np.float64).eps:
+            # constant template, same as in OpenCV
+            results.append(np.ones(norms.shape, np.float32))
+            continue
+        num = cv2.matchTemplate(image, template, cv2.TM_CCORR)
+        results.append(_normalize_cc(num, norms * np.float32(tnorm)))
+    return results
+
+def _match_angles(img1, x, y, img_size, image, alpha0, angles, mtype, engine,
+                  norms=None):
+    ''' Rotate template to each of the given angles and run MCC
+    Returns
+    -------
+        templates : list of 2D arrays - rotated templates
+        results : list of 2D arrays - CC for each template
+        (None, None) if template is outside the image
+    '''
+    templates = []
+    for angle in angles:
+        template = get_rotated_template(img1, y, x, img_size, angle-alpha0)
+        if template.shape[0] < img_size or template.shape[1] < img_size:
+            return None, None
+        templates.append(template.astype(np.uint8))
+    if engine == 'fft' and mtype == cv2.TM_CCOEFF_NORMED:
+        results = list(match_templates_fft(image, templates))
+    elif engine == 'integral' and mtype == cv2.TM_CCOEFF_NORMED:
+        results = match_templates_integral(image, templates, norms)
+    else:
+        results = [cv2.matchTemplate(image, template, mtype)
+                   for template in templates]
+    return templates, results
+
 def rotate_and_match(img1, x, y, img_size, image, alpha0, angles=[0],
-                     mtype=cv2.TM_CCOEFF_NORMED, **kwargs):
+                     mtype=cv2.TM_CCOEFF_NORMED, engine='opencv',
+                     angle_prior=None, min_r=0.9, subpixel=False, norms=None,
+                     **kwargs):
     ''' Rotate template in a range of angles and run MCC for each
     Parameters
     ----------
@@ -136,38 +387,86 @@ def rotate_and_match(img1, x, y, img_size, image, alpha0, angles=[0],
         alpha0 : float - angle of rotation between two SAR scenes
         angles : list - which angles to test
         mtype : int - type of cross-correlation
-        kwargs : dict, params for get_hessian
+        engine : str - 'opencv' (cv2.matchTemplate for each angle), 'fft'
+            (batched correlation of all angles in frequency domain) or
+            'integral' (correlation with precomputed <norms>). 'fft' and
+            'integral' are used only for mtype=cv2.TM_CCOEFF_NORMED.
+        angle_prior : float - expected angle (e.g. from rotation of the drift
+            model). If given, adaptive search is used: only the angle nearest
+            to angle_prior and its two neighbours in <angles> are tested
+            first, then the search continues towards the growing MCC until
+            a local maximum is found or MCC exceeds <min_r>. If None, all
+            angles are tested.
+        min_r : float - MCC high enough to stop adaptive search
+        subpixel : bool - add sub-pixel offset of the peak to dx, dy?
+        norms : 2D array - norms of windows of <image> for engine='integral'
+            (see get_window_norms)
+        kwargs : dict, params for get_peak_properties
     Returns
     -------
         best_r : float - MCC
         best_a : float - angle that gives highest MCC
         best_h : float - Hessian at highest MCC point
-        dx : int - X displacement of MCC
-        dy : int - Y displacement of MCC
+        dx : float - X displacement of MCC
+        dy : float - Y displacement of MCC
         best_result : 2D array - CC
         best_template : 2D array - template rotated to the best angle
     '''
-    best_r = -np.inf
-    for angle in angles:
-        template = get_rotated_template(img1, y, x, img_size, angle-alpha0)
-        if template.shape[0] < img_size or template.shape[1] < img_size:
-            return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
-        result = cv2.matchTemplate(image, template.astype(np.uint8), mtype)
-        ij = np.unravel_index(np.argmax(result), result.shape)
-        if result.max() > best_r:
-            best_r = result.max()
-            best_a = angle
-            best_result = result
-            best_template = template
-            best_ij = ij
-
-    best_h = get_hessian(best_result, **kwargs)[best_ij]
-    dy = best_ij[0] - (image.shape[0] - template.shape[0]) / 2.
-    dx = best_ij[1] - (image.shape[1] - template.shape[1]) / 2.
+    angles = list(angles)
+    if angle_prior is None or not np.isfinite(angle_prior):
+        templates, results = _match_angles(img1, x, y, img_size, image,
+                                           alpha0, angles, mtype, engine,
+                                           norms)
+        if templates is None:
+            return (np.nan,) * 7
+    else:
+        angles = sorted(angles)
+        i0 = int(np.argmin(np.abs(np.array(angles) - angle_prior)))
+        tested = list(range(max(i0 - 1, 0), min(i0 + 2, len(angles))))
+        templates, results = _match_angles(img1, x, y, img_size, image, alpha0,
+                                           [angles[i] for i in tested],
+                                           mtype, engine, norms)
+        if templates is None:
+            return (np.nan,) * 7
+        # climb towards higher MCC until local maximum
+        while True:
+            ibest = tested[np.argmax([r.max() for r in results])]
+            if results[tested.index(ibest)].max() >= min_r:
+                break
+            inext = [i for i in [ibest - 1, ibest + 1]
+                     if 0 <= i < len(angles) and i not in tested]
+            if len(inext) == 0:
+                break
+            t, r = _match_angles(img1, x, y, img_size, image, alpha0,
+                                 [angles[inext[0]]], mtype, engine, norms)
+            if t is None:
+                break
+            tested += inext[:1]
+            templates += t
+            results += r
+            if r[0].max() <= results[tested.index(ibest)].max():
+                break
+        angles = [angles[i] for i in tested]
+
+    best_i = int(np.argmax([result.max() for result in results]))
+    best_r = results[best_i].max()
+    best_a = angles[best_i]
+    best_result = results[best_i]
+    best_template = templates[best_i]
+    best_ij = np.unravel_index(np.argmax(best_result), best_result.shape)
+
+    # secondary peak is not used
+    best_h, sub_dy, sub_dx, ratio = get_peak_properties(best_result, best_ij,
+                                                        subpixel=subpixel,
+                                                        peak_ratio=False,
+                                                        **kwargs)
+    dy = best_ij[0] - (image.shape[0] - best_template.shape[0]) / 2. + sub_dy
+    dx = best_ij[1] - (image.shape[1] - best_template.shape[1]) / 2. + sub_dx
 
     return best_r, best_a, best_h, dx, dy, best_result, best_template
 
-def use_mcc(x1p, y1p, x2p, y2p, brd, img_size, img1, img2, alpha0, **kwargs):
+def use_mcc(x1p, y1p, x2p, y2p, brd, img_size, img1, img2, alpha0,
+            norms2=None, **kwargs):
     ''' Apply MCC algorithm for one point
     Parameters
     ----------
@@ -180,7 +479,9 @@ def use_mcc(x1p, y1p, x2p, y2p, brd, img_size, img1, img2, alpha0, **kwargs):
         img1 : 2D array - full szie image 1
         img2 : 2D array - full szie image 2
         alpha0 : float, rotation between two images
-        kwargs : dict, params for rotate_and_match, get_hessian
+        norms2 : 2D array - norms of all windows of img2 (see
+            get_window_norms) for engine='integral'
+        kwargs : dict, params for rotate_and_match, get_peak_properties
     Returns
     -------
         x2 : float, result X coordinate on image 2
@@ -190,75 +491,234 @@ def use_mcc(x1p, y1p, x2p, y2p, brd, img_size, img1, img2, alpha0, **kwargs):
         h : float, Hessian of CC at MCC point
     '''
     hws = int(img_size / 2.)
-    image = img2[int(y2p-hws-brd):int(y2p+hws+brd+1),
-                 int(x2p-hws-brd):int(x2p+hws+brd+1)]
+    row0, col0 = int(y2p-hws-brd), int(x2p-hws-brd)
+    image = img2[row0:int(y2p+hws+brd+1), col0:int(x2p+hws+brd+1)]
+    norms = None
+    if norms2 is not None:
+        # norms of windows of the same size as template inside <image>
+        th = img2.shape[0] - norms2.shape[0] + 1
+        tw = img2.shape[1] - norms2.shape[1] + 1
+        norms = norms2[row0:row0 + image.shape[0] - th + 1,
+                       col0:col0 + image.shape[1] - tw + 1]
     r, a, h, dx, dy, bestr, bestt = rotate_and_match(img1, x1p, y1p,
                                                      img_size, image,
-                                                     alpha0, **kwargs)
+                                                     alpha0, norms=norms,
+                                                     **kwargs)
 
     x2 = x2p + dx
     y2 = y2p + dy
 
     return x2, y2, r, a, h
 
-def use_mcc_mp(i):
-    ''' Use MCC in multiprocessing
-    Uses global variables where first guess and images are stored
+def use_mcc_chunk(data, params, start, stop):
+    ''' Apply MCC to a chunk of points
     Parameters
     ---------
-        i : int, index of poin
+        data : dict with arrays
+            img1, img2 : 2D arrays, full size images 1 and 2
+            img1_<level>, img2_<level> : 2D arrays, levels of image pyramids
+                (optional, see get_pyramid)
+            norms2, norms2_<level> : 2D arrays, norms of windows of img2 for
+                engine='integral' (optional, see get_window_norms)
+            x1_dst, y1_dst : 1D vectors, coordinates of points on image 1
+            x2fg, y2fg : 1D vectors, first guess coordinates on image 2
+            border : 1D vector, searching distance
+            angle_prior : 1D vector, expected angle (optional)
+            results : 2D array, output x2, y2, r, a, h for each point
+        params : dict, other parameters for use_mcc and level of pyramids
+            (0 for full size images)
+        start : int, index of the first point in the chunk
+        stop : int, index after the last point in the chunk
+    '''
+    params = dict(params)
+    level = params.pop('level', 0)
+    img1, img2 = _get_level_images(data, level)
+    norms2 = data.get(_level_name('norms2', level))
+    for i in range(start, stop):
+        angle_prior = None
+        if 'angle_prior' in data:
+            angle_prior = data['angle_prior'][i]
+        x2, y2, r, a, h = use_mcc(data['x1_dst'][i], data['y1_dst'][i],
+                                  data['x2fg'][i], data['y2fg'][i],
+                                  data['border'][i],
+                                  img1=img1, img2=img2, norms2=norms2,
+                                  angle_prior=angle_prior,
+                                  **params)
+        data['results'][i] = x2, y2, r, a, h
+        if i % 10 == 0:
+            print('%02.0f%% %07.1f %07.1f %07.1f %07.1f %02.1f %+05.1f %+06.2f' % (
+            100 * float(i) / len(data['x1_dst']),
+             data['x1_dst'][i], data['y1_dst'][i], x2, y2, r, a, h))
+
+def _run_mcc(executor, images, arrays, params):
+    ''' Run MCC for all points with <executor>
+    Parameters
+    ----------
+        executor : SerialExecutor, ThreadExecutor or ProcessExecutor
+        images : dict with the images (img1, img2 and optionally levels of
+            image pyramids img1_<level>, img2_<level>)
+        arrays : dict with vectors of coordinates of points, first guess and
+            border (and optionally angle_prior) for use_mcc_chunk
+        params : dict, other parameters for use_mcc_chunk
     Returns
     -------
-        x2 : float, result X coordinate on image 2
-        y2 : float, result X coordinate on image 2
-        r : float, MCC
-        a : float, angle that gives highest MCC
-        h : float, Hessian of CC at MCC point
+        results : 2D array, x2, y2, r, a, h for each point
     '''
-    global x1_dst_shared, y1_dst_shared
-    global x2fg_shared, y2fg_shared, border_shared
-    global img_size_shared, img1_shared, img2_shared
-    global alpha0_shared, angles_shared
-    global hesnorm_shared, hessmth_shared
-
-    x2, y2, r, a, h = use_mcc(x1_dst_shared[i], y1_dst_shared[i],
-                   x2fg_shared[i], y2fg_shared[i], border_shared[i],
-                   img_size_shared,
-                   img1_shared, img2_shared, alpha0_shared,
-                   angles=angles_shared,
-                   hesnorm=hesnorm_shared,
-                   hessmth=hessmth_shared)
-    if i % 10 == 0:
-        print('%02.0f%% %07.1f %07.1f %07.1f %07.1f %02.1f %+05.1f %+06.2f' % (
-        100 * float(i) / len(x1_dst_shared),
-         x1_dst_shared[i], y1_dst_shared[i], x2, y2, r, a, h))
-    return x2, y2, r, a, h
+    size = len(arrays['x1_dst'])
+    data = dict(arrays, results=np.zeros((size, 5)) + np.nan)
+    data.update(images)
+    executor.map_chunks(use_mcc_chunk, data, ['results'], params, size)
+    return data['results']
+
+def _iter_mcc(executor, images, arrays, params):
+    ''' Run MCC for all points with <executor> and yield chunks of results
+    as soon as they are finished (parameters are the same as in _run_mcc)
+    Yields
+    ------
+        positions : 1D vector, indices of points in the chunk
+        results : 2D array, x2, y2, r, a, h for each point in the chunk
+    '''
+    size = len(arrays['x1_dst'])
+    data = dict(arrays, results=np.zeros((size, 5)) + np.nan)
+    data.update(images)
+    if hasattr(executor, 'imap_chunks'):
+        chunks = executor.imap_chunks(use_mcc_chunk, data, ['results'],
+                                      params, size)
+    else:
+        # executor without streaming
+        executor.map_chunks(use_mcc_chunk, data, ['results'], params, size)
+        chunks = [(0, size)]
+    for start, stop in chunks:
+        yield np.arange(start, stop), data['results'][start:stop]
+
+def _stream_results(chunks, idx, n2, executor=None):
+    ''' Convert chunks of MCC results to chunks of PM results and close
+    <executor> (if given) after the last chunk '''
+    try:
+        for positions, results in chunks:
+            lon2, lat2 = n2.transform_points(results[:, 0], results[:, 1])
+            yield (idx[positions], results[:, 0], results[:, 1],
+                   results[:, 2], results[:, 3], results[:, 4],
+                   np.asarray(lon2), np.asarray(lat2))
+    finally:
+        if executor is not None:
+            executor.close()
+
+def _level_name(name, level=0):
+    ''' Name of array for the given level of pyramids '''
+    if level == 0:
+        return name
+    return '%s_%d' % (name, level)
+
+def _get_level_images(images, level=0):
+    ''' Get images of the given level of pyramids from dict <images> '''
+    return images[_level_name('img1', level)], images[_level_name('img2', level)]
+
+def get_pyramid(img, levels):
+    ''' Build Gaussian pyramid of image
+    Parameters
+    ----------
+        img : 2D array or BlockReader, full size image
+        levels : int, number of downsampled levels
+    Returns
+    -------
+        pyramid : list of 2D arrays, the image and <levels> images each
+            downsampled by factor 2 from the previous one
+    '''
+    pyramid = [img]
+    for level in range(levels):
+        pyramid.append(_pyr_down(pyramid[-1]))
+    return pyramid
+
+def _pyr_down(img, block_rows=1024):
+    ''' Downsample image with cv2.pyrDown (by blocks of rows if the image is
+    not in memory, e.g. BlockReader) '''
+    if isinstance(img, np.ndarray):
+        return cv2.pyrDown(img)
+    rows, cols = img.shape
+    img_down = None
+    for row0 in range(0, rows, block_rows):
+        # halo of 4 rows for the 5x5 Gaussian kernel
+        start = max(row0 - 4, 0)
+        block = cv2.pyrDown(img[start:min(row0 + block_rows + 4, rows), :])
+        if img_down is None:
+            img_down = np.empty(((rows + 1) // 2, block.shape[1]), block.dtype)
+        row1 = (min(row0 + block_rows, rows) + 1) // 2
+        img_down[row0 // 2:row1] = block[row0 // 2 - start // 2:
+                                         row1 - start // 2]
+    return img_down
+
+def _get_gpi(x1, y1, x2, y2, border, img_size, shape1, shape2, margin=0):
+    ''' Find points with templates and searching windows inside images '''
+    hws = img_size / 2
+    hws_hypot = np.hypot(hws, hws)
+    return ((x2-border-hws-margin > 0) *
+            (y2-border-hws-margin > 0) *
+            (x2+border+hws+margin < shape2[1]) *
+            (y2+border+hws+margin < shape2[0]) *
+            (x1-hws_hypot-margin > 0) *
+            (y1-hws_hypot-margin > 0) *
+            (x1+hws_hypot+margin < shape1[1]) *
+            (y1+hws_hypot+margin < shape1[0]))
+
+def refine_first_guess(executor, images, arrays, params, levels,
+                       pyramid_border=4):
+    ''' Refine first guess by MCC on downsampled levels of image pyramids
 
-def _init_pool(x1_dst, y1_dst, x2fg, y2fg, border, gpi, img_size,
-              img1, img2, alpha0, angles, hesnorm, hessmth):
-    ''' Initialize data for multiprocessing '''
-    global x1_dst_shared, y1_dst_shared
-    global x2fg_shared, y2fg_shared, border_shared
-    global img_size_shared, img1_shared, img2_shared
-    global angles_shared, alpha0_shared
-    global hesnorm_shared, hessmth_shared
-
-    x1_dst_shared = x1_dst[gpi]
-    y1_dst_shared = y1_dst[gpi]
-    x2fg_shared = x2fg[gpi]
-    y2fg_shared = y2fg[gpi]
-    border_shared = border[gpi]
-    img_size_shared = img_size
-    img1_shared = img1
-    img2_shared = img2
-    angles_shared = angles
-    alpha0_shared = alpha0
-    hesnorm_shared = hesnorm
-    hessmth_shared = hessmth
+    Starting from the coarsest level, templates of the same size (in pixels
+    of the level) are matched within the searching distance reduced by the
+    downsampling factor. The found position gives the first guess for the
+    next finer level, which is searched within <pyramid_border> pixels only.
+    The found angle is used as angle_prior for the next level.
+
+    Parameters
+    ----------
+        executor : SerialExecutor, ThreadExecutor or ProcessExecutor
+        images : dict with the images img1, img2 and levels of pyramids
+            img1_<level>, img2_<level> for level in 1 .. <levels>
+        arrays : dict with vectors x1_dst, y1_dst, x2fg, y2fg, border and
+            optionally angle_prior (see use_mcc_chunk)
+        params : dict, other parameters for use_mcc (img_size, alpha0, ...)
+        levels : int, number of downsampled levels
+        pyramid_border : int, searching distance on finer levels
+    Returns
+    -------
+        arrays : dict with refined x2fg, y2fg, border and angle_prior
+    '''
+    arrays = dict([(name, np.array(arrays[name], dtype=float))
+                   for name in arrays])
+    if 'angle_prior' not in arrays:
+        arrays['angle_prior'] = np.zeros(len(arrays['x1_dst'])) + np.nan
+    for level in range(levels, 0, -1):
+        scale = 2. ** level
+        img1, img2 = _get_level_images(images, level)
+        level_arrays = dict(x1_dst=arrays['x1_dst'] / scale,
+                            y1_dst=arrays['y1_dst'] / scale,
+                            x2fg=arrays['x2fg'] / scale,
+                            y2fg=arrays['y2fg'] / scale,
+                            border=np.ceil(arrays['border'] / scale))
+        gpi = _get_gpi(level_arrays['x1_dst'], level_arrays['y1_dst'],
+                       level_arrays['x2fg'], level_arrays['y2fg'],
+                       level_arrays['border'], params['img_size'],
+                       img1.shape, img2.shape)
+        level_arrays = dict([(name, level_arrays[name][gpi])
+                             for name in level_arrays])
+        level_arrays['angle_prior'] = arrays['angle_prior'][gpi]
+        results = _run_mcc(executor, images, level_arrays,
+                           dict(params, level=level))
+        # update first guess where the match was found
+        idx = np.nonzero(gpi)[0][np.isfinite(results[:, 0])]
+        results = results[np.isfinite(results[:, 0])]
+        arrays['x2fg'][idx] = results[:, 0] * scale
+        arrays['y2fg'][idx] = results[:, 1] * scale
+        arrays['angle_prior'][idx] = results[:, 3]
+        arrays['border'][idx] = pyramid_border * scale / 2.
+    return arrays
 
 def prepare_first_guess(x1_dst, y1_dst, n1, x1, y1, n2, x2, y2, img_size,
                         min_fg_pts=5, min_border=20, max_border=50,
-                        old_border=True, **kwargs):
+                        old_border=True, threads=1, poly_model=None,
+                        **kwargs):
     ''' For the given coordinates estimate the First Guess
     Parameters
     ---------
@@ -272,6 +732,11 @@ def prepare_first_guess(x1_dst, y1_dst, n1, x1, y1, n2, x2, y2, img_size,
         img_size : int, size of template
         min_border : int, minimum searching distance
         max_border : int, maximum searching distance
+        old_border : bool, use distance to nearest keypoint as border?
+            (otherwise error of polynomial first guess is used)
+        threads : int, number of threads for interpolation
+        poly_model : PolyDriftModel, fitted model of drift (e.g. from
+            lstsq_filter). If None, it is fitted to x1, y1, x2, y2
         **kwargs : parameters for:
             x2y2_interpolation_poly
             x2y2_interpolation_near
@@ -283,13 +748,24 @@ def prepare_first_guess(x1_dst, y1_dst, n1, x1, y1, n2, x2, y2, img_size,
     '''
     shape1 = n1.shape()
     if len(x1) > min_fg_pts:
+        # fit polynomial once for all evaluations
+        if poly_model is None:
+            poly_model = PolyDriftModel(x1, y1, x2, y2,
+                                        kwargs.get('order', 1))
         # interpolate 1st guess using 2nd order polynomial
         x2p2, y2p2 = x2y2_interpolation_poly(x1, y1, x2, y2,
-                                             x1_dst, y1_dst, **kwargs)
+                                             x1_dst, y1_dst,
+                                             model=poly_model, **kwargs)
 
+        # triangulate keypoints once for all interpolated fields
+        interpolator = ScatteredInterpolator(x1, y1, x1_dst, y1_dst,
+                                             kwargs.get('method', 'linear'),
+                                             threads=threads)
         # interpolate 1st guess using griddata
         x2fg, y2fg = x2y2_interpolation_near(x1, y1, x2, y2,
-                                             x1_dst, y1_dst, **kwargs)
+                                             x1_dst, y1_dst,
+                                             interpolator=interpolator,
+                                             **kwargs)
 
         # TODO:
         # Now border is proportional to the distance to the point
@@ -300,19 +776,20 @@ def prepare_first_guess(x1_dst, y1_dst, n1, x1, y1, n2, x2, y2, img_size,
         # Border can be estimated as error of the first guess
         # (x2 - x2_predicted_with_polynom) gridded using nearest neighbour.
         if old_border:
-            # find distance to nearest neigbour and create border matrix
-            border_img = get_distance_to_nearest_keypoint(x1, y1, shape1)
+            # find distance to nearest neigbour in the destination points
             border = np.zeros(x1_dst.size) + max_border
             gpi = ((x1_dst >= 0) * (x1_dst < shape1[1]) *
                    (y1_dst >= 0) * (y1_dst < shape1[0]))
-            border[gpi] = border_img[y1_dst.astype(np.int16)[gpi],
-                                     x1_dst.astype(np.int16)[gpi]]
+            border[gpi] = get_distance_to_nearest_keypoint(x1, y1, shape1,
+                                                           x1_dst[gpi],
+                                                           y1_dst[gpi])
         else:
             x2tst, y2tst = x2y2_interpolation_poly(x1, y1, x2, y2, x1, y1,
-                                                                    **kwargs)
+                                                   model=poly_model, **kwargs)
             x2dif, y2dif = x2y2_interpolation_near(x1, y1,
                                                    x2-x2tst, y2-y2tst,
                                                    x1_dst, y1_dst,
+                                                   interpolator=interpolator,
                                                    **kwargs)
             border = np.hypot(x2dif, y2dif)
 
@@ -331,11 +808,37 @@ def prepare_first_guess(x1_dst, y1_dst, n1, x1, y1, n2, x2, y2, img_size,
 
     return x2fg, y2fg, border
 
+def get_pixel_grid(n1, step, img_size=35, margin=0):
+    ''' Regular grid of pixels on the first image for dense pattern matching
+    Parameters
+    ----------
+        n1 : Nansat, the fist image
+        step : int, distance between grid points in pixels (e.g. img_size)
+        img_size : int, size of template
+        margin : int, distance from edge of the image to templates
+    Returns
+    -------
+        lon1_dst : 2D array, longitude of grid points on image 1
+        lat1_dst : 2D array, latitude of grid points on image 1
+    '''
+    start = int(np.hypot(img_size / 2., img_size / 2.) + margin) + 1
+    rows, cols = n1.shape()
+    x1_dst, y1_dst = np.meshgrid(np.arange(start, cols - start, step),
+                                 np.arange(start, rows - start, step))
+    lon1_dst, lat1_dst = n1.transform_points(x1_dst.flatten(),
+                                             y1_dst.flatten())
+    return lon1_dst.reshape(x1_dst.shape), lat1_dst.reshape(x1_dst.shape)
+
 def pattern_matching(lon1_dst, lat1_dst,
                      n1, x1, y1, n2, x2, y2,
                      margin=0,
                      img_size=35, threads=5, angles=range(-15,16,3),
-                     hesnorm=True, hessmth=False, **kwargs):
+                     hesnorm=True, hessmth=False, img1=None, img2=None,
+                     engine='opencv', adaptive_angles=False, min_r=0.9,
+                     subpixel=False, min_peak_r=None, backend='processes',
+                     chunksize=None, pyramid_levels=0, pyramid_border=4,
+                     pyramids=None, norms2=None, block_size=512,
+                     max_blocks=64, stream=False, checkpoint=None, **kwargs):
     ''' Run Pattern Matching Algorithm on two images
     Parameters
     ---------
@@ -348,10 +851,58 @@ def pattern_matching(lon1_dst, lat1_dst,
         x2 : 1D vector, X coordinates of keypoints on image 2
         y2 : 1D vector, Y coordinates of keypoints on image 2
         img_size : int, size of template
-        threads : int, number of parallel threads
+        threads : int, number of parallel threads or processes
         angles : 1D vector, angles for template rotation
         hesnorm : bool, normalize Hessian of cross-corr matrix?
         hessmth : bool, smooth cross-corr matrix before Hessian?
+        img1 : 2D UInt8 matrix, image from n1 (read from n1 if None). Can
+            also be an image which is not loaded into memory: name of file,
+            gdal.Dataset, numpy.memmap or BlockReader. Then only windows
+            needed for each point are read by blocks (see BlockReader) and
+            points are sorted spatially.
+        img2 : 2D UInt8 matrix, image from n2 (read from n2 if None), or
+            image which is not in memory (as img1)
+        engine : str, 'opencv', 'fft' or 'integral', see rotate_and_match.
+            'integral' is recommended for dense grids (see get_pixel_grid).
+        adaptive_angles : bool, search angles around the local rotation
+            predicted by the polynomial drift model (see rotate_and_match)?
+        min_r : float, MCC high enough to stop adaptive search of angles
+        subpixel : bool, find sub-pixel position of MCC?
+        min_peak_r : float, MCC below which Hessian is not computed (h=nan)
+        backend : str, 'serial', 'threads' or 'processes' or executor object
+            (e.g. ProcessExecutor reused between calls), see get_executor.
+            If str, a new executor with <threads> workers is started and
+            stopped.
+        chunksize : int, number of points in one task for the new executor
+        pyramid_levels : int, number of downsampled levels of image pyramids.
+            If > 0, first guess is refined on downsampled images (see
+            refine_first_guess) and MCC on full size images is run within
+            <pyramid_border> pixels only.
+        pyramid_border : int, searching distance after refinement on pyramids
+        pyramids : tuple with two lists of 2D arrays, image pyramids of img1
+            and img2 (see get_pyramid) built once per scene. If None, they
+            are built from img1 and img2.
+        norms2 : list of 2D arrays, norms of windows of img2 for each level
+            of pyramids for engine='integral' (see get_window_norms). If None,
+            they are computed from img2 once for all points (only for
+            images in memory).
+        block_size : int, size of blocks for reading images not in memory
+        max_blocks : int, number of cached blocks for each image not in memory
+        stream : bool, return generator which yields chunks of results as
+            soon as they are finished (in any order) instead of the arrays
+            below. Each chunk is a tuple with 1D vectors:
+                idx : indices of points in flattened lon1_dst
+                x2, y2 : coordinates of results on image 2
+                r, a, h : MCC, angle and Hessian
+                lon2, lat2 : longitude and latitude of results on image 2
+            Points where pattern matching is not applied (e.g. near edges)
+            are not yielded.
+        checkpoint : Checkpoint or str (directory), store where results of
+            finished points are periodically saved. The run is identified
+            by the images, coordinates, first guess and border of the points
+            and parameters of MCC (img_size, angles, hesnorm, ...). If it is
+            restarted (e.g. after the process was killed), only the points
+            which are not in the checkpoint are processed. See Checkpoint.
         **kwargs : parameters for:
             prepare_first_guess
             get_drift_vectors
@@ -365,40 +916,121 @@ def pattern_matching(lon1_dst, lat1_dst,
         lon2_dst : 1D vector, longitude of results on image 2
         lat2_dst : 1D vector, latitude  of results on image 2
     '''
-    img1, img2 = n1[1], n2[1]
+    if img1 is None:
+        img1 = n1[1]
+    if img2 is None:
+        img2 = n2[1]
+    # images which are not in memory are read by blocks
+    img1 = get_reader(img1, block_size=block_size, max_blocks=max_blocks)
+    img2 = get_reader(img2, block_size=block_size, max_blocks=max_blocks)
+    out_of_core = not (isinstance(img1, np.ndarray) and
+                       isinstance(img2, np.ndarray))
     # convert lon/lat to pixe/line of the first image
     x1_dst, y1_dst = n1.transform_points(lon1_dst.flatten(), lat1_dst.flatten(), 1)
 
+    # fit polynomial drift model once for first guess and rotation
+    poly_model = kwargs.pop('poly_model', None)
+    if poly_model is None and len(x1) > kwargs.get('min_fg_pts', 5):
+        poly_model = PolyDriftModel(x1, y1, x2, y2, kwargs.get('order', 1))
+
     x2fg, y2fg, border = prepare_first_guess(x1_dst, y1_dst,
                                              n1, x1, y1,
                                              n2, x2, y2,
                                              img_size,
+                                             threads=threads,
+                                             poly_model=poly_model,
                                              **kwargs)
-    # find good input points
-    hws = img_size / 2
-    hws_hypot = np.hypot(hws, hws)
-    gpi = ((x2fg-border-hws-margin > 0) *
-           (y2fg-border-hws-margin > 0) *
-           (x2fg+border+hws+margin < n2.shape()[1]) *
-           (y2fg+border+hws+margin < n2.shape()[0]) *
-           (x1_dst-hws_hypot-margin > 0) *
-           (y1_dst-hws_hypot-margin > 0) *
-           (x1_dst+hws_hypot+margin < n1.shape()[1]) *
-           (y1_dst+hws_hypot+margin < n1.shape()[0]))
-
     alpha0 = get_initial_rotation(n1, n2)
+    params = dict(img_size=img_size, alpha0=alpha0, angles=angles,
+                  hesnorm=hesnorm, hessmth=hessmth, engine=engine,
+                  min_r=min_r, subpixel=subpixel, min_peak_r=min_peak_r)
+    images = dict(img1=img1, img2=img2)
+    if pyramid_levels > 0:
+        if pyramids is None:
+            pyramids = (get_pyramid(img1, pyramid_levels),
+                        get_pyramid(img2, pyramid_levels))
+        for level in range(1, pyramid_levels + 1):
+            images[_level_name('img1', level)] = pyramids[0][level]
+            images[_level_name('img2', level)] = pyramids[1][level]
+    if engine == 'integral':
+        # norms of all windows of image 2 are computed once for all points
+        if norms2 is None:
+            norms2 = [get_window_norms(images[_level_name('img2', level)],
+                                       (int(img_size), int(img_size)))
+                      if isinstance(images[_level_name('img2', level)],
+                                    np.ndarray) else None
+                      for level in range(pyramid_levels + 1)]
+        for level in range(pyramid_levels + 1):
+            if norms2[level] is not None:
+                images[_level_name('norms2', level)] = norms2[level]
+
+    # run MCC in multiple threads or processes
+    executor = get_executor(backend, threads, chunksize)
+    close_executor = executor is not backend
+    try:
+        angle_prior = None
+        if pyramid_levels > 0:
+            # tighten first guess and searching distance on coarse levels
+            refined = refine_first_guess(executor, images,
+                                         dict(x1_dst=x1_dst, y1_dst=y1_dst,
+                                              x2fg=x2fg, y2fg=y2fg,
+                                              border=border),
+                                         params, pyramid_levels,
+                                         pyramid_border)
+            x2fg, y2fg, border = (refined['x2fg'], refined['y2fg'],
+                                  refined['border'])
+            angle_prior = refined['angle_prior']
+
+        # find good input points
+        gpi = _get_gpi(x1_dst, y1_dst, x2fg, y2fg, border, img_size,
+                       n1.shape(), n2.shape(), margin)
+
+        # expected angle from local rotation of the drift model
+        if adaptive_angles and poly_model is not None:
+            model_prior = alpha0 + poly_model.get_rotation(x1_dst, y1_dst)
+            if angle_prior is None:
+                angle_prior = model_prior
+            else:
+                angle_prior[np.isnan(angle_prior)] = model_prior[
+                                                    np.isnan(angle_prior)]
+
+        idx = np.nonzero(gpi)[0]
+        order = np.arange(idx.size)
+        if out_of_core:
+            # neighbouring points read the same blocks
+            order = get_spatial_order(x1_dst[idx], y1_dst[idx], block_size)
+        idx = idx[order]
+        arrays = dict(x1_dst=x1_dst[idx], y1_dst=y1_dst[idx],
+                      x2fg=x2fg[idx], y2fg=y2fg[idx], border=border[idx])
+        if angle_prior is not None:
+            arrays['angle_prior'] = angle_prior[idx]
+
+        def iter_chunks(todo):
+            return _iter_mcc(executor, images,
+                             dict((name, arrays[name][todo]) for name in arrays),
+                             params)
+
+        checkpoint = get_checkpoint(checkpoint)
+        if checkpoint is None:
+            chunks = iter_chunks(np.arange(idx.size))
+        else:
+            # skip points which are already finished
+            key = checkpoint.get_key(img1, img2, arrays, params)
+            chunks = checkpoint.iter_results(key, iter_chunks, idx.size)
+
+        if stream:
+            # new executor is closed by the generator after the last chunk
+            owned_executor = executor if close_executor else None
+            close_executor = False
+            return _stream_results(chunks, idx, n2, owned_executor)
+
+        results = np.zeros((idx.size, 5))
+        for positions, chunk_results in chunks:
+            results[order[positions]] = chunk_results
+    finally:
+        if close_executor:
+            executor.close()
 
-    # run MCC in multiple threads
-    p = Pool(threads, initializer=_init_pool,
-            initargs=(x1_dst, y1_dst, x2fg, y2fg, border, gpi,
-            img_size, img1, img2, alpha0, angles, hesnorm, hessmth))
-    results = p.map(use_mcc_mp, range(len(gpi[gpi])))
-    p.close()
-    p.terminate()
-    p.join()
-    del p
-
-    results = np.array(results)
     x2_dst = results[:,0]
     y2_dst = results[:,1]
     r      = results[:,2]
@@ -0,0 +1,215 @@
+# Name:    reader.py
+# Purpose: Container of block reader of large images
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import gdal
+
+class BlockReader(object):
+    ''' Read windows of a large image through a cache of blocks
+
+    The image is not loaded into memory. Windows are read with 2D slicing
+    (e.g. reader[10:50, 20:60]) like from a numpy array. The image is read
+    by square blocks aligned to a regular grid and the least recently used
+    blocks are removed from the cache when it has more than <max_blocks>.
+    Neighbouring windows (e.g. of spatially sorted points) are therefore
+    read from disk only once.
+
+    The reader can be pickled and sent to another process: only the name of
+    the file (or of the memory-mapped array) is passed and the file is
+    reopened with an empty cache. Readers of in-memory GDAL datasets (MEM
+    driver or /vsimem/ files) cannot be pickled.
+    '''
+    def __init__(self, source, band=1, block_size=512, max_blocks=64):
+        ''' Initialize reader (the file is opened at the first read)
+        Parameters
+        ----------
+            source : str (name of file readable by GDAL), gdal.Dataset,
+                numpy.memmap or numpy array
+            band : int, number of band in GDAL dataset
+            block_size : int, size of blocks, pixels
+            max_blocks : int, maximum number of blocks in the cache
+        '''
+        self.band = band
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.filename = None
+        self._dataset = None
+        self._array = None
+        if isinstance(source, str):
+            self.filename = source
+        elif isinstance(source, gdal.Dataset):
+            self.filename = source.GetDescription()
+            self._dataset = source
+        else:
+            self._array = source
+        self._init_cache()
+
+    def _init_cache(self):
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_blocks'], state['_lock']
+        if self._dataset is not None and (
+                not self.filename or self.filename.startswith('/vsimem/') or
+                self._dataset.GetDriver().ShortName == 'MEM'):
+            raise TypeError('BlockReader of in-memory GDAL dataset cannot be '
+                            'pickled (e.g. sent to worker processes): save '
+                            'the dataset to a file or read it into an array')
+        state['_dataset'] = None
+        if isinstance(self._array, np.memmap) and self._array.filename:
+            # reopen memory-mapped file instead of pickling data
+            state['_array'] = (self._array.filename, self._array.dtype.str,
+                               self._array.offset, self._array.shape)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self._array, tuple):
+            filename, dtype, offset, shape = self._array
+            self._array = np.memmap(filename, dtype=dtype, mode='r',
+                                    offset=offset, shape=shape)
+        self._init_cache()
+
+    def _get_band(self):
+        ''' Open GDAL dataset (if needed) and return the band '''
+        if self._dataset is None:
+            self._dataset = gdal.Open(self.filename)
+            if self._dataset is None:
+                raise IOError('Cannot open %s' % self.filename)
+        return self._dataset.GetRasterBand(self.band)
+
+    @property
+    def name(self):
+        ''' Name of the file with the image (None for arrays in memory) '''
+        if isinstance(self._array, np.memmap) and self._array.filename:
+            return '%s:%d' % (self._array.filename, self._array.offset)
+        return self.filename
+
+    @property
+    def shape(self):
+        ''' Number of rows and columns in the image '''
+        if self._array is not None:
+            return self._array.shape[:2]
+        band = self._get_band()
+        return band.YSize, band.XSize
+
+    @property
+    def dtype(self):
+        ''' Data type of the image '''
+        if self._array is not None:
+            return self._array.dtype
+        return self._get_block(0, 0).dtype
+
+    def _get_block(self, brow, bcol):
+        ''' Get block from cache or read it from the image '''
+        key = (brow, bcol)
+        with self._lock:
+            if key in self._blocks:
+                self._blocks[key] = self._blocks.pop(key)
+                return self._blocks[key]
+            rows, cols = self.shape
+            row0, col0 = brow * self.block_size, bcol * self.block_size
+            row1 = min(row0 + self.block_size, rows)
+            col1 = min(col0 + self.block_size, cols)
+            if self._array is not None:
+                block = np.array(self._array[row0:row1, col0:col1])
+            else:
+                block = self._get_band().ReadAsArray(col0, row0,
+                                                     col1 - col0, row1 - row0)
+            self._blocks[key] = block
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        return block
+
+    def read(self, row0, row1, col0, col1):
+        ''' Read window of the image
+        Parameters
+        ----------
+            row0, row1 : int, first and last (excluded) row of the window
+            col0, col1 : int, first and last (excluded) column of the window
+        Returns
+        -------
+            window : 2D array (cut by the image edges)
+        '''
+        rows, cols = self.shape
+        row0, row1 = max(row0, 0), min(row1, rows)
+        col0, col1 = max(col0, 0), min(col1, cols)
+        if row1 <= row0 or col1 <= col0:
+            return np.zeros((max(row1 - row0, 0), max(col1 - col0, 0)),
+                            self.dtype)
+        bs = self.block_size
+        window = None
+        for brow in range(row0 // bs, (row1 - 1) // bs + 1):
+            for bcol in range(col0 // bs, (col1 - 1) // bs + 1):
+                block = self._get_block(brow, bcol)
+                if window is None:
+                    window = np.empty((row1 - row0, col1 - col0), block.dtype)
+                # intersection of the block and the window
+                r0, r1 = max(row0, brow * bs), min(row1, (brow + 1) * bs)
+                c0, c1 = max(col0, bcol * bs), min(col1, (bcol + 1) * bs)
+                window[r0 - row0:r1 - row0, c0 - col0:c1 - col0] = block[
+                    r0 - brow * bs:r1 - brow * bs, c0 - bcol * bs:c1 - bcol * bs]
+        return window
+
+    def __getitem__(self, key):
+        ''' Read window with 2D slicing like from numpy array (negative
+        indices are counted from the end, step is not supported) '''
+        if (not isinstance(key, tuple) or len(key) != 2 or
+                not all(isinstance(k, slice) and k.step in (None, 1)
+                        for k in key)):
+            raise IndexError('Only 2D slices are supported by BlockReader')
+        rows, cols = self.shape
+        row0, row1 = key[0].indices(rows)[:2]
+        col0, col1 = key[1].indices(cols)[:2]
+        return self.read(row0, row1, col0, col1)
+
+def get_reader(img, **kwargs):
+    ''' Get reader of image which is not in memory
+    Parameters
+    ----------
+        img : numpy array, numpy.memmap, gdal.Dataset, str or BlockReader
+        **kwargs : parameters for BlockReader (e.g. block_size, max_blocks)
+    Returns
+    -------
+        img : the same numpy array (if it is in memory) or BlockReader
+    '''
+    if isinstance(img, BlockReader):
+        return img
+    if isinstance(img, np.ndarray) and not isinstance(img, np.memmap):
+        return img
+    return BlockReader(img, **kwargs)
+
+def get_spatial_order(x, y, block_size=512):
+    ''' Order of points for reading images by blocks: points are sorted by
+    bands of rows of height <block_size> and by columns inside each band in
+    alternating directions
+    Parameters
+    ----------
+        x : 1D vector, X coordinates of points
+        y : 1D vector, Y coordinates of points
+        block_size : int, height of bands
+    Returns
+    -------
+        order : 1D vector, indices of sorted points
+    '''
+    band = np.floor(np.asarray(y) / block_size)
+    direction = np.where(band % 2 == 0, 1, -1)
+    return np.lexsort((np.asarray(x) * direction, band))
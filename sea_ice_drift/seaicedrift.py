@@ -19,12 +19,23 @@ import numpy as np
 from nansat import Nansat
 
 from sea_ice_drift.lib import get_n, get_drift_vectors
+from sea_ice_drift.geolocation import FastGeolocation, get_projector
 from sea_ice_drift.ftlib import feature_tracking
-from sea_ice_drift.pmlib import pattern_matching
+from sea_ice_drift.pmlib import (pattern_matching, get_pyramid,
+                                 get_window_norms)
+from sea_ice_drift.executors import get_executor
+from sea_ice_drift.tiling import tiled_drift
 
 class SeaIceDrift(object):
-    ''' Retrieve Sea Ice Drift using Feature Tracking and Pattern Matching'''
-    def __init__(self, filename1, filename2, **kwargs):
+    ''' Retrieve Sea Ice Drift using Feature Tracking and Pattern Matching
+
+    Used as a context manager (with SeaIceDrift(...) as sid:), the object
+    keeps workers and shared images of Pattern Matching between calls of
+    get_drift_PM and stops them on exit. Otherwise workers are started and
+    stopped in each call.
+    '''
+    def __init__(self, filename1, filename2, fast_geolocation=False,
+                 **kwargs):
         ''' Initialize from two file names:
         Open files with Nansat
         Read data from sigma0_HV or other band and convert to UInt8
@@ -32,6 +43,10 @@ class SeaIceDrift(object):
         ----------
             filename1 : str, file name of the first Sentinel-1 image
             filename2 : str, file name of the second Sentinel-1 image
+            fast_geolocation : bool or dict, use FastGeolocation instead of
+                TPS for transformation of coordinates? (dict is used as
+                parameters of FastGeolocation, e.g. step and max_error)
+            **kwargs : parameters for get_n (e.g. scene_cache)
         '''
         self.filename1 = filename1
         self.filename2 = filename2
@@ -39,6 +54,69 @@ class SeaIceDrift(object):
         # get Nansat
         self.n1 = get_n(self.filename1, **kwargs)
         self.n2 = get_n(self.filename2, **kwargs)
+        if fast_geolocation:
+            if not isinstance(fast_geolocation, dict):
+                fast_geolocation = {}
+            self.n1 = FastGeolocation(self.n1, **fast_geolocation)
+            self.n2 = FastGeolocation(self.n2, **fast_geolocation)
+        # read UInt8 images once and reuse in FT and PM
+        self.img1 = self.n1[1]
+        self.img2 = self.n2[1]
+        # image pyramids for PM (built at first call with pyramid_levels)
+        self.pyramids = None
+        # norms of windows of image 2 for PM with engine='integral'
+        self.norms2 = {}
+        # executor for PM reused inside the with block
+        self.executor = None
+        self._executor_key = None
+        self._reuse_executor = False
+
+    def __enter__(self):
+        self._reuse_executor = True
+        return self
+
+    def __exit__(self, *args):
+        self._reuse_executor = False
+        self.close()
+
+    def close(self):
+        ''' Stop workers used for Pattern Matching '''
+        if self.executor is not None:
+            self.executor.close()
+            self.executor = None
+            self._executor_key = None
+
+    def get_pyramids(self, levels):
+        ''' Get image pyramids of both images (built once per scene)
+        Parameters
+        ----------
+            levels : int, number of downsampled levels
+        Returns
+        -------
+            pyramids : tuple with two lists of 2D arrays, see get_pyramid
+        '''
+        if self.pyramids is None or len(self.pyramids[0]) <= levels:
+            self.pyramids = (get_pyramid(self.img1, levels),
+                             get_pyramid(self.img2, levels))
+        return self.pyramids
+
+    def get_norms2(self, img_size, levels=0):
+        ''' Get norms of windows of the second image for each level of
+        pyramids (computed once per scene and template size)
+        Parameters
+        ----------
+            img_size : int, size of template
+            levels : int, number of downsampled levels
+        Returns
+        -------
+            norms2 : list of 2D arrays, see get_window_norms
+        '''
+        key = (int(img_size), levels)
+        if key not in self.norms2:
+            images2 = self.get_pyramids(levels)[1][:levels + 1]
+            self.norms2[key] = [get_window_norms(img2, (key[0], key[0]))
+                                for img2 in images2]
+        return self.norms2[key]
 
     def get_drift_FT(self, **kwargs):
         ''' Get sea ice drift using Feature Tracking
@@ -56,7 +134,9 @@ class SeaIceDrift(object):
             lon2 : 1D vector - longitudes of destination points
             lat2 : 1D vector - latitudes of destination points
         '''
-        x1, y1, x2, y2 = feature_tracking(self.n1, self.n2, **kwargs)
+        x1, y1, x2, y2 = feature_tracking(self.n1, self.n2,
+                                          img1=self.img1, img2=self.img2,
+                                          **kwargs)
         return get_drift_vectors(self.n1, x1, y1,
                                  self.n2, x2, y2, **kwargs)
     
@@ -72,7 +152,7 @@ class SeaIceDrift(object):
             lon2 : 1D vector, longitude of keypoints on image2
             lat2 : 1D vector, latitude  of keypoints on image2
             **kwargs : parameters for
-                feature_tracking
+                pattern_matching
                 get_drift_vectors
         Returns
         -------
@@ -83,7 +163,93 @@ class SeaIceDrift(object):
             lon2_dst : 1D vector, longitude of results on image 2
             lat2_dst : 1D vector, latitude  of results on image 2
         '''
+        # keep workers and shared images for the next calls in with block
+        backend = kwargs.get('backend', 'processes')
+        if isinstance(backend, str) and self._reuse_executor:
+            key = (backend, kwargs.get('threads', 5), kwargs.get('chunksize'))
+            if self._executor_key != key:
+                self.close()
+                self.executor = get_executor(*key)
+                self._executor_key = key
+            kwargs['backend'] = self.executor
+
+        # build downsampled images once and share them between calls
+        if kwargs.get('pyramid_levels', 0) > 0 and 'pyramids' not in kwargs:
+            kwargs['pyramids'] = self.get_pyramids(kwargs['pyramid_levels'])
+        if kwargs.get('engine') == 'integral' and 'norms2' not in kwargs:
+            kwargs['norms2'] = self.get_norms2(kwargs.get('img_size', 35),
+                                               kwargs.get('pyramid_levels', 0))
+
         x1, y1 = self.n1.transform_points(lon1, lat1, 1)
         x2, y2 = self.n2.transform_points(lon2, lat2, 1)
+        # images can be replaced e.g. by BlockReader of full size images
+        kwargs.setdefault('img1', self.img1)
+        kwargs.setdefault('img2', self.img2)
         return pattern_matching(lons, lats, self.n1, x1, y1,
-                                            self.n2, x2, y2, **kwargs)
+                                            self.n2, x2, y2,
+                                            **kwargs)
+
+    def get_drift_PM_grid(self, xgrd, ygrd, nsr, lon1, lat1, lon2, lat2,
+                          **kwargs):
+        ''' Get sea ice drift using Pattern Matching on a projected grid
+        Drift is computed from the given grid coordinates directly (start
+        points are not converted back from lon/lat)
+        Parameters
+        ----------
+            xgrd : 1D vector, X coordinates of result vectors in <nsr>
+            ygrd : 1D vector, Y coordinates of result vectors in <nsr>
+            nsr : Nansat.NSR, EPSG code, proj4 or WKT string, projection
+            lon1 : 1D vector, longitude of keypoints on image1
+            lat1 : 1D vector, latitude  of keypoints on image1
+            lon2 : 1D vector, longitude of keypoints on image2
+            lat2 : 1D vector, latitude  of keypoints on image2
+            **kwargs : parameters for
+                pattern_matching
+        Returns
+        -------
+            u : 1D vector, displacement along X axis of <nsr>
+            v : 1D vector, displacement along Y axis of <nsr>
+            r : 1D vector, MCC
+            a : 1D vector, angle that gives the highes MCC
+            h : 1D vector, Hessian of CC at MCC point
+            x2 : 1D vector, X coordinates of results on image 2 in <nsr>
+            y2 : 1D vector, Y coordinates of results on image 2 in <nsr>
+        '''
+        projector = get_projector(nsr)
+        lons, lats = projector.inverse(xgrd, ygrd)
+        upm, vpm, r, a, h, lon2pm, lat2pm = self.get_drift_PM(
+                                lons, lats, lon1, lat1, lon2, lat2, **kwargs)
+        x2, y2 = projector.forward(lon2pm, lat2pm)
+        # keep zeros where pattern matching was not applied
+        u, v = projector.get_drift(xgrd, ygrd, lon2pm, lat2pm)
+        gpi = (lon2pm != 0) + (lat2pm != 0)
+        u[~gpi] = 0
+        v[~gpi] = 0
+        return u, v, r, a, h, x2, y2
+
+    def get_drift_tiled(self, lons, lats, tile_size=4096, threads=4,
+                        ft_kwargs=None, pm_kwargs=None, **kwargs):
+        ''' Get sea ice drift using Feature Tracking and Pattern Matching
+        run by tiles of the first image (see tiled_drift)
+        Parameters
+        ----------
+            lons : 1D vector, longitude of PM result vectors on image 1
+            lats : 1D vector, latitude of PM result vectors on image 1
+            tile_size : int, size of tiles, pixels
+            threads : int, number of tiles processed in parallel
+            ft_kwargs : dict, parameters for feature_tracking and
+                get_drift_vectors
+            pm_kwargs : dict, parameters for pattern_matching
+            **kwargs : other parameters for tiled_drift (halo, margin)
+        Returns
+        -------
+            ft : tuple with u, v, lon1, lat1, lon2, lat2 (see get_drift_FT)
+            pm : tuple with u, v, r, a, h, lon2, lat2 (see get_drift_PM)
+        '''
+        (x1, y1, x2, y2), pm = tiled_drift(self.n1, self.n2, lons, lats,
+                                           tile_size, self.img1, self.img2,
+                                           threads, ft_kwargs=ft_kwargs,
+                                           pm_kwargs=pm_kwargs, **kwargs)
+        ft = get_drift_vectors(self.n1, x1, y1, self.n2, x2, y2,
+                               **(ft_kwargs or {}))
+        return ft, pm
@@ -0,0 +1,150 @@
+# Name:    shared.py
+# Purpose: Container of arrays shared between processes
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import
+
+import os
+import atexit
+import shutil
+import tempfile
+try:
+    from weakref import finalize
+except ImportError:
+    # Python 2
+    finalize = None
+
+import numpy as np
+
+# directory in RAM on Linux
+SHM_DIR = '/dev/shm'
+
+if finalize is None:
+    class finalize(object):
+        ''' Call func(*args, **kwargs) once: when called or at exit of the
+        interpreter (simplified weakref.finalize for Python 2, where the owner
+        calls it from __del__) '''
+        def __init__(self, obj, func, *args, **kwargs):
+            self._call = (func, args, kwargs)
+            atexit.register(self)
+
+        @property
+        def alive(self):
+            return self._call is not None
+
+        def __call__(self):
+            if self._call is not None:
+                func, args, kwargs = self._call
+                self._call = None
+                return func(*args, **kwargs)
+
+        def detach(self):
+            self._call = None
+
+class SharedArrays(object):
+    ''' Numpy arrays shared between processes through memory-mapped files
+
+    Each array is written once into a .npy file in a temporary directory
+    (in /dev/shm if available) and opened by other processes with memory
+    mapping. Each put() writes a new file, so an array which is replaced does
+    not change files opened by other processes. Only names of files are
+    passed to the processes, so the arrays are neither pickled nor copied
+    for each process. Arrays created with create() can be written by the
+    processes directly. Files are removed by close(), when the object is
+    garbage collected or at exit of the interpreter.
+    '''
+    def __init__(self, path=None):
+        ''' Create temporary directory
+        Parameters
+        ----------
+            path : str, parent directory (SHM_DIR or system default if None)
+        '''
+        if path is None and os.path.isdir(SHM_DIR):
+            path = SHM_DIR
+        self.path = tempfile.mkdtemp(prefix='sea_ice_drift_', dir=path)
+        self.files = {}
+        self._count = 0
+        self._finalizer = finalize(self, shutil.rmtree, self.path,
+                                   ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        # needed only on Python 2 (see finalize)
+        self._finalizer()
+
+    def _filename(self, name):
+        ''' Unique name of file for the array '''
+        self._count += 1
+        return os.path.join(self.path, '%s.%d.npy' % (name, self._count))
+
+    def put(self, name, array):
+        ''' Write array into shared file
+        Parameters
+        ----------
+            name : str, name of the array
+            array : numpy array
+        Returns
+        -------
+            filename : str, name of the file
+        '''
+        filename = self._filename(name)
+        np.save(filename, np.ascontiguousarray(array))
+        # previous version of the array is not needed
+        if name in self.files and os.path.exists(self.files[name]):
+            os.remove(self.files[name])
+        self.files[name] = filename
+        return filename
+
+    def create(self, name, shape, dtype=np.float64, fill_value=np.nan):
+        ''' Create shared array which can be written by other processes
+        Parameters
+        ----------
+            name : str, name of the array
+            shape : tuple, shape of the array
+            dtype : data type of the array
+            fill_value : initial value of the array elements
+        Returns
+        -------
+            array : memory-mapped numpy array
+        '''
+        filename = self._filename(name)
+        array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                          shape=shape)
+        array[:] = fill_value
+        array.flush()
+        self.files[name] = filename
+        return array
+
+    @staticmethod
+    def load(files, mode='r'):
+        ''' Open shared arrays (e.g. in another process)
+        Parameters
+        ----------
+            files : dict, names of arrays and files (SharedArrays.files)
+            mode : str, mode of memory mapping ('r' or 'r+' for writing)
+        Returns
+        -------
+            arrays : dict with memory-mapped arrays
+        '''
+        return dict([(name, np.load(files[name], mmap_mode=mode))
+                     for name in files])
+
+    def close(self):
+        ''' Remove all shared files '''
+        self._finalizer()
+        self.files = {}
@@ -17,16 +17,25 @@ from __future__ import absolute_import
 import os
 import sys
 import glob
+import json
+import shutil
+import tempfile
 import unittest
 import inspect
+import pickle
 
 import numpy as np
+import cv2
+from scipy.interpolate import griddata
 import matplotlib.pyplot as plt
 plt.switch_backend('Agg')
 
+import gdal
 from nansat import Nansat, Domain, NSR
 
-from sea_ice_drift.lib import (get_uint8_image,
+from sea_ice_drift.lib import (PolyDriftModel,
+                               ScatteredInterpolator,
+                               get_uint8_image,
                                get_displacement_km,
                                get_displacement_pix,
                                get_denoised_object,
@@ -36,19 +45,53 @@ from sea_ice_drift.lib import (get_uint8_image,
                                get_drift_vectors,
                                _fill_gpi)
 
-from sea_ice_drift.ftlib import (find_key_points,
+from sea_ice_drift.ftlib import (KeyPoints,
+                                 Matches,
+                                 find_key_points,
+                                 get_matcher,
                                  get_match_coords,
                                  domain_filter,
                                  max_drift_filter,
+                                 get_max_drift_pix,
                                  lstsq_filter,
                                  feature_tracking)
 
-from sea_ice_drift.pmlib import (get_rotated_template,
+from sea_ice_drift.pmlib import (get_hessian,
+                                 get_peak_properties,
+                                 get_rotated_template,
                                  get_distance_to_nearest_keypoint,
                                  get_initial_rotation,
-                                 rotate_and_match)
-
+                                 match_templates_fft,
+                                 get_window_norms,
+                                 match_templates_integral,
+                                 rotate_and_match,
+                                 get_pyramid,
+                                 refine_first_guess,
+                                 get_pixel_grid)
+
+from sea_ice_drift.cache import ArrayCache
+from sea_ice_drift.shared import SharedArrays
+from sea_ice_drift.reader import BlockReader
+from sea_ice_drift.checkpoint import Checkpoint
+from sea_ice_drift.executors import ProcessExecutor, get_executor
+from sea_ice_drift.geolocation import FastGeolocation, get_projector
 from sea_ice_drift.seaicedrift import SeaIceDrift
+from sea_ice_drift.batch import (estimate_pair_memory,
+                                 get_pair_id,
+                                 run_batch,
+                                 _get_next_pair)
+
+def _power_chunk(data, params, start, stop):
+    ''' Raise chunk of input array to power (for tests of executors) '''
+    data['out'][start:stop] = data['x'][start:stop] ** params['power']
+
+def _raise_pair(*args, **kwargs):
+    ''' Fail outside of process_pair (for tests of batch) '''
+    raise MemoryError('Test error')
+
+def _exit_pair(*args, **kwargs):
+    ''' Exit worker without status (e.g. killed by OOM killer) '''
+    os._exit(9)
 
 class SeaIceDriftLibTests(unittest.TestCase):
     def setUp(self):
@@ -82,6 +125,16 @@ class SeaIceDriftLibTests(unittest.TestCase):
         self.assertEqual(imageUint8.min(), 0)
         self.assertEqual(imageUint8.max(), 255)
 
+    def test_get_uint8_image_dB(self):
+        ''' Shall convert to dB and scale to uint8 in one pass '''
+        imageUint8 = get_uint8_image(self.img1, -30, -5, dB=True)
+        imageUint8Ref = get_uint8_image(10 * np.log10(self.img1), -30, -5)
+
+        self.assertEqual(imageUint8.dtype, np.uint8)
+        self.assertEqual(imageUint8.shape, self.img1.shape)
+        self.assertTrue(np.abs(imageUint8.astype(int) -
+                               imageUint8Ref.astype(int)).max() <= 1)
+
     def test_get_displacement_km(self):
         ''' Shall find matching coordinates and plot quiver in lon/lat'''
         img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
@@ -125,6 +178,37 @@ class SeaIceDriftLibTests(unittest.TestCase):
         self.assertEqual(n[1].min(), 0)
         self.assertEqual(n[1].max(), 255)
 
+    def test_get_n_cache(self):
+        ''' Shall store preprocessed scene in cache and read it back '''
+        cacheDir = tempfile.mkdtemp()
+        n1 = get_n(self.testFiles[0], scene_cache=cacheDir)
+        n2 = get_n(self.testFiles[0], scene_cache=cacheDir)
+        cacheSize = ArrayCache(os.path.join(cacheDir, 'scenes')).size()
+        shutil.rmtree(cacheDir)
+
+        self.assertTrue(cacheSize > 0)
+        np.testing.assert_array_equal(n1[1], n2[1])
+        self.assertEqual(n1.time_coverage_start, n2.time_coverage_start)
+        lon1, lat1 = n1.transform_points([10, 100], [20, 200])
+        lon2, lat2 = n2.transform_points([10, 100], [20, 200])
+        np.testing.assert_allclose(lon1, lon2)
+        np.testing.assert_allclose(lat1, lat2)
+
+    def test_fast_geolocation(self):
+        ''' Shall transform coordinates as Nansat with small error '''
+        n1 = get_n(self.testFiles[0])
+        fg1 = FastGeolocation(n1, step=50, max_error=0.5)
+        cols = np.random.uniform(0, n1.shape()[1], 1000)
+        rows = np.random.uniform(0, n1.shape()[0], 1000)
+        lon, lat = n1.transform_points(cols, rows)
+        lonf, latf = fg1.transform_points(cols, rows)
+        colsf, rowsf = fg1.transform_points(lon, lat, 1)
+
+        self.assertEqual(fg1.shape(), n1.shape())
+        self.assertTrue(fg1.error <= 0.5 or fg1.step < 10)
+        self.assertTrue(np.abs(latf - lat).max() < 0.01)
+        self.assertTrue(np.hypot(colsf - cols, rowsf - rows).max() < 1)
+
     def test_x2y2_interpolation_poly(self):
         img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
         img2 = get_uint8_image(self.img2, self.imgMin, self.imgMax)
@@ -148,6 +232,40 @@ class SeaIceDriftLibTests(unittest.TestCase):
         plt.close('all')
         self.assertEqual(len(x2p1), len(x1))
 
+    def test_poly_drift_model(self):
+        ''' Shall fit polynomial once and evaluate it by chunks '''
+        x1, y1 = np.random.uniform(0, 1000, (2, 500))
+        x2 = 10 + 1.01 * x1 + 0.02 * y1 + 1e-5 * x1 * y1
+        y2 = -5 + 0.99 * y1 - 0.01 * x1
+        x1grd, y1grd = np.meshgrid(np.arange(0, 1000, 10.),
+                                   np.arange(0, 1000, 20.))
+        model = PolyDriftModel(x1, y1, x2, y2, order=2)
+        x2grd, y2grd = model(x1grd, y1grd, chunk_size=1000)
+        x2grd32, y2grd32 = model(x1grd, y1grd, dtype=np.float32)
+        x2ref, y2ref = x2y2_interpolation_poly(x1, y1, x2, y2,
+                                               x1grd, y1grd, order=2)
+
+        self.assertEqual(x2grd.shape, x1grd.shape)
+        self.assertEqual(x2grd32.dtype, np.float32)
+        np.testing.assert_allclose(x2grd, x2ref)
+        np.testing.assert_allclose(y2grd, y2ref)
+        np.testing.assert_allclose(x2grd, 10 + 1.01 * x1grd + 0.02 * y1grd +
+                                   1e-5 * x1grd * y1grd, atol=1e-6)
+
+    def test_poly_drift_model_rotation(self):
+        ''' Shall find Jacobian and local rotation of the model '''
+        x1, y1 = np.random.uniform(0, 1000, (2, 500))
+        alpha = np.radians(5)
+        x2 = 10 + np.cos(alpha) * x1 + np.sin(alpha) * y1 + 1e-5 * x1 * y1
+        y2 = -5 - np.sin(alpha) * x1 + np.cos(alpha) * y1
+        model = PolyDriftModel(x1, y1, x2, y2, order=2)
+        dx2dx1, dx2dy1, dy2dx1, dy2dy1 = model.jacobian(x1, y1)
+        angle = model.get_rotation(500, 500)
+
+        np.testing.assert_allclose(dx2dy1, np.sin(alpha) + 1e-5 * x1)
+        np.testing.assert_allclose(dy2dx1, -np.sin(alpha), atol=1e-9)
+        self.assertAlmostEqual(angle, 5, 0)
+
     def test_x2y2_interpolation_near(self):
         img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
         img2 = get_uint8_image(self.img2, self.imgMin, self.imgMax)
@@ -165,6 +283,21 @@ class SeaIceDriftLibTests(unittest.TestCase):
         plt.close('all')
         self.assertEqual(len(x2p1), len(x1))
 
+    def test_scattered_interpolator(self):
+        ''' Shall interpolate several fields as griddata '''
+        x1, y1 = np.random.uniform(0, 100, (2, 500))
+        x2, y2 = x1 + 10 * np.sin(y1 / 10.), y1 + 5
+        x1grd, y1grd = np.meshgrid(np.arange(0, 100, 3.), np.arange(0, 100, 4.))
+        interpolator = ScatteredInterpolator(x1, y1, x1grd, y1grd,
+                                             chunk_size=100, threads=2)
+        x2grd, y2grd = interpolator(x2, y2)
+        x2ref = griddata(np.array([y1, x1]).T, x2,
+                         np.array([y1grd.flatten(), x1grd.flatten()]).T)
+
+        self.assertEqual(x2grd.shape, x1grd.shape)
+        np.testing.assert_allclose(x2grd.flatten(), x2ref)
+        self.assertTrue(np.nanmax(np.abs(y2grd - y1grd - 5)) < 1e-6)
+
     def test_get_drift_vectors(self):
         img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
         img2 = get_uint8_image(self.img2, self.imgMin, self.imgMax)
@@ -183,6 +316,19 @@ class SeaIceDriftLibTests(unittest.TestCase):
         self.assertEqual(len(u), len(x1))
         self.assertEqual(len(v), len(x1))
 
+    def test_get_projector(self):
+        ''' Shall reuse projector and convert lon/lat to projection and back '''
+        nsr = NSR('+proj=stere +lat_0=90 +lon_0=-45 +lat_ts=70 +datum=WGS84')
+        projector = get_projector(nsr)
+        lon, lat = np.array([-3., 0, 2]), np.array([86.4, 86.6, 86.8])
+        x, y = projector.forward(lon, lat)
+        lon2, lat2 = projector.inverse(x, y)
+
+        self.assertIs(get_projector(nsr), projector)
+        np.testing.assert_allclose(lon, lon2)
+        np.testing.assert_allclose(lat, lat2)
+        self.assertTrue(np.all(np.abs(x) > 1000))
+
     def test_fill_gpi(self):
         a = np.array([[1,2,3],[1,2,3],[1,2,3]])
         gpi = (a > 2)
@@ -197,6 +343,59 @@ class SeaIceDriftFTLibTests(SeaIceDriftLibTests):
         keyPoints1, descr1 = find_key_points(img1)
 
         self.assertTrue(len(keyPoints1) > 1000)
+        self.assertIsInstance(keyPoints1, KeyPoints)
+        self.assertEqual(len(keyPoints1), len(descr1))
+        self.assertEqual(keyPoints1.x.shape, keyPoints1.response.shape)
+
+    def test_find_key_points_tiled(self):
+        ''' Shall find key points in tiles '''
+        img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
+        keyPoints1, descr1 = find_key_points(img1, nFeatures=self.nFeatures,
+                                             tile_size=200, tile_threads=2)
+
+        self.assertIsInstance(keyPoints1, KeyPoints)
+        self.assertTrue(len(keyPoints1) > 1000)
+        self.assertTrue(len(keyPoints1) <= self.nFeatures + 100)
+        self.assertEqual(len(keyPoints1), len(descr1))
+
+    def test_find_key_points_cache(self):
+        ''' Shall store key points in cache and read them back '''
+        img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
+        cacheDir = tempfile.mkdtemp()
+        keyPoints1, descr1 = find_key_points(img1, nFeatures=self.nFeatures,
+                                             keypoint_cache=cacheDir)
+        keyPoints2, descr2 = find_key_points(img1, nFeatures=self.nFeatures,
+                                             keypoint_cache=cacheDir)
+        cache = ArrayCache(os.path.join(cacheDir, 'keypoints'))
+        cacheSize = cache.size()
+        shutil.rmtree(cacheDir)
+
+        self.assertTrue(cacheSize > 0)
+        np.testing.assert_array_equal(keyPoints1.x, keyPoints2.x)
+        np.testing.assert_array_equal(keyPoints1.octave, keyPoints2.octave)
+        np.testing.assert_array_equal(descr1, descr2)
+
+    def test_keypoints_subset(self):
+        ''' Shall select subset of keypoints together with descriptors '''
+        img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
+        keyPoints1, descr1 = find_key_points(img1, nFeatures=self.nFeatures)
+        gpi = keyPoints1.x > keyPoints1.x.mean()
+        keyPoints1f = keyPoints1[gpi]
+
+        self.assertEqual(len(keyPoints1f), gpi.sum())
+        self.assertEqual(len(keyPoints1f.descriptors), gpi.sum())
+        self.assertTrue(np.all(keyPoints1f.x > keyPoints1.x.mean()))
+
+    def test_matches_ratio_test(self):
+        ''' Shall keep matches with distance ratio below threshold '''
+        matches = Matches([0, 1, 2], [5, 6, 7], [10, 10, 10], [20, 12, np.inf])
+        good = matches.ratio_test(0.7)
+        single = matches.ratio_test(0.7, keep_single=True)
+
+        self.assertEqual(list(good.query_idx), [0])
+        self.assertEqual(list(good.train_idx), [5])
+        self.assertEqual(list(single.query_idx), [0, 2])
+        self.assertEqual(list(single.train_idx), [5, 7])
 
     def test_get_match_coords(self):
         ''' Shall find matching coordinates '''
@@ -209,6 +408,55 @@ class SeaIceDriftFTLibTests(SeaIceDriftLibTests):
         self.assertTrue(len(keyPoints1) > len(x1))
         self.assertTrue(len(keyPoints2) > len(x2))
 
+    def test_get_match_coords_lsh(self):
+        ''' Shall find matching coordinates with approximate matcher '''
+        img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
+        img2 = get_uint8_image(self.img2, self.imgMin, self.imgMax)
+        keyPoints1, descr1 = find_key_points(img1, nFeatures=self.nFeatures)
+        keyPoints2, descr2 = find_key_points(img2, nFeatures=self.nFeatures)
+        x1, y1, x2, y2 = get_match_coords(keyPoints1, descr1,
+                                          keyPoints2, descr2,
+                                          matcher='lsh', lsh_tables=8)
+        self.assertTrue(len(x1) > 0)
+        self.assertTrue(len(keyPoints1) > len(x1))
+
+    def test_get_matcher(self):
+        ''' Shall create matchers by name '''
+        self.assertIsInstance(get_matcher('bf'), cv2.BFMatcher)
+        self.assertIsInstance(get_matcher('lsh'), cv2.FlannBasedMatcher)
+        self.assertIsInstance(get_matcher(cv2.BFMatcher), cv2.BFMatcher)
+        with self.assertRaises(ValueError):
+            get_matcher('unknown')
+
+    def test_get_match_coords_spatial(self):
+        ''' Shall find matching coordinates only within search radius '''
+        img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
+        img2 = get_uint8_image(self.img2, self.imgMin, self.imgMax)
+        keyPoints1, descr1 = find_key_points(img1, nFeatures=self.nFeatures)
+        keyPoints2, descr2 = find_key_points(img2, nFeatures=self.nFeatures)
+        x1, y1, x2, y2 = get_match_coords(keyPoints1, descr1,
+                                          keyPoints2, descr2,
+                                          search_radius=100)
+        # approximate matcher: neighbours are filtered by radius before ratio test
+        x1l, y1l, x2l, y2l = get_match_coords(keyPoints1, descr1,
+                                              keyPoints2, descr2,
+                                              search_radius=100,
+                                              matcher='lsh', lsh_tables=8,
+                                              spatial_knn=32)
+
+        self.assertTrue(len(x1) > 0)
+        self.assertTrue(np.all(np.hypot(x2 - x1, y2 - y1) <= 100))
+        self.assertTrue(len(x1l) > 0)
+        self.assertTrue(np.all(np.hypot(x2l - x1l, y2l - y1l) <= 100))
+
+    def test_get_max_drift_pix(self):
+        ''' Shall find maximum displacement in pixels '''
+        radius05 = get_max_drift_pix(self.n1, self.n2, maxDrift=0.5)
+        radius10 = get_max_drift_pix(self.n1, self.n2, maxDrift=1.0)
+
+        self.assertTrue(radius05 > 1)
+        self.assertAlmostEqual((radius10 - 1) / (radius05 - 1), 2, 3)
+
     def test_domain_filter(self):
         ''' Shall leave keypoints from second image withn domain of the first '''
         img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
@@ -220,12 +468,8 @@ class SeaIceDriftFTLibTests(SeaIceDriftLibTests):
                                              self.n1, domainMargin=100)
 
         # plot dots
-        cols1 = [kp.pt[0] for kp in keyPoints1]
-        rows1 = [kp.pt[1] for kp in keyPoints1]
-        lon1, lat1 = self.n1.transform_points(cols1, rows1, 0)
-        cols2 = [kp.pt[0] for kp in keyPoints2f]
-        rows2 = [kp.pt[1] for kp in keyPoints2f]
-        lon2, lat2 = self.n2.transform_points(cols2, rows2, 0)
+        lon1, lat1 = self.n1.transform_points(keyPoints1.x, keyPoints1.y, 0)
+        lon2, lat2 = self.n2.transform_points(keyPoints2f.x, keyPoints2f.y, 0)
         plt.plot(lon1, lat1, '.')
         plt.plot(lon2, lat2, '.')
         plt.savefig('sea_ice_drift_tests_%s.png' % inspect.currentframe().f_code.co_name)
@@ -261,6 +505,11 @@ class SeaIceDriftFTLibTests(SeaIceDriftLibTests):
         x1f, y1f, x2f, y2f = lstsq_filter(x1, y1, x2, y2)
         self.assertTrue(len(x1) > len(x1f))
 
+        x1f, y1f, x2f, y2f, model = lstsq_filter(x1, y1, x2, y2,
+                                                 return_model=True)
+        self.assertIsInstance(model, PolyDriftModel)
+        self.assertEqual(model.order, 2)
+
 
 class SeaIceDriftPMLibTests(SeaIceDriftLibTests):
     def test_get_rotated_template(self):
@@ -292,6 +541,118 @@ class SeaIceDriftPMLibTests(SeaIceDriftLibTests):
                     dist)
         self.assertEqual(dist.shape, img1.shape)
 
+    def test_get_distance_to_nearest_keypoint_points(self):
+        ''' Shall find distances only in given points as in full matrix '''
+        x1, y1 = np.random.uniform(0, 300, (2, 100))
+        x1_dst, y1_dst = np.random.uniform(0, 300, (2, 1000))
+        dist_img = get_distance_to_nearest_keypoint(x1, y1, (300, 300))
+        dist = get_distance_to_nearest_keypoint(x1, y1, (300, 300),
+                                                x1_dst, y1_dst)
+
+        self.assertEqual(dist.shape, x1_dst.shape)
+        np.testing.assert_allclose(dist, dist_img[y1_dst.astype(int),
+                                                  x1_dst.astype(int)])
+
+    def test_shared_arrays(self):
+        ''' Shall share arrays through memory-mapped files '''
+        with SharedArrays() as shared:
+            shared.put('img1', self.img1)
+            results = shared.create('results', (10, 5))
+            arrays = SharedArrays.load(shared.files, 'r+')
+            arrays['results'][2] = 1
+            path = shared.path
+
+            np.testing.assert_array_equal(arrays['img1'], self.img1)
+            self.assertEqual(results[2, 0], 1)
+            self.assertTrue(np.isnan(results[0, 0]))
+        self.assertFalse(os.path.exists(path))
+        # files are removed without close() too
+        shared = SharedArrays()
+        shared.put('x', np.zeros(3))
+        path = shared.path
+        del shared
+        self.assertFalse(os.path.exists(path))
+
+    def test_executors(self):
+        ''' Shall apply function to chunks with all backends '''
+        x = np.arange(10.)
+        for backend in ['serial', 'threads', 'processes']:
+            with get_executor(backend, threads=2, chunksize=3) as executor:
+                data = dict(x=x, out=np.zeros(10))
+                executor.map_chunks(_power_chunk, data, ['out'],
+                                    dict(power=2), 10)
+                np.testing.assert_array_equal(data['out'], x**2)
+                # each finished chunk is filled when it is yielded
+                data = dict(x=x, out=np.zeros(10))
+                for start, stop in executor.imap_chunks(_power_chunk, data,
+                                                        ['out'],
+                                                        dict(power=3), 10):
+                    np.testing.assert_array_equal(data['out'][start:stop],
+                                                  x[start:stop]**3)
+                np.testing.assert_array_equal(data['out'], x**3)
+
+        self.assertEqual(executor.get_chunks(10),
+                         [(0, 3), (3, 6), (6, 9), (9, 10)])
+        self.assertRaises(ValueError, get_executor, 'gpu')
+
+    def test_process_executor_share(self):
+        ''' Shall share the same input array only once '''
+        img1 = np.arange(100.).reshape(10, 10)
+        img2 = img1 * 2
+        x = np.arange(10.)
+        with ProcessExecutor(threads=2, chunksize=3) as executor:
+            files1 = executor.share(dict(img1=img1))
+            files2 = executor.share(dict(img1=img1))
+            # modified in place
+            img1[0, 0] = -1
+            files3 = executor.share(dict(img1=img1))
+            shared3 = np.load(files3['img1'])
+            files4 = executor.share(dict(img1=img2))
+            shared4 = np.load(files4['img1'])
+            # calls cannot overlap
+            chunks = executor.imap_chunks(_power_chunk,
+                                          dict(x=x, out=np.zeros(10)),
+                                          ['out'], dict(power=2), 10)
+            next(chunks)
+            self.assertRaises(RuntimeError, executor.map_chunks,
+                              _power_chunk, dict(x=x, out=np.zeros(10)),
+                              ['out'], dict(power=2), 10)
+            chunks.close()
+            data = dict(x=x, out=np.zeros(10))
+            executor.map_chunks(_power_chunk, data, ['out'], dict(power=2), 10)
+
+        self.assertEqual(files1['img1'], files2['img1'])
+        self.assertNotEqual(files2['img1'], files3['img1'])
+        self.assertFalse(os.path.exists(files2['img1']))
+        self.assertEqual(shared3[0, 0], -1)
+        np.testing.assert_array_equal(shared4, img2)
+        np.testing.assert_array_equal(data['out'], x**2)
+        self.assertFalse(os.path.exists(files4['img1']))
+
+    def test_block_reader(self):
+        ''' Shall read same windows from file by blocks as from array '''
+        img = gdal.Open(self.testFiles[0]).GetRasterBand(1).ReadAsArray()
+        reader = pickle.loads(pickle.dumps(BlockReader(self.testFiles[0],
+                                                       block_size=100,
+                                                       max_blocks=4)))
+        window = reader[150:420, 90:333]
+        mem_dataset = gdal.GetDriverByName('MEM').CreateCopy(
+                                        '', gdal.Open(self.testFiles[0]))
+        template1 = get_rotated_template(reader, 200, 200, 35, 10)
+        template2 = get_rotated_template(img, 200, 200, 35, 10)
+
+        self.assertEqual(reader.shape, img.shape)
+        np.testing.assert_array_equal(window, img[150:420, 90:333])
+        for rows, cols in [(slice(-5, 10), slice(None, 10)),
+                           (slice(-250, -30), slice(-99, None)),
+                           (slice(30, 10), slice(5, 20))]:
+            np.testing.assert_array_equal(reader[rows, cols], img[rows, cols])
+        np.testing.assert_array_equal(template1, template2)
+        self.assertRaises(TypeError, pickle.dumps, BlockReader(mem_dataset))
+        np.testing.assert_array_equal(get_pyramid(reader, 1)[1],
+                                      cv2.pyrDown(img))
+        self.assertEqual(len(reader._blocks), 4)
+
     def test_get_initial_rotation(self):
         ''' Shall find angle between images '''
         alpha12 = get_initial_rotation(self.n1, self.n2)
@@ -319,6 +680,117 @@ class SeaIceDriftPMLibTests(SeaIceDriftLibTests):
         plt.savefig('sea_ice_drift_tests_%s.png' % inspect.currentframe().f_code.co_name,)
         plt.close('all')
 
+    def test_get_peak_properties(self):
+        ''' Shall find Hessian as get_hessian, sub-pixel peak and 2nd peak '''
+        yy, xx = np.mgrid[:81, :81]
+        ccm = (np.exp(-((xx - 40.3)**2 + (yy - 39.8)**2) / 20.) +
+               0.5 * np.exp(-((xx - 10)**2 + (yy - 60)**2) / 20.))
+        ccm = ccm.astype(np.float32)
+        h, dy, dx, ratio = get_peak_properties(ccm)
+        h_rej = get_peak_properties(ccm, min_peak_r=1.5)
+        h_only = get_peak_properties(ccm, subpixel=False, peak_ratio=False)
+
+        self.assertAlmostEqual(h, get_hessian(ccm)[40, 40], 4)
+        self.assertAlmostEqual(40 + dx, 40.3, 1)
+        self.assertAlmostEqual(40 + dy, 39.8, 1)
+        self.assertAlmostEqual(ratio, 0.5, 2)
+        self.assertTrue(np.isnan(h_rej[0]))
+        self.assertEqual(h_only[:3], (h, 0., 0.))
+        self.assertTrue(np.isnan(h_only[3]))
+
+    def test_match_templates_fft(self):
+        ''' Shall give same CC as cv2.matchTemplate for all templates '''
+        img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
+        image = get_uint8_image(self.img2, self.imgMin, self.imgMax)[:150, :150]
+        templates = [get_rotated_template(img1, 100, 100, 35, angle)
+                     for angle in [-10, 0, 10]]
+        templates = [t.astype(np.uint8) for t in templates]
+        results = match_templates_fft(image, templates)
+
+        self.assertEqual(results.shape, (3, 116, 116))
+        for template, result in zip(templates, results):
+            result_cv2 = cv2.matchTemplate(image, template,
+                                           cv2.TM_CCOEFF_NORMED)
+            np.testing.assert_allclose(result, result_cv2, atol=1e-4)
+
+    def test_match_templates_constant(self):
+        ''' Shall give same CC as cv2.matchTemplate for constant template '''
+        image = np.random.RandomState(0).randint(0, 255, (60, 60))
+        image = image.astype(np.uint8)
+        image[:30] = 0
+        templates = [np.zeros((15, 15), np.uint8) + 10, image[5:20, 5:20]]
+        results_cv2 = [cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+                       for template in templates]
+        results_fft = match_templates_fft(image, templates)
+        results_integral = match_templates_integral(image, templates)
+
+        for results in [results_fft, results_integral]:
+            for result, result_cv2 in zip(results, results_cv2):
+                np.testing.assert_allclose(result, result_cv2, atol=1e-4)
+
+    def test_match_templates_integral(self):
+        ''' Shall give same CC as cv2.matchTemplate with norms of windows
+        cut from norms of full image '''
+        img1 = get_uint8_image(self.img1, self.imgMin, self.imgMax)
+        img2 = get_uint8_image(self.img2, self.imgMin, self.imgMax)
+        image = img2[50:200, 50:200]
+        norms = get_window_norms(img2, (35, 35), block_rows=30)
+        templates = [get_rotated_template(img1, 100, 100, 35, angle)
+                     for angle in [-10, 0, 10]]
+        templates = [t.astype(np.uint8) for t in templates]
+        results = match_templates_integral(image, templates,
+                                           norms[50:166, 50:166])
+
+        self.assertEqual(norms.shape, (img2.shape[0] - 34, img2.shape[1] - 34))
+        for template, result in zip(templates, results):
+            result_cv2 = cv2.matchTemplate(image, template,
+                                           cv2.TM_CCOEFF_NORMED)
+            np.testing.assert_allclose(result, result_cv2, atol=1e-4)
+
+    def test_rotate_and_match_fft(self):
+        ''' Shall find same match with both engines '''
+        n1 = get_n(self.testFiles[0])
+        n2 = get_n(self.testFiles[1])
+        res_cv2 = rotate_and_match(n1[1],300,100,50,n2[1],60,[-2,-1,0,1,2])
+        res_fft = rotate_and_match(n1[1],300,100,50,n2[1],60,[-2,-1,0,1,2],
+                                   engine='fft')
+
+        self.assertAlmostEqual(res_cv2[0], res_fft[0], 4)
+        self.assertEqual(res_cv2[1], res_fft[1])
+        self.assertEqual(res_cv2[3:5], res_fft[3:5])
+
+    def test_rotate_and_match_adaptive(self):
+        ''' Shall find same match with adaptive search of angles '''
+        n1 = get_n(self.testFiles[0])
+        n2 = get_n(self.testFiles[1])
+        res_all = rotate_and_match(n1[1],300,100,50,n2[1],60,range(-15,16,3))
+        res_adp = rotate_and_match(n1[1],300,100,50,n2[1],60,range(-15,16,3),
+                                   angle_prior=res_all[1] + 2)
+
+        self.assertEqual(res_all[:2], res_adp[:2])
+        self.assertEqual(res_all[3:5], res_adp[3:5])
+
+    def test_refine_first_guess(self):
+        ''' Shall find large shift on downsampled levels of pyramids '''
+        img = cv2.GaussianBlur(np.random.RandomState(0).rand(600, 600), (0, 0), 4)
+        img1 = get_uint8_image(img, img.min(), img.max())
+        img2 = np.roll(np.roll(img1, -24, axis=0), 40, axis=1)
+        pyr1, pyr2 = get_pyramid(img1, 2), get_pyramid(img2, 2)
+        images = dict(img1=img1, img2=img2, img1_1=pyr1[1], img2_1=pyr2[1],
+                      img1_2=pyr1[2], img2_2=pyr2[2])
+        x1, y1 = np.meshgrid([200., 300., 400.], [200., 300., 400.])
+        arrays = dict(x1_dst=x1.flatten(), y1_dst=y1.flatten(),
+                      x2fg=x1.flatten(), y2fg=y1.flatten(),
+                      border=np.zeros(9) + 60)
+        params = dict(img_size=35, alpha0=0, angles=[0])
+        refined = refine_first_guess(get_executor('serial'), images, arrays,
+                                     params, 2, pyramid_border=4)
+
+        self.assertEqual(pyr1[2].shape, (150, 150))
+        self.assertTrue(np.all(np.abs(refined['x2fg'] - x1.flatten() - 40) < 4))
+        self.assertTrue(np.all(np.abs(refined['y2fg'] - y1.flatten() + 24) < 4))
+        self.assertTrue(np.all(refined['border'] == 4))
+
 
 class SeaIceDriftClassTests(SeaIceDriftLibTests):
     def test_integrated(self):
@@ -361,6 +833,159 @@ class SeaIceDriftClassTests(SeaIceDriftLibTests):
                     dpi=150, bbox_inches='tight', pad_inches=0)
         plt.close('all')
 
+    def test_get_drift_tiled(self):
+        ''' Shall merge FT and PM results from tiles '''
+        lon1pm, lat1pm = np.meshgrid(np.linspace(-3, 2, 20),
+                                     np.linspace(86.4, 86.8, 20))
+        sid = SeaIceDrift(self.testFiles[0], self.testFiles[1])
+        ft, pm = sid.get_drift_tiled(lon1pm, lat1pm, tile_size=300,
+                                     threads=2)
+        upm, vpm, rpm, apm, hpm, lon2pm, lat2pm = pm
+
+        self.assertEqual(len(ft), 6)
+        self.assertTrue(len(ft[0]) > 0)
+        self.assertTrue(np.all(np.isfinite(ft[0])))
+        self.assertEqual(rpm.shape, lon1pm.shape)
+        self.assertTrue(np.any(rpm > 0.4))
+        # parallel tiles give the same results as tiles one by one
+        ft1, pm1 = sid.get_drift_tiled(lon1pm, lat1pm, tile_size=300,
+                                       threads=1)
+        for res, res1 in zip(ft + pm, ft1 + pm1):
+            np.testing.assert_array_equal(res, res1)
+
+    def test_get_drift_PM_executor(self):
+        ''' Shall keep workers only inside with block '''
+        lon1pm, lat1pm = np.meshgrid(np.linspace(-3, 2, 5),
+                                     np.linspace(86.4, 86.8, 5))
+        sid = SeaIceDrift(self.testFiles[0], self.testFiles[1])
+        uft, vft, lon1ft, lat1ft, lon2ft, lat2ft = sid.get_drift_FT()
+        pm0 = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft, lon2ft, lat2ft,
+                               threads=2)
+        self.assertIsNone(sid.executor)
+        with sid:
+            pm1 = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft,
+                                   lon2ft, lat2ft, threads=2)
+            executor = sid.executor
+            sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft, lon2ft, lat2ft,
+                             threads=2)
+            self.assertIs(sid.executor, executor)
+        self.assertIsNone(sid.executor)
+        for arr0, arr1 in zip(pm0, pm1):
+            np.testing.assert_array_equal(arr0, arr1)
+
+    def test_get_drift_PM_integral(self):
+        ''' Shall give same PM results with engine integral as with default
+        engine on dense grid and reuse norms of windows of image 2 '''
+        sid = SeaIceDrift(self.testFiles[0], self.testFiles[1])
+        lon1pm, lat1pm = get_pixel_grid(sid.n1, 70)
+        uft, vft, lon1ft, lat1ft, lon2ft, lat2ft = sid.get_drift_FT()
+        pm0 = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft, lon2ft, lat2ft,
+                               backend='serial')
+        pm1 = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft, lon2ft, lat2ft,
+                               backend='serial', engine='integral')
+        norms2 = sid.get_norms2(35)
+        pm2 = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft, lon2ft, lat2ft,
+                               backend='processes', threads=2,
+                               engine='integral')
+        upm0, vpm0, rpm0 = pm0[:3]
+
+        self.assertIs(sid.get_norms2(35), norms2)
+        self.assertEqual(norms2[0].shape, (sid.img2.shape[0] - 34,
+                                           sid.img2.shape[1] - 34))
+        for upm, vpm, rpm, apm, hpm, lon2pm, lat2pm in [pm1, pm2]:
+            gpi = np.isfinite(rpm0)
+            np.testing.assert_array_equal(np.isfinite(rpm), gpi)
+            np.testing.assert_allclose(rpm[gpi], rpm0[gpi], atol=1e-4)
+            # peaks with (almost) equal CC can be swapped by rounding
+            self.assertTrue(np.mean((upm[gpi] == upm0[gpi]) *
+                                    (vpm[gpi] == vpm0[gpi])) > 0.99)
+
+    def test_get_drift_PM_checkpoint(self):
+        ''' Shall resume interrupted PM from checkpoint '''
+        lon1pm, lat1pm = np.meshgrid(np.linspace(-3, 2, 10),
+                                     np.linspace(86.4, 86.8, 10))
+        cpDir = tempfile.mkdtemp()
+        sid = SeaIceDrift(self.testFiles[0], self.testFiles[1])
+        uft, vft, lon1ft, lat1ft, lon2ft, lat2ft = sid.get_drift_FT()
+        pm0 = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft, lon2ft, lat2ft,
+                               backend='serial')
+        # interrupt the run after the first chunk
+        chunks = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft,
+                                  lon2ft, lat2ft, backend='serial',
+                                  chunksize=5, stream=True,
+                                  checkpoint=Checkpoint(cpDir, interval=0))
+        next(chunks)
+        chunks.close()
+        cpFiles = os.listdir(cpDir)
+        pm1 = sid.get_drift_PM(lon1pm, lat1pm, lon1ft, lat1ft, lon2ft, lat2ft,
+                               backend='serial', checkpoint=cpDir)
+        shutil.rmtree(cpDir)
+
+        self.assertEqual(len(cpFiles), 1)
+        for arr0, arr1 in zip(pm0, pm1):
+            np.testing.assert_array_equal(arr0, arr1)
+
+
+
+class SeaIceDriftBatchTests(SeaIceDriftLibTests):
+    def test_estimate_pair_memory(self):
+        ''' Shall estimate memory proportional to size of scenes '''
+        mem05 = estimate_pair_memory(self.testFiles[0], self.testFiles[1],
+                                     0.5, overhead=0)
+        mem10 = estimate_pair_memory(self.testFiles[0], self.testFiles[1],
+                                     1.0, overhead=0)
+
+        self.assertTrue(mem05 > 0)
+        self.assertEqual(mem10, mem05 * 4)
+        self.assertRaises(IOError, estimate_pair_memory,
+                          'missing1.tif', 'missing2.tif')
+
+    def test_get_next_pair(self):
+        ''' Shall start the first pair which fits into memory '''
+        memory = dict(a=10, b=5, c=3)
+
+        self.assertEqual(_get_next_pair(['a', 'b', 'c'], memory, 0, 0, 12), 'a')
+        self.assertEqual(_get_next_pair(['b', 'c'], memory, 10, 1, 12), None)
+        self.assertEqual(_get_next_pair(['b', 'c'], memory, 8, 1, 12), 'c')
+        self.assertEqual(_get_next_pair(['a'], memory, 0, 0, 5), 'a')
+
+    def test_run_batch(self):
+        ''' Shall process pair, write product and status '''
+        lon, lat = np.meshgrid(np.linspace(-3, 2, 5), np.linspace(86.4, 86.8, 5))
+        outDir = tempfile.mkdtemp()
+        status = run_batch([self.testFiles[:2]], dict(lon=lon, lat=lat),
+                           outDir, processes=1)
+        pair_id = get_pair_id(*self.testFiles[:2])
+        product = np.load(os.path.join(outDir, pair_id + '.npz'))
+        status2 = run_batch([self.testFiles[:2]], dict(lon=lon, lat=lat),
+                            outDir, processes=1)
+        statusFileExists = os.path.exists(os.path.join(outDir, 'status.json'))
+        shutil.rmtree(outDir)
+
+        self.assertEqual(status[pair_id]['status'], 'done')
+        self.assertEqual(product['upm'].shape, lon.shape)
+        self.assertEqual(status2[pair_id]['time'], status[pair_id]['time'])
+        self.assertTrue(statusFileExists)
+
+    def test_run_batch_lost_worker(self):
+        ''' Shall mark pair as failed if worker raises or exits '''
+        lon, lat = np.meshgrid(np.linspace(-3, 2, 5), np.linspace(86.4, 86.8, 5))
+        outDir = tempfile.mkdtemp()
+        pair_id = get_pair_id(*self.testFiles[:2])
+        status1 = run_batch([self.testFiles[:2]], dict(lon=lon, lat=lat),
+                            outDir, processes=1, pair_func=_raise_pair)
+        status2 = run_batch([self.testFiles[:2]], dict(lon=lon, lat=lat),
+                            outDir, processes=1, pair_func=_exit_pair)
+        with open(os.path.join(outDir, 'status.json')) as f:
+            statusFile = json.load(f)
+        shutil.rmtree(outDir)
+
+        self.assertEqual(status1[pair_id]['status'], 'failed')
+        self.assertIn('MemoryError', status1[pair_id]['error'])
+        self.assertEqual(status2[pair_id]['status'], 'failed')
+        self.assertIn('exited with code 9', status2[pair_id]['error'])
+        self.assertEqual(statusFile[pair_id]['status'], 'failed')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,225 @@
+# Name:    tiling.py
+# Purpose: Container of tiled retrieval of sea ice drift from large scenes
+# Authors:      Anton Korosov, Stefan Muckenhuber
+# Created:      16.10.2026
+# Copyright:    (c) NERSC 2016
+# Licence:
+# This file is part of SeaIceDrift.
+# SeaIceDrift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+# http://www.gnu.org/licenses/gpl-3.0.html
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+from __future__ import absolute_import
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from sea_ice_drift.ftlib import feature_tracking, get_max_drift_pix, _get_tiles
+from sea_ice_drift.pmlib import pattern_matching
+from sea_ice_drift.geolocation import TileGeolocation
+from sea_ice_drift.reader import get_reader
+
+def get_tile_margin(ft_kwargs=None, pm_kwargs=None):
+    ''' Find margin around tile needed for Feature Tracking (edge of the
+    coarsest level of ORB pyramid) and for Pattern Matching (template and
+    maximum searching distance)
+    Parameters
+    ----------
+        ft_kwargs : dict, parameters for feature_tracking
+        pm_kwargs : dict, parameters for pattern_matching
+    Returns
+    -------
+        margin : int, pixels
+    '''
+    ft_kwargs = ft_kwargs or {}
+    pm_kwargs = pm_kwargs or {}
+    ft_margin = (max(ft_kwargs.get('edgeThreshold', 34),
+                     ft_kwargs.get('patchSize', 34)) *
+                 1.2 ** (ft_kwargs.get('nLevels', 7) - 1))
+    hws = pm_kwargs.get('img_size', 35) / 2.
+    pm_margin = np.hypot(hws, hws) + 2 * pm_kwargs.get('max_border', 50)
+    return int(np.ceil(max(ft_margin, pm_margin))) + 1
+
+def _get_window2(n1, n2, window1, halo, shape2):
+    ''' Find window on image 2 which covers <window1> of image 1 extended
+    by <halo> pixels, None if windows do not overlap '''
+    row0, row1, col0, col1 = window1
+    t = np.linspace(0, 1, 11)
+    cols = np.hstack([col0 + t * (col1 - col0), np.zeros(11) + col1,
+                      col0 + t * (col1 - col0), np.zeros(11) + col0])
+    rows = np.hstack([np.zeros(11) + row0, row0 + t * (row1 - row0),
+                      np.zeros(11) + row1, row0 + t * (row1 - row0)])
+    lon, lat = n1.transform_points(cols, rows, 0)
+    x2, y2 = n2.transform_points(lon, lat, 1)
+    if not np.any(np.isfinite(x2)):
+        return None
+    window2 = (max(int(np.floor(np.nanmin(y2) - halo)), 0),
+               min(int(np.ceil(np.nanmax(y2) + halo)), shape2[0]),
+               max(int(np.floor(np.nanmin(x2) - halo)), 0),
+               min(int(np.ceil(np.nanmax(x2) + halo)), shape2[1]))
+    if window2[1] <= window2[0] or window2[3] <= window2[2]:
+        return None
+    return window2
+
+def process_tile(n1, n2, tile, img1, img2, lon1pm, lat1pm, x1pm, y1pm,
+                 halo, ft_kwargs=None, pm_kwargs=None, window2=False,
+                 lock=None):
+    ''' Run Feature Tracking and Pattern Matching in one tile
+    Parameters
+    ----------
+        n1 : Nansat, the first image
+        n2 : Nansat, the second image
+        tile : list with core and extended window of the tile on image 1:
+            [(row0, row1, col0, col1), (row0, row1, col0, col1)]
+        img1 : 2D UInt8 array or BlockReader, the first image
+        img2 : 2D UInt8 array or BlockReader, the second image
+        lon1pm, lat1pm : 1D vectors, coordinates of PM grid points
+        x1pm, y1pm : 1D vectors, pixel coordinates of PM grid points on n1
+        halo : float, maximum drift, pixels
+        ft_kwargs : dict, parameters for feature_tracking
+        pm_kwargs : dict, parameters for pattern_matching
+        window2 : (row0, row1, col0, col1) or None, window of image 2 (see
+            _get_window2), computed if False
+        lock : threading.Lock, serializes calls of n1 and n2 if tiles are
+            processed in parallel threads
+    Returns
+    -------
+        ft : tuple with x1, y1, x2, y2 - FT vectors which start in the core
+            of the tile (pixel coordinates on n1 and n2)
+        pm : tuple with indices of PM grid points in the core of the tile
+            and u, v, r, a, h, lon2, lat2 for these points
+    '''
+    ft_kwargs = dict(ft_kwargs or {})
+    pm_kwargs = dict(pm_kwargs or {})
+    (row0, row1, col0, col1), window1 = tile
+    ipm = np.nonzero((x1pm >= col0) * (x1pm < col1) *
+                     (y1pm >= row0) * (y1pm < row1))[0]
+    empty_ft = (np.array([]),) * 4
+    empty_pm = (ipm,) + (np.zeros(len(ipm)),) * 7
+    lock = lock or threading.Lock()
+    with lock:
+        scene_shape = n1.shape()
+        if window2 is False:
+            window2 = _get_window2(n1, n2, window1, halo, n2.shape())
+    if window2 is None:
+        return empty_ft, empty_pm
+
+    # subimages and geolocation of the windows
+    tn1 = TileGeolocation(n1, window1[0], window1[2],
+                          window1[1] - window1[0], window1[3] - window1[2],
+                          lock)
+    tn2 = TileGeolocation(n2, window2[0], window2[2],
+                          window2[1] - window2[0], window2[3] - window2[2],
+                          lock)
+    sub1 = np.ascontiguousarray(img1[window1[0]:window1[1],
+                                     window1[2]:window1[3]])
+    sub2 = np.ascontiguousarray(img2[window2[0]:window2[1],
+                                     window2[2]:window2[3]])
+
+    # number of keypoints is proportional to the area of the window
+    scene_area = float(scene_shape[0] * scene_shape[1])
+    ft_kwargs['nFeatures'] = int(np.ceil(ft_kwargs.get('nFeatures', 100000) *
+                                         sub1.size / scene_area))
+    x1, y1, x2, y2 = feature_tracking(tn1, tn2, img1=sub1, img2=sub2,
+                                      **ft_kwargs)
+
+    pm = empty_pm
+    if len(ipm) > 0:
+        # local drift model is fitted to all vectors in the tile
+        pm_kwargs.setdefault('backend', 'serial')
+        pm = (ipm,) + tuple(pattern_matching(lon1pm[ipm], lat1pm[ipm],
+                                             tn1, x1, y1, tn2, x2, y2,
+                                             img1=sub1, img2=sub2,
+                                             **pm_kwargs))
+
+    # each vector belongs to the tile where it starts (no duplicates)
+    x1, y1 = np.asarray(x1) + window1[2], np.asarray(y1) + window1[0]
+    x2, y2 = np.asarray(x2) + window2[2], np.asarray(y2) + window2[0]
+    gpi = (x1 >= col0) * (x1 < col1) * (y1 >= row0) * (y1 < row1)
+    return (x1[gpi], y1[gpi], x2[gpi], y2[gpi]), pm
+
+def tiled_drift(n1, n2, lon1pm, lat1pm, tile_size=4096, img1=None,
+                img2=None, threads=4, halo=None, margin=None,
+                ft_kwargs=None, pm_kwargs=None):
+    ''' Run Feature Tracking and Pattern Matching by tiles of the first image
+
+    Each tile of image 1 is extended by <margin> and the corresponding
+    window of image 2 is extended by <halo> (maximum drift). FT (including
+    lstsq_filter) and PM (including the polynomial first guess) use only
+    subimages and vectors of the tile, so the drift model is local and
+    memory usage is bounded by size of the tile rather than size of the
+    scene. FT vectors and PM grid points belong only to the tile where
+    they start, so results are merged without duplicates at tile seams.
+    Windows on image 2 are found before starting the threads and all other
+    calls of n1 and n2 (e.g. transform_points) are serialized with a lock.
+    Parameters
+    ----------
+        n1 : Nansat, the first image
+        n2 : Nansat, the second image
+        lon1pm : 1D or 2D array, longitude of PM grid points on image 1
+        lat1pm : 1D or 2D array, latitude of PM grid points on image 1
+        tile_size : int, size of tiles, pixels
+        img1 : 2D UInt8 array, name of file, gdal.Dataset, numpy.memmap or
+            BlockReader, the first image (read from n1 if None)
+        img2 : the second image (as img1)
+        threads : int, number of tiles processed in parallel threads
+        halo : float, maximum drift, pixels (from maxDrift in <ft_kwargs>
+            if None, see get_max_drift_pix)
+        margin : int, extension of tiles (see get_tile_margin if None)
+        ft_kwargs : dict, parameters for feature_tracking (nFeatures is
+            given for the whole scene)
+        pm_kwargs : dict, parameters for pattern_matching
+    Returns
+    -------
+        ft : tuple with x1, y1, x2, y2 - FT vectors, pixel coordinates on n1
+            and n2 (see feature_tracking)
+        pm : tuple with u, v, r, a, h, lon2, lat2 - PM results for the grid
+            points (see pattern_matching)
+    '''
+    ft_kwargs = ft_kwargs or {}
+    pm_kwargs = pm_kwargs or {}
+    if img1 is None:
+        img1 = n1[1]
+    if img2 is None:
+        img2 = n2[1]
+    img1, img2 = get_reader(img1), get_reader(img2)
+    if halo is None:
+        halo = get_max_drift_pix(n1, n2, **ft_kwargs)
+    if margin is None:
+        margin = get_tile_margin(ft_kwargs, pm_kwargs)
+    lon1pm = np.asarray(lon1pm)
+    lat1pm = np.asarray(lat1pm)
+    x1pm, y1pm = n1.transform_points(lon1pm.flatten(), lat1pm.flatten(), 1)
+    x1pm, y1pm = np.asarray(x1pm), np.asarray(y1pm)
+
+    tiles = _get_tiles(n1.shape(), tile_size, margin)
+    shape2 = n2.shape()
+    windows2 = [_get_window2(n1, n2, tile[1], halo, shape2) for tile in tiles]
+    lock = threading.Lock()
+
+    def process(args):
+        tile, window2 = args
+        return process_tile(n1, n2, tile, img1, img2,
+                            lon1pm.flatten(), lat1pm.flatten(), x1pm, y1pm,
+                            halo, ft_kwargs, pm_kwargs, window2, lock)
+
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(process, list(zip(tiles, windows2)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    # merge results of all tiles
+    ft = tuple(np.hstack([res[0][i] for res in results]) for i in range(4))
+    pm = [np.zeros(lon1pm.size) for i in range(7)]
+    for res in results:
+        for i in range(7):
+            pm[i][res[1][0]] = res[1][i + 1]
+    pm = tuple(p.reshape(lon1pm.shape) for p in pm)
+    return ft, pm
@@ -13,6 +13,11 @@ setup(
     download_url='https://github.com/nansencenter/sea_ice_drift/archive/v0.6.tar.gz',
     packages=['sea_ice_drift'],
     test_suite="sea_ice_drift.tests",
+    entry_points={
+        'console_scripts': [
+            'sea_ice_drift_batch = sea_ice_drift.batch:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Plugins',